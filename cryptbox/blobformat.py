@@ -0,0 +1,738 @@
+# cryptbox - format of the encrypted files
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import bz2
+import hashlib
+import hmac
+import os
+import struct
+import zlib
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from cancellation import *
+
+try:
+    import lzma
+except ImportError:
+    # lzma is only available with Python 3 or the backports.lzma package
+    lzma = None
+
+# An encrypted file consists of a header, the authentication code of the
+# header and the segments. The content is split into segments of a fixed
+# size; each segment is encrypted with AES in counter mode and followed
+# by its authentication code, so that every segment can be decrypted and
+# verified independently of the others. If the content is compressed,
+# each segment is compressed before it is encrypted and the encrypted
+# lengths of the segments follow the last segment.
+
+# identifies files in the segmented format. Files of the former format
+# start with the size of the content instead.
+BLOB_MAGIC = "CRYPTBOX"
+
+# version of the segmented format
+BLOB_VERSION = 2
+
+# layout of the header: magic, version, codec, reserved, size of the
+# segments, size of the content and a random nonce
+BLOB_HEADER_FORMAT = "<8sBBHIQ8s"
+BLOB_HEADER_SIZE = struct.calcsize(BLOB_HEADER_FORMAT)
+
+# codecs of the content of the segments
+BLOB_CODEC_NONE = 0
+BLOB_CODEC_ZLIB = 1
+BLOB_CODEC_BZ2 = 2
+BLOB_CODEC_LZMA = 3
+
+# codecs by their names in the configuration
+BLOB_CODEC_NAMES = { "none": BLOB_CODEC_NONE, "zlib": BLOB_CODEC_ZLIB, "bz2": BLOB_CODEC_BZ2 }
+if lzma != None:
+    BLOB_CODEC_NAMES["lzma"] = BLOB_CODEC_LZMA
+
+# number of bytes at the start of a file that are compressed to decide
+# whether the file is compressed
+BLOB_SAMPLE_SIZE = 64 * 1024
+
+# maximal ratio of the compressed and the original size of the sample
+# for a file to be compressed. Files like images, videos or archives are
+# already compressed and stored without compression.
+BLOB_MAX_COMPRESSION_RATIO = 0.9
+
+# length of the authentication codes (HMAC-SHA256)
+BLOB_MAC_SIZE = 32
+
+# size of the content of a segment
+BLOB_SEGMENT_SIZE = 64 * 1024
+
+# size of the content of a segment, if the content is compressed. Larger
+# segments compress better.
+BLOB_COMPRESSED_SEGMENT_SIZE = 1024 * 1024
+
+# size of the blocks in which files of the former format (one CBC stream)
+# are decrypted for random access. It must be a multiple of 16.
+LEGACY_BLOCK_SIZE = 64 * 1024
+
+def derive_segment_keys(key):
+    """
+    derives the keys to encrypt and to authenticate segments from a key
+    Parameters:
+    - key
+      encryption key
+    Returns:
+    - tuple of the encryption key and the authentication key
+    """
+    encryption_key = hmac.new(key, "cryptbox-segment-encryption", hashlib.sha256).digest()
+    authentication_key = hmac.new(key, "cryptbox-segment-authentication", hashlib.sha256).digest()
+    return (encryption_key, authentication_key)
+
+def create_header(size, segment_size=BLOB_SEGMENT_SIZE, codec=BLOB_CODEC_NONE):
+    """
+    creates the header of an encrypted file
+    Parameters:
+    - size
+      size of the content
+    - segment_size
+      size of the content of a segment
+    - codec
+      codec of the content of the segments
+    Returns:
+    - header
+    """
+    return struct.pack(BLOB_HEADER_FORMAT, BLOB_MAGIC, BLOB_VERSION, codec, 0,
+                       segment_size, size, os.urandom(8))
+
+def authenticate_header(keys, header):
+    """
+    Parameters:
+    - keys
+      keys returned by derive_segment_keys()
+    - header
+      header of an encrypted file
+    Returns:
+    - authentication code of the header
+    """
+    return hmac.new(keys[1], header, hashlib.sha256).digest()
+
+def get_segment_cipher(keys, header, index):
+    """
+    creates the cipher of a segment. The counter of each segment starts
+    with the nonce of the file and the index of the segment.
+    Parameters:
+    - keys
+      keys returned by derive_segment_keys()
+    - header
+      header of the encrypted file
+    - index
+      index of the segment
+    Returns:
+    - AES cipher in counter mode
+    """
+    nonce = header[-8:]
+    counter = Counter.new(32, prefix=nonce + struct.pack(">I", index), initial_value=0)
+    return AES.new(keys[0], AES.MODE_CTR, counter=counter)
+
+def authenticate_segment(keys, header, index, encrypted):
+    """
+    computes the authentication code of a segment. It covers the
+    header, so that segments can't be exchanged between files, and the
+    index, so that segments can't be reordered.
+    Parameters:
+    - keys
+      keys returned by derive_segment_keys()
+    - header
+      header of the encrypted file
+    - index
+      index of the segment
+    - encrypted
+      encrypted content of the segment
+    Returns:
+    - authentication code
+    """
+    mac = hmac.new(keys[1], header, hashlib.sha256)
+    mac.update(struct.pack("<Q", index))
+    mac.update(encrypted)
+    return mac.digest()
+
+def encrypt_segment(keys, header, index, data):
+    """
+    encrypts a segment
+    Parameters:
+    - keys
+      keys returned by derive_segment_keys()
+    - header
+      header of the encrypted file
+    - index
+      index of the segment
+    - data
+      content of the segment
+    Returns:
+    - encrypted segment followed by its authentication code
+    """
+    encrypted = get_segment_cipher(keys, header, index).encrypt(data)
+    return encrypted + authenticate_segment(keys, header, index, encrypted)
+
+def decrypt_segment(keys, header, index, segment):
+    """
+    verifies and decrypts a segment
+    Parameters:
+    - keys
+      keys returned by derive_segment_keys()
+    - header
+      header of the encrypted file
+    - index
+      index of the segment
+    - segment
+      encrypted segment followed by its authentication code
+    Returns:
+    - content of the segment
+    """
+    encrypted = segment[:-BLOB_MAC_SIZE]
+    mac = authenticate_segment(keys, header, index, encrypted)
+    if not hmac.compare_digest(mac, segment[-BLOB_MAC_SIZE:]):
+        raise IOError("Segment %i is not authentic." % index)
+    return get_segment_cipher(keys, header, index).decrypt(encrypted)
+
+def get_segment_position(segment_size, index):
+    """
+    Parameters:
+    - segment_size
+      size of the content of a segment
+    - index
+      index of a segment
+    Returns:
+    - position of the segment in the encrypted file
+    """
+    return BLOB_HEADER_SIZE + BLOB_MAC_SIZE + index * (segment_size + BLOB_MAC_SIZE)
+
+def split_segments(size, segment_size, part_size):
+    """
+    splits the segments of a file into parts that are encrypted or
+    decrypted by different processes
+    Parameters:
+    - size
+      size of the content
+    - segment_size
+      size of the content of a segment
+    - part_size
+      size of the content of a part
+    Returns:
+    - list of tuples (index of the first segment, number of segments)
+    """
+    result = []
+    segments = (size + segment_size - 1) // segment_size
+    count = max(part_size // segment_size, 1)
+    for first in range(0, segments, count):
+        result.append((first, min(count, segments - first)))
+    return result
+
+def compress_segment(codec, data):
+    """
+    compresses the content of a segment
+    Parameters:
+    - codec
+      codec to compress the content with
+    - data
+      content of the segment
+    Returns:
+    - compressed content
+    """
+    if codec == BLOB_CODEC_ZLIB:
+        result = zlib.compress(data, 6)
+    elif codec == BLOB_CODEC_BZ2:
+        result = bz2.compress(data, 9)
+    elif codec == BLOB_CODEC_LZMA and lzma != None:
+        result = lzma.compress(data)
+    else:
+        raise IOError("Unsupported codec %i." % codec)
+    return result
+
+def decompress_segment(codec, data, length):
+    """
+    decompresses the content of a segment
+    Parameters:
+    - codec
+      codec the content was compressed with
+    - data
+      compressed content
+    - length
+      expected length of the content
+    Returns:
+    - content of the segment
+    """
+    try:
+        if codec == BLOB_CODEC_ZLIB:
+            result = zlib.decompress(data)
+        elif codec == BLOB_CODEC_BZ2:
+            result = bz2.decompress(data)
+        elif codec == BLOB_CODEC_LZMA and lzma != None:
+            result = lzma.decompress(data)
+        else:
+            raise IOError("Unsupported codec %i." % codec)
+    except (zlib.error, ValueError, EOFError):
+        raise IOError("Unable to decompress the segment.")
+    if len(result) != length:
+        raise IOError("The decompressed segment has an invalid length.")
+    return result
+
+def choose_codec(sample, codec):
+    """
+    decides whether content is compressed. A sample of the start of the
+    content is compressed quickly; content whose sample doesn't shrink
+    enough is stored uncompressed.
+    Parameters:
+    - sample
+      start of the content (see BLOB_SAMPLE_SIZE)
+    - codec
+      configured codec
+    Returns:
+    - codec to use
+    """
+    result = codec
+    if codec != BLOB_CODEC_NONE:
+        if len(zlib.compress(sample, 1)) > len(sample) * BLOB_MAX_COMPRESSION_RATIO:
+            result = BLOB_CODEC_NONE
+    return result
+
+def create_segment_table(keys, header, lengths):
+    """
+    creates the table of the encrypted lengths of the segments of
+    compressed content
+    Parameters:
+    - keys
+      keys returned by derive_segment_keys()
+    - header
+      header of the encrypted file
+    - lengths
+      list of the lengths of the encrypted segments including their
+      authentication codes
+    Returns:
+    - table followed by its authentication code
+    """
+    table = "".join([struct.pack("<I", length) for length in lengths])
+    return table + hmac.new(keys[1], header + table, hashlib.sha256).digest()
+
+def write_segments(srcfile, destfile, key, size, segment_size=BLOB_SEGMENT_SIZE,
+                   codec=BLOB_CODEC_NONE):
+    """
+    encrypts content into the segmented format. Compressed content is
+    compressed segment by segment while it is encrypted.
+    Parameters:
+    - srcfile
+      file object to read the content from
+    - destfile
+      file object to write the encrypted file to
+    - key
+      encryption key
+    - size
+      size of the content
+    - segment_size
+      size of the content of a segment
+    - codec
+      codec to compress the segments with
+    Returns:
+    - digest of the content (SHA-256 as a hex string)
+    """
+    keys = derive_segment_keys(key)
+    header = create_header(size, segment_size, codec)
+    destfile.write(header)
+    destfile.write(authenticate_header(keys, header))
+    digest = hashlib.sha256()
+    lengths = []
+    index = 0
+    remaining = size
+    while remaining > 0:
+        check_cancelled()
+        data = srcfile.read(min(segment_size, remaining))
+        if len(data) == 0:
+            raise IOError("The content was shorter than expected.")
+        digest.update(data)
+        remaining -= len(data)
+        if codec != BLOB_CODEC_NONE:
+            data = compress_segment(codec, data)
+        segment = encrypt_segment(keys, header, index, data)
+        destfile.write(segment)
+        lengths.append(len(segment))
+        index += 1
+    if codec != BLOB_CODEC_NONE:
+        destfile.write(create_segment_table(keys, header, lengths))
+    return digest.hexdigest()
+
+def create_segmented_file(destfilename, key, size, segment_size=BLOB_SEGMENT_SIZE):
+    """
+    creates an encrypted file whose segments are written by
+    encrypt_segments()
+    Parameters:
+    - destfilename
+      name of the encrypted file
+    - key
+      encryption key
+    - size
+      size of the content
+    - segment_size
+      size of the content of a segment
+    Returns:
+    - header of the encrypted file
+    """
+    header = create_header(size, segment_size)
+    destfile = open(destfilename, "wb")
+    try:
+        destfile.write(header)
+        destfile.write(authenticate_header(derive_segment_keys(key), header))
+    finally:
+        destfile.close()
+    return header
+
+def encrypt_segments(srcfilename, destfilename, key, header, first, count):
+    """
+    encrypts a part of a file and writes the segments to their
+    positions in an encrypted file created by create_segmented_file().
+    Several processes may encrypt different parts of a file at the
+    same time.
+    Parameters:
+    - srcfilename
+      name of the file to encrypt
+    - destfilename
+      name of the encrypted file
+    - key
+      encryption key
+    - header
+      header of the encrypted file
+    - first
+      index of the first segment
+    - count
+      number of segments
+    """
+    keys = derive_segment_keys(key)
+    segment_size, size = struct.unpack(BLOB_HEADER_FORMAT, header)[4:6]
+    srcfile = open(srcfilename, "rb")
+    destfile = open(destfilename, "r+b")
+    try:
+        srcfile.seek(first * segment_size)
+        destfile.seek(get_segment_position(segment_size, first))
+        for index in range(first, first + count):
+            check_cancelled()
+            length = min(segment_size, size - index * segment_size)
+            data = srcfile.read(length)
+            if len(data) != length:
+                raise IOError("The content was shorter than expected.")
+            destfile.write(encrypt_segment(keys, header, index, data))
+    finally:
+        srcfile.close()
+        destfile.close()
+
+def decrypt_segments(srcfilename, destfilename, key, first, count):
+    """
+    decrypts a part of an encrypted file of the segmented format and
+    writes the content to its position in the destination file.
+    Several processes may decrypt different parts of a file at the
+    same time.
+    Parameters:
+    - srcfilename
+      name of the encrypted file
+    - destfilename
+      name of the existing destination file
+    - key
+      encryption key
+    - first
+      index of the first segment
+    - count
+      number of segments
+    """
+    srcfile = open_encrypted_file(srcfilename, key)
+    destfile = open(destfilename, "r+b")
+    try:
+        segment_size = srcfile.get_segment_size()
+        srcfile.seek(first * segment_size)
+        destfile.seek(first * segment_size)
+        for index in range(count):
+            check_cancelled()
+            destfile.write(srcfile.read(segment_size))
+    finally:
+        srcfile.close()
+        destfile.close()
+
+class EncryptedFile(object):
+    """
+    file-like object to read an encrypted file with random access. The
+    content is decrypted in blocks; only the blocks containing the bytes
+    that are read are decrypted.
+    """
+
+    def __init__(self, fileobj, size):
+        """
+        creates an instance
+        Parameters:
+        - fileobj
+          file object of the encrypted file
+        - size
+          size of the content
+        """
+        self._file = fileobj
+        self._size = size
+        self._position = 0
+        self._block_index = None
+        self._block = None
+
+    def _locate(self, position):
+        """
+        determines the block containing a position of the content
+        Parameters:
+        - position
+          position in the content
+        Returns:
+        - tuple of the index of the block and the position of the
+          block in the content
+        """
+        raise NotImplementedError()
+
+    def _decrypt_block(self, index):
+        """
+        reads and decrypts a block
+        Parameters:
+        - index
+          index of the block
+        Returns:
+        - content of the block
+        """
+        raise NotImplementedError()
+
+    def get_size(self):
+        """
+        Returns:
+        - size of the content
+        """
+        return self._size
+
+    def read(self, size=-1):
+        """
+        reads content from the current position
+        Parameters:
+        - size
+          maximal number of bytes to read. A negative size reads up
+          to the end of the content.
+        Returns:
+        - content read
+        """
+        remaining = self._size - self._position
+        if size < 0 or size > remaining:
+            size = max(remaining, 0)
+        result = []
+        while size > 0:
+            index, start = self._locate(self._position)
+            if index != self._block_index:
+                self._block = self._decrypt_block(index)
+                self._block_index = index
+            offset = self._position - start
+            data = self._block[offset:offset + size]
+            if len(data) == 0:
+                raise IOError("The encrypted file is incomplete.")
+            result.append(data)
+            self._position += len(data)
+            size -= len(data)
+        return "".join(result)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """
+        sets the current position
+        Parameters:
+        - offset
+          offset of the position
+        - whence
+          os.SEEK_SET, os.SEEK_CUR or os.SEEK_END
+        """
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise IOError("Invalid position %i." % offset)
+        self._position = offset
+
+    def tell(self):
+        """
+        Returns:
+        - current position
+        """
+        return self._position
+
+    def close(self):
+        """
+        closes the encrypted file
+        """
+        self._file.close()
+        self._block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class SegmentedFile(EncryptedFile):
+    """
+    reads an encrypted file of the segmented format
+    """
+
+    def __init__(self, fileobj, key):
+        """
+        creates an instance and verifies the header
+        Parameters:
+        - fileobj
+          file object of the encrypted file
+        - key
+          encryption key
+        """
+        header = fileobj.read(BLOB_HEADER_SIZE)
+        mac = fileobj.read(BLOB_MAC_SIZE)
+        if len(mac) != BLOB_MAC_SIZE:
+            raise IOError("The encrypted file is incomplete.")
+        fields = struct.unpack(BLOB_HEADER_FORMAT, header)
+        magic, version, codec, reserved, segment_size, size, nonce = fields
+        if version != BLOB_VERSION:
+            raise IOError("Unsupported version %i of the encrypted file." % version)
+        self._keys = derive_segment_keys(key)
+        if not hmac.compare_digest(authenticate_header(self._keys, header), mac):
+            raise IOError("The header of the encrypted file is not authentic.")
+        EncryptedFile.__init__(self, fileobj, size)
+        self._header = header
+        self._codec = codec
+        self._segment_size = segment_size
+        self._positions = None
+        if codec != BLOB_CODEC_NONE:
+            self._read_segment_table()
+
+    def _read_segment_table(self):
+        """
+        reads the table of the lengths of compressed segments and
+        determines the positions of the segments
+        """
+        segments = (self._size + self._segment_size - 1) // self._segment_size
+        length = segments * struct.calcsize("<I") + BLOB_MAC_SIZE
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() < BLOB_HEADER_SIZE + BLOB_MAC_SIZE + length:
+            raise IOError("The encrypted file is incomplete.")
+        self._file.seek(-length, os.SEEK_END)
+        data = self._file.read(length)
+        table = data[:-BLOB_MAC_SIZE]
+        mac = hmac.new(self._keys[1], self._header + table, hashlib.sha256).digest()
+        if not hmac.compare_digest(mac, data[-BLOB_MAC_SIZE:]):
+            raise IOError("The segment table of the encrypted file is not authentic.")
+        self._positions = [BLOB_HEADER_SIZE + BLOB_MAC_SIZE]
+        for index in range(segments):
+            self._positions.append(self._positions[-1] + struct.unpack_from("<I", table, index * 4)[0])
+
+    def get_codec(self):
+        """
+        Returns:
+        - codec of the content of the segments
+        """
+        return self._codec
+
+    def get_segment_size(self):
+        """
+        Returns:
+        - size of the content of a segment
+        """
+        return self._segment_size
+
+    def _locate(self, position):
+        index = position // self._segment_size
+        return (index, index * self._segment_size)
+
+    def _decrypt_block(self, index):
+        content_length = min(self._segment_size, self._size - index * self._segment_size)
+        if self._positions == None:
+            position = get_segment_position(self._segment_size, index)
+            length = content_length + BLOB_MAC_SIZE
+        else:
+            if index + 1 >= len(self._positions):
+                raise IOError("The encrypted file is incomplete.")
+            position = self._positions[index]
+            length = self._positions[index + 1] - position
+        self._file.seek(position)
+        segment = self._file.read(length)
+        if len(segment) != length:
+            raise IOError("The encrypted file is incomplete.")
+        data = decrypt_segment(self._keys, self._header, index, segment)
+        if self._codec != BLOB_CODEC_NONE:
+            data = decompress_segment(self._codec, data, content_length)
+        return data
+
+class LegacyFile(EncryptedFile):
+    """
+    reads an encrypted file of the former format: the size of the
+    content, the initialization vector and the content encrypted as
+    one CBC stream. Since a CBC block is decrypted with the preceding
+    encrypted block, decryption may start at any block.
+    """
+
+    def __init__(self, fileobj, key):
+        """
+        creates an instance
+        Parameters:
+        - fileobj
+          file object of the encrypted file
+        - key
+          encryption key
+        """
+        header = fileobj.read(struct.calcsize('<Q'))
+        iv = fileobj.read(16)
+        if len(iv) != 16:
+            raise IOError("The encrypted file is incomplete.")
+        EncryptedFile.__init__(self, fileobj, struct.unpack('<Q', header)[0])
+        self._key = key
+        self._iv = iv
+        self._offset = len(header) + len(iv)
+
+    def _locate(self, position):
+        index = position // LEGACY_BLOCK_SIZE
+        return (index, index * LEGACY_BLOCK_SIZE)
+
+    def _decrypt_block(self, index):
+        offset = self._offset + index * LEGACY_BLOCK_SIZE
+        if index == 0:
+            iv = self._iv
+            self._file.seek(offset)
+        else:
+            self._file.seek(offset - 16)
+            iv = self._file.read(16)
+        data = self._file.read(LEGACY_BLOCK_SIZE)
+        if len(data) % 16 != 0:
+            raise IOError("The encrypted file is incomplete.")
+        return AES.new(self._key, AES.MODE_CBC, iv).decrypt(data)
+
+def open_encrypted_file(filename, key):
+    """
+    opens an encrypted file of either format for reading
+    Parameters:
+    - filename
+      name of the encrypted file
+    - key
+      encryption key
+    Returns:
+    - EncryptedFile instance
+    """
+    fileobj = open(filename, "rb")
+    try:
+        magic = fileobj.read(len(BLOB_MAGIC))
+        fileobj.seek(0)
+        if magic == BLOB_MAGIC:
+            result = SegmentedFile(fileobj, key)
+        else:
+            result = LegacyFile(fileobj, key)
+    except:
+        fileobj.close()
+        raise
+    return result
@@ -0,0 +1,58 @@
+# cryptbox - cooperative cancellation of a synchronization
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import multiprocessing
+
+# event that is set to cancel the synchronization. It is created before
+# any worker process, so that the worker processes share it.
+cancel_event = multiprocessing.Event()
+
+class CancelledError(Exception):
+    """
+    exception raised when a cancelled operation stops
+    """
+    pass
+
+def request_cancel():
+    """
+    requests all running operations to stop as soon as possible
+    """
+    cancel_event.set()
+
+def is_cancelled():
+    """
+    Returns:
+    - True:  the operations were requested to stop
+    - False: the operations continue
+    """
+    return cancel_event.is_set()
+
+def check_cancelled():
+    """
+    raises a CancelledError, if the operations were requested to stop
+    """
+    if cancel_event.is_set():
+        raise CancelledError("Operation cancelled.")
+
+def wait_cancelled(timeout):
+    """
+    waits until the operations are requested to stop
+    Parameters:
+    - timeout
+      maximal number of seconds to wait
+    Returns:
+    - True:  the operations were requested to stop
+    - False: the timeout expired
+    """
+    return cancel_event.wait(timeout)
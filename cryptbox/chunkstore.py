@@ -0,0 +1,405 @@
+# -*- coding: iso-8859-15 -*-
+
+# cryptbox - content-defined chunks of files
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import bisect
+import hashlib
+import hmac
+import os
+import os.path
+import struct
+import time
+
+from StringIO import StringIO
+
+from crypthelper import *
+
+try:
+    import numpy
+except ImportError:
+    # without numpy the chunk boundaries are searched byte by byte,
+    # which is considerably slower
+    numpy = None
+
+# name of the directory containing the chunks in the destination
+# directory
+CHUNKSTORE_DIRECTORY_NAME = "cryptbox.chunks"
+
+# sizes of the chunks
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+# a chunk ends when the masked bits of the rolling hash are zero. The
+# mask uses 20 bits (average chunk size of 1 MB) in the upper part of
+# the hash, since these bits depend on more input bytes.
+CHUNK_MASK = ((1 << 20) - 1) << 12
+
+# number of bytes to read at once
+CHUNK_READ_SIZE = 8 * 1024 * 1024
+
+# number of bytes whose rolling hashes are computed at once if numpy
+# is available
+CHUNK_SCAN_SIZE = 256 * 1024
+
+# minimal age in seconds of unused chunks to be removed. Younger chunks
+# may belong to an upload of another computer whose index changes are
+# not synchronized yet.
+CHUNK_MIN_UNUSED_AGE = 24 * 60 * 60
+
+def create_gear_table():
+    """
+    creates the table of random values for the rolling hash. The
+    table is derived from fixed values, so that all computers split
+    files at the same positions.
+    Returns:
+    - list of 256 32 bit values
+    """
+    result = []
+    for index in range(256):
+        digest = hashlib.md5("cryptbox-gear-%i" % index).digest()
+        result.append(struct.unpack("<I", digest[:4])[0])
+    return result
+
+GEAR_TABLE = create_gear_table()
+
+if numpy != None:
+    GEAR_ARRAY = numpy.array(GEAR_TABLE, dtype=numpy.uint32)
+
+def find_chunk_boundary(buf, start=0):
+    """
+    finds the end of the chunk starting at a position of a buffer by
+    using a rolling gear hash. The bytes are read from the buffer in
+    place, so that neither the buffer nor a part of it is copied. If
+    numpy is available, the hashes are computed for many bytes at once.
+    Parameters:
+    - buf
+      bytearray to split
+    - start
+      position of the first byte of the chunk
+    Returns:
+    - position after the last byte of the chunk
+    """
+    end = min(len(buf), start + CHUNK_MAX_SIZE)
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    if numpy != None:
+        return scan_chunk_boundary(buf, start + CHUNK_MIN_SIZE, end)
+    gear = GEAR_TABLE
+    mask = CHUNK_MASK
+    value = 0
+    for pos in xrange(start + CHUNK_MIN_SIZE, end):
+        value = ((value << 1) + gear[buf[pos]]) & 0xFFFFFFFF
+        if not value & mask:
+            return pos + 1
+    return end
+
+def scan_chunk_boundary(buf, begin, end):
+    """
+    finds a chunk boundary like find_chunk_boundary() with numpy. The
+    hash after a byte is the sum of the gear values of the last 32
+    bytes, each shifted by its distance to the byte; older bytes are
+    shifted out of the 32 bits. The sums are computed for a whole
+    block by doubling the number of summed bytes five times.
+    Parameters:
+    - buf
+      bytearray to split
+    - begin
+      position of the first byte that is hashed
+    - end
+      position after the last byte that may end the chunk
+    Returns:
+    - position after the last byte of the chunk
+    """
+    mask = numpy.uint32(CHUNK_MASK)
+    position = begin
+    while position < end:
+        stop = min(position + CHUNK_SCAN_SIZE, end)
+        # the hashes of the block depend on the 31 bytes before it
+        prefix = min(position - begin, 31)
+        data = numpy.frombuffer(buf, dtype=numpy.uint8, count=stop - position + prefix,
+                                offset=position - prefix)
+        values = GEAR_ARRAY[data]
+        for shift in (1, 2, 4, 8, 16):
+            values[shift:] += values[:-shift] << numpy.uint32(shift)
+        hits = numpy.flatnonzero((values[prefix:] & mask) == 0)
+        if len(hits) > 0:
+            return position + int(hits[0]) + 1
+        position = stop
+    return end
+
+def iterate_chunks(srcfile):
+    """
+    splits a file into content-defined chunks. The file is read into a
+    single buffer; the chunks are located by an offset into the buffer
+    and the returned chunks are removed only before the buffer is
+    filled again.
+    Parameters:
+    - srcfile
+      opened file to split
+    Returns:
+    - generator of chunks
+    """
+    buf = bytearray()
+    offset = 0
+    eof = False
+    while not eof:
+        data = srcfile.read(CHUNK_READ_SIZE)
+        eof = len(data) == 0
+        del buf[:offset]
+        offset = 0
+        buf.extend(data)
+        while len(buf) - offset >= CHUNK_MAX_SIZE or (eof and len(buf) > offset):
+            pos = find_chunk_boundary(buf, offset)
+            yield str(buf[offset:pos])
+            offset = pos
+
+def get_chunk_id(data, key):
+    """
+    computes the id of a chunk. The id is a keyed hash of the
+    content, so that equal chunks are stored only once, without
+    revealing the content.
+    Parameters:
+    - data
+      content of the chunk
+    - key
+      encryption key
+    Returns:
+    - id of the chunk
+    """
+    id_key = hashlib.sha256("cryptbox-chunk-id:" + key).digest()
+    return hmac.new(id_key, data, hashlib.sha256).hexdigest()
+
+def get_chunk_path(chunkdir, chunk_id):
+    """
+    Parameters:
+    - chunkdir
+      directory containing the chunks
+    - chunk_id
+      id of a chunk
+    Returns:
+    - path of the encrypted chunk
+    """
+    return os.path.join(chunkdir, chunk_id[:2], chunk_id)
+
+def write_chunk(chunkdir, chunk_id, data, key):
+    """
+    encrypts and writes a chunk in the segmented format if it doesn't
+    exist yet. An existing chunk is touched instead, so that remove_unused_chunks() doesn't
+    remove it before the index using it is synchronized.
+    Parameters:
+    - chunkdir
+      directory containing the chunks
+    - chunk_id
+      id of the chunk
+    - data
+      content of the chunk
+    - key
+      encryption key
+    """
+    chunkpath = get_chunk_path(chunkdir, chunk_id)
+    if os.path.exists(chunkpath):
+        try:
+            os.utime(chunkpath, None)
+            return
+        except OSError:
+            # the chunk was removed meanwhile
+            pass
+    dirpath = os.path.dirname(chunkpath)
+    if not os.path.isdir(dirpath):
+        try:
+            os.makedirs(dirpath)
+        except OSError:
+            # the directory may be created by another process
+            if not os.path.isdir(dirpath):
+                raise
+    temppath = "%s.%i.tmp" % (chunkpath, os.getpid())
+    chunkfile = open(temppath, "wb")
+    try:
+        write_segments(StringIO(data), chunkfile, key, len(data))
+    finally:
+        chunkfile.close()
+    os.rename(temppath, chunkpath)
+
+def read_chunk(chunkdir, chunk_id, key):
+    """
+    reads and decrypts a chunk of either format and verifies that
+    the content matches the id of the chunk
+    Parameters:
+    - chunkdir
+      directory containing the chunks
+    - chunk_id
+      id of the chunk
+    - key
+      encryption key
+    Returns:
+    - content of the chunk
+    """
+    chunkpath = get_chunk_path(chunkdir, chunk_id)
+    chunkfile = open_encrypted_file(chunkpath, key)
+    try:
+        data = chunkfile.read()
+    finally:
+        chunkfile.close()
+    if get_chunk_id(data, key) != chunk_id:
+        raise IOError("The content of chunk %s doesn't match its id." % chunkpath)
+    return data
+
+def transcode_chunk(chunkdir, chunk_id, old_key, new_key):
+    """
+    encrypts a chunk with another key. Since the id of a chunk depends
+    on the key, the chunk is stored under a new id; the chunk with the
+    old id is kept. The new chunk gets the times of the old chunk.
+    Parameters:
+    - chunkdir
+      directory containing the chunks
+    - chunk_id
+      id of the chunk
+    - old_key
+      key the chunk is encrypted with
+    - new_key
+      key to encrypt the chunk with
+    Returns:
+    - new id of the chunk
+    """
+    check_cancelled()
+    data = read_chunk(chunkdir, chunk_id, old_key)
+    result = get_chunk_id(data, new_key)
+    write_chunk(chunkdir, result, data, new_key)
+    adjust_time(get_chunk_path(chunkdir, chunk_id), get_chunk_path(chunkdir, result))
+    return result
+
+def store_file_chunks(srcfilename, chunkdir, key):
+    """
+    splits a file into chunks and stores the chunks that don't
+    exist yet
+    Parameters:
+    - srcfilename
+      name of the file to store
+    - chunkdir
+      directory containing the chunks
+    - key
+      encryption key
+    Returns:
+    - tuple of the list of the ids of the chunks of the file and the
+      digest of the content of the file
+    """
+    chunk_ids = []
+    digest = hashlib.sha256()
+    srcfile = open(srcfilename, "rb")
+    try:
+        for data in iterate_chunks(srcfile):
+            check_cancelled()
+            digest.update(data)
+            chunk_id = get_chunk_id(data, key)
+            write_chunk(chunkdir, chunk_id, data, key)
+            chunk_ids.append(chunk_id)
+    finally:
+        srcfile.close()
+    return (chunk_ids, digest.hexdigest())
+
+def restore_file_chunks(chunkdir, chunk_ids, destfilename, key, timestamp):
+    """
+    restores a file from its chunks
+    Parameters:
+    - chunkdir
+      directory containing the chunks
+    - chunk_ids
+      list of the ids of the chunks of the file
+    - destfilename
+      name of the file to restore
+    - key
+      encryption key
+    - timestamp
+      modification time to set
+    """
+    destfile = open(destfilename, "wb")
+    try:
+        for chunk_id in chunk_ids:
+            check_cancelled()
+            destfile.write(read_chunk(chunkdir, chunk_id, key))
+    finally:
+        destfile.close()
+    os.utime(destfilename, (timestamp, timestamp))
+
+class ChunkedFile(EncryptedFile):
+    """
+    reads a file stored as chunks with random access. The sizes of the
+    chunks are read from their headers; only the chunks containing the
+    bytes that are read are decrypted.
+    """
+
+    def __init__(self, chunkdir, chunk_ids, key):
+        """
+        creates an instance
+        Parameters:
+        - chunkdir
+          directory containing the chunks
+        - chunk_ids
+          list of the ids of the chunks of the file
+        - key
+          encryption key
+        """
+        offsets = []
+        size = 0
+        for chunk_id in chunk_ids:
+            offsets.append(size)
+            chunkfile = open_encrypted_file(get_chunk_path(chunkdir, chunk_id), key)
+            size += chunkfile.get_size()
+            chunkfile.close()
+        EncryptedFile.__init__(self, None, size)
+        self._chunkdir = chunkdir
+        self._chunk_ids = chunk_ids
+        self._key = key
+        self._offsets = offsets
+
+    def _locate(self, position):
+        index = bisect.bisect_right(self._offsets, position) - 1
+        return (index, self._offsets[index])
+
+    def _decrypt_block(self, index):
+        return read_chunk(self._chunkdir, self._chunk_ids[index], self._key)
+
+    def close(self):
+        self._block = None
+
+def remove_unused_chunks(chunkdir, used_ids):
+    """
+    removes chunks that are not used by any file
+    Parameters:
+    - chunkdir
+      directory containing the chunks
+    - used_ids
+      set of ids of the chunks that are used
+    Returns:
+    - number of chunks removed
+    """
+    result = 0
+    if not os.path.isdir(chunkdir):
+        return result
+    min_timestamp = time.time() - CHUNK_MIN_UNUSED_AGE
+    for dirname in os.listdir(chunkdir):
+        dirpath = os.path.join(chunkdir, dirname)
+        if not os.path.isdir(dirpath):
+            continue
+        for chunk_id in os.listdir(dirpath):
+            if chunk_id in used_ids:
+                continue
+            chunkpath = os.path.join(dirpath, chunk_id)
+            try:
+                if get_change_time(chunkpath) < min_timestamp:
+                    os.remove(chunkpath)
+                    result += 1
+            except OSError:
+                pass
+    return result
@@ -14,6 +14,32 @@
 
 import os.path
 
+# default number of index changes to collect before the index is written
+DEFAULT_INDEX_FLUSH_COUNT = 500
+# default maximal number of seconds between writing index changes
+DEFAULT_INDEX_FLUSH_INTERVAL = 30
+# default number of worker processes (0: one worker per CPU)
+DEFAULT_WORKERS = 0
+# default number of threads to scan the source directory
+DEFAULT_SCAN_THREADS = 1
+# default size in MB from which a single file is encrypted and decrypted
+# by several worker processes (0: never)
+DEFAULT_PARALLEL_FILE_SIZE = 64
+
+# storage formats of the files in the destination directory
+STORAGE_BLOB = "blob"
+STORAGE_CHUNKED = "chunked"
+
+# codecs to compress uploaded files
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_BZ2 = "bz2"
+COMPRESSION_LZMA = "lzma"
+
+# databases to store the state information of the local files
+STATE_BACKEND_COUCHDB = "couchdb"
+STATE_BACKEND_SQLITE = "sqlite"
+
 class CryptBoxConfig(object):
     """
     class to manage the cryptbox configuration
@@ -27,6 +53,14 @@ class CryptBoxConfig(object):
         self._destination_directory = None
         self._password_salt = None
         self._password_repeat_hash = 0
+        self._index_flush_count = DEFAULT_INDEX_FLUSH_COUNT
+        self._index_flush_interval = DEFAULT_INDEX_FLUSH_INTERVAL
+        self._workers = DEFAULT_WORKERS
+        self._scan_threads = DEFAULT_SCAN_THREADS
+        self._parallel_file_size = DEFAULT_PARALLEL_FILE_SIZE
+        self._storage = STORAGE_BLOB
+        self._compression = COMPRESSION_NONE
+        self._state_backend = STATE_BACKEND_COUCHDB
         if self.exists():
             self.load()
 
@@ -82,6 +116,82 @@ class CryptBoxConfig(object):
         """
         self._password_repeat_hash = repeat_hash
 
+    def set_index_flush_count(self, count):
+        """
+        sets the number of index changes to collect before they are
+        written
+        Parameters:
+        - count
+          number of index changes
+        """
+        self._index_flush_count = count
+
+    def set_index_flush_interval(self, interval):
+        """
+        sets the maximal interval between writing index changes
+        Parameters:
+        - interval
+          interval in seconds
+        """
+        self._index_flush_interval = interval
+
+    def set_workers(self, workers):
+        """
+        sets the number of worker processes for encryption and
+        decryption
+        Parameters:
+        - workers
+          number of worker processes (0: one worker per CPU)
+        """
+        self._workers = workers
+
+    def set_scan_threads(self, threads):
+        """
+        sets the number of threads to scan the source directory
+        Parameters:
+        - threads
+          number of threads (1: scan serially)
+        """
+        self._scan_threads = threads
+
+    def set_parallel_file_size(self, size):
+        """
+        sets the size from which a single file is encrypted and
+        decrypted by several worker processes
+        Parameters:
+        - size
+          size in MB (0: never)
+        """
+        self._parallel_file_size = size
+
+    def set_storage(self, storage):
+        """
+        sets the storage format of uploaded files
+        Parameters:
+        - storage
+          STORAGE_BLOB or STORAGE_CHUNKED
+        """
+        self._storage = storage
+
+    def set_compression(self, compression):
+        """
+        sets the codec to compress uploaded files
+        Parameters:
+        - compression
+          COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_BZ2 or
+          COMPRESSION_LZMA
+        """
+        self._compression = compression
+
+    def set_state_backend(self, state_backend):
+        """
+        sets the database to store the state information of local files
+        Parameters:
+        - state_backend
+          STATE_BACKEND_COUCHDB or STATE_BACKEND_SQLITE
+        """
+        self._state_backend = state_backend
+
     def get_source_directory(self):
         """
         Returns:
@@ -109,6 +219,66 @@ class CryptBoxConfig(object):
         - value for repeating password hashing
         """
         return self._password_repeat_hash
+
+    def get_index_flush_count(self):
+        """
+        Returns:
+        - number of index changes to collect before they are written
+        """
+        return self._index_flush_count
+
+    def get_index_flush_interval(self):
+        """
+        Returns:
+        - maximal interval in seconds between writing index changes
+        """
+        return self._index_flush_interval
+
+    def get_workers(self):
+        """
+        Returns:
+        - number of worker processes (0: one worker per CPU)
+        """
+        return self._workers
+
+    def get_scan_threads(self):
+        """
+        Returns:
+        - number of threads to scan the source directory
+        """
+        return self._scan_threads
+
+    def get_parallel_file_size(self):
+        """
+        Returns:
+        - size in MB from which a single file is encrypted and
+          decrypted by several worker processes (0: never)
+        """
+        return self._parallel_file_size
+
+    def get_storage(self):
+        """
+        Returns:
+        - storage format of uploaded files (STORAGE_BLOB or
+          STORAGE_CHUNKED)
+        """
+        return self._storage
+
+    def get_compression(self):
+        """
+        Returns:
+        - codec to compress uploaded files (COMPRESSION_NONE,
+          COMPRESSION_ZLIB, COMPRESSION_BZ2 or COMPRESSION_LZMA)
+        """
+        return self._compression
+
+    def get_state_backend(self):
+        """
+        Returns:
+        - database to store the state information of local files
+          (STATE_BACKEND_COUCHDB or STATE_BACKEND_SQLITE)
+        """
+        return self._state_backend
  
     def load(self):
         """
@@ -138,6 +308,47 @@ class CryptBoxConfig(object):
                         except ValueError:
                             self._password_repeat_hash = 0
                             print "Invalid Repeat Hash value %s." % value
+                    elif key == "index_flush_count":
+                        try:
+                            self._index_flush_count = int(value)
+                        except ValueError:
+                            print "Invalid index flush count %s." % value
+                    elif key == "index_flush_interval":
+                        try:
+                            self._index_flush_interval = int(value)
+                        except ValueError:
+                            print "Invalid index flush interval %s." % value
+                    elif key == "workers":
+                        try:
+                            self._workers = int(value)
+                        except ValueError:
+                            print "Invalid number of workers %s." % value
+                    elif key == "scan_threads":
+                        try:
+                            self._scan_threads = int(value)
+                        except ValueError:
+                            print "Invalid number of scan threads %s." % value
+                    elif key == "parallel_file_size":
+                        try:
+                            self._parallel_file_size = int(value)
+                        except ValueError:
+                            print "Invalid parallel file size %s." % value
+                    elif key == "storage":
+                        if value in [STORAGE_BLOB, STORAGE_CHUNKED]:
+                            self._storage = value
+                        else:
+                            print "Invalid storage format %s." % value
+                    elif key == "compression":
+                        if value in [COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_BZ2,
+                                     COMPRESSION_LZMA]:
+                            self._compression = value
+                        else:
+                            print "Invalid compression %s." % value
+                    elif key == "state_backend":
+                        if value in [STATE_BACKEND_COUCHDB, STATE_BACKEND_SQLITE]:
+                            self._state_backend = value
+                        else:
+                            print "Invalid state backend %s." % value
                     else:
                         print "Invalid configuration key %s was ignored." % key
             config_file.close()
@@ -164,6 +375,14 @@ class CryptBoxConfig(object):
             if self._password_salt:
                 config_file.write("password_salt = %s\n" % self._password_salt)
             config_file.write("password_repeat_hash = %s\n" % str(self._password_repeat_hash))
+            config_file.write("index_flush_count = %s\n" % str(self._index_flush_count))
+            config_file.write("index_flush_interval = %s\n" % str(self._index_flush_interval))
+            config_file.write("workers = %s\n" % str(self._workers))
+            config_file.write("scan_threads = %s\n" % str(self._scan_threads))
+            config_file.write("parallel_file_size = %s\n" % str(self._parallel_file_size))
+            config_file.write("storage = %s\n" % self._storage)
+            config_file.write("compression = %s\n" % self._compression)
+            config_file.write("state_backend = %s\n" % self._state_backend)
             config_file.close()
         except IOError:
             result = False
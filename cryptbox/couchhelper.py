@@ -15,6 +15,19 @@
 import hashlib
 import httplib
 import json
+import socket
+import threading
+import urllib
+
+# maximal number of idle connections kept open per server
+HTTP_MAX_IDLE_CONNECTIONS = 4
+
+# number of documents to retrieve with one request
+COUCH_PAGE_SIZE = 1000
+
+# shared HttpHelper instances by host and port
+http_helpers = {}
+http_helpers_lock = threading.Lock()
 
 class CouchURI(object):
     """
@@ -54,7 +67,7 @@ class CouchURI(object):
         index = 0
         for element in self._elements:
             prev = self.get_element(index)
-            if not prev.startswith("?"):
+            if not prev.startswith("?") and not prev.startswith("&"):
                 stringlist.append("/")
             stringlist.append(element)
             index = index + 1
@@ -73,7 +86,11 @@ class CouchURI(object):
         """
         newelement = element
         if value:
-            newelement = "".join(["?", element, "=", value])
+            separator = "?"
+            for existing in self._elements:
+                if existing.startswith("?"):
+                    separator = "&"
+            newelement = "".join([separator, element, "=", urllib.quote(value)])
         self._elements.append(newelement)
 
 class JSONResponse(object):
@@ -131,7 +148,8 @@ class JSONResponse(object):
 
 class HttpHelper(object):
     """
-    Helper class to support http communication
+    Helper class to support http communication. Connections are kept
+    alive and reused for subsequent requests.
     """
 
     def __init__(self, host, port=5984):
@@ -144,13 +162,133 @@ class HttpHelper(object):
         """
         self._host = host
         self._port = port
+        self._lock = threading.Lock()
+        self._idle_connections = []
+        self._statistics = {"requests": 0, "connections": 0, "reconnects": 0}
+
+    def _count(self, key):
+        """
+        increments a request counter
+        Parameters:
+        - key
+          name of the counter
+        """
+        self._lock.acquire()
+        try:
+            self._statistics[key] = self._statistics.get(key, 0) + 1
+        finally:
+            self._lock.release()
 
     def _connect(self):
         """
         connects to the server
         """
+        self._count("connections")
         return httplib.HTTPConnection(self._host, self._port)
 
+    def _acquire_connection(self):
+        """
+        gets an idle connection or connects to the server
+        Returns:
+        - tuple of the connection and a flag, if the connection was
+          used before
+        """
+        connection = None
+        self._lock.acquire()
+        try:
+            if len(self._idle_connections) > 0:
+                connection = self._idle_connections.pop()
+        finally:
+            self._lock.release()
+        if connection:
+            return (connection, True)
+        return (self._connect(), False)
+
+    def _release_connection(self, connection):
+        """
+        returns a connection to the idle connections
+        Parameters:
+        - connection
+          connection to release
+        """
+        self._lock.acquire()
+        try:
+            if len(self._idle_connections) < HTTP_MAX_IDLE_CONNECTIONS:
+                self._idle_connections.append(connection)
+                connection = None
+        finally:
+            self._lock.release()
+        if connection:
+            connection.close()
+
+    def _request(self, method, uri, body=None, headers={}):
+        """
+        invokes a request. If a reused connection was closed by the
+        server, the request is repeated with a new connection.
+        Parameters:
+        - method
+          http method
+        - uri
+          URI to use
+        - body
+          body to transfer
+        - headers
+          dictionary of http headers
+        Returns:
+        - response of the request
+        """
+        self._count("requests")
+        self._count(method)
+        while True:
+            connection, reused = self._acquire_connection()
+            released = False
+            try:
+                try:
+                    connection.request(method, uri.get_uri_string(), body, headers)
+                    http_response = connection.getresponse()
+                    response = JSONResponse(http_response)
+                except (httplib.HTTPException, socket.error):
+                    if not reused:
+                        raise
+                    self._count("reconnects")
+                    continue
+                if not http_response.will_close:
+                    self._release_connection(connection)
+                    released = True
+                return response
+            finally:
+                # a connection is closed on any error (e.g. a response
+                # which isn't valid JSON), so that it doesn't leak
+                if not released:
+                    connection.close()
+
+    def close(self):
+        """
+        closes all idle connections
+        """
+        self._lock.acquire()
+        try:
+            connections = self._idle_connections
+            self._idle_connections = []
+        finally:
+            self._lock.release()
+        for connection in connections:
+            connection.close()
+
+    def get_statistics(self):
+        """
+        Returns:
+        - dictionary of request counters: number of requests, number
+          of requests for each http method, number of connections
+          opened and number of reconnects
+        """
+        self._lock.acquire()
+        try:
+            result = dict(self._statistics)
+        finally:
+            self._lock.release()
+        return result
+
     def get_host(self):
         """
         Returns:
@@ -174,10 +312,8 @@ class HttpHelper(object):
         Returns:
         - response of the request
         """
-        c = self._connect()
         headers = {"Accept": "application/json"}
-        c.request("GET", uri.get_uri_string(), None, headers)
-        return JSONResponse(c.getresponse())
+        return self._request("GET", uri, None, headers)
 
     def post(self, uri, body):
         """
@@ -190,10 +326,8 @@ class HttpHelper(object):
         Returns:
         - response of the request
         """
-        c = self._connect()
         headers = {"Content-type": "application/json"}
-        c.request('POST', uri.get_uri_string(), body, headers)
-        return JSONResponse(c.getresponse())
+        return self._request("POST", uri, body, headers)
 
     def put(self, uri, body):
         """
@@ -206,13 +340,10 @@ class HttpHelper(object):
         Returns:
         - response of the request
         """
-        c = self._connect()
+        headers = {}
         if len(body) > 0:
             headers = {"Content-type": "application/json"}
-            c.request("PUT", uri.get_uri_string(), body, headers)
-        else:
-            c.request("PUT", uri.get_uri_string(), body)
-        return JSONResponse(c.getresponse())
+        return self._request("PUT", uri, body, headers)
 
     def delete(self, uri):
         """
@@ -223,9 +354,46 @@ class HttpHelper(object):
         Returns:
         - response of the request
         """
-        c = self._connect()
-        c.request("DELETE", uri.get_uri_string())
-        return JSONResponse(c.getresponse())
+        return self._request("DELETE", uri)
+
+def get_http_helper(host, port):
+    """
+    returns the shared HttpHelper instance for a server, so that its
+    connections are reused by all databases on the server
+    Parameters:
+    - host
+      host to connect
+    - port
+      port to connect
+    Returns:
+    - HttpHelper instance
+    """
+    http_helpers_lock.acquire()
+    try:
+        key = (host, str(port))
+        if not key in http_helpers:
+            http_helpers[key] = HttpHelper(host, port)
+        result = http_helpers[key]
+    finally:
+        http_helpers_lock.release()
+    return result
+
+def get_http_statistics():
+    """
+    Returns:
+    - dictionary of the request counters of all shared HttpHelper
+      instances
+    """
+    result = {}
+    http_helpers_lock.acquire()
+    try:
+        helpers = http_helpers.values()
+    finally:
+        http_helpers_lock.release()
+    for helper in helpers:
+        for key, value in helper.get_statistics().items():
+            result[key] = result.get(key, 0) + value
+    return result
 
 class CouchKey(object):
     """
@@ -342,9 +510,18 @@ class CouchDocument(object):
         - response
           JSON response to load the documend
         """
-        self._doc_id = response.get_elements()["_id"]
-        self._rev_id = response.get_elements()["_rev"]
-        self._values = response.get_elements()["value"]
+        self.load_values(response.get_elements())
+
+    def load_values(self, doc_dict):
+        """
+        loads a document from a dictionary of the JSON document
+        Parameters:
+        - doc_dict
+          dictionary of the JSON document
+        """
+        self._doc_id = doc_dict["_id"]
+        self._rev_id = doc_dict["_rev"]
+        self._values = doc_dict["value"]
 
 class CouchViewsDocument(object):
     """
@@ -446,7 +623,7 @@ class CouchDatabase(object):
           port to use
         """
         self._name = name
-        self._http_helper = HttpHelper(host, port)
+        self._http_helper = get_http_helper(host, port)
         if self._name:
             if not self._name in self.get_databases():
                 flag = self.create_database()
@@ -512,6 +689,14 @@ class CouchDatabase(object):
         """
         return self._name
 
+    def get_statistics(self):
+        """
+        Returns:
+        - dictionary of the request counters of the connection to the
+          server (see HttpHelper.get_statistics())
+        """
+        return self._http_helper.get_statistics()
+
     def get_databases(self):
         """
         Returns:
@@ -573,6 +758,46 @@ class CouchDatabase(object):
                 doc.set_rev_id(rev_id)
         return result
 
+    def save_documents(self, doc_list):
+        """
+        saves several documents with one request using _bulk_docs
+        Parameters:
+        - doc_list
+          list of CouchDocuments to save
+        Returns:
+        - list of the CouchDocuments that were not saved because of a
+          conflict, or None if the request failed
+        """
+        result = None
+        if self._name:
+            docs = []
+            for doc in doc_list:
+                doc_dict = {}
+                doc_dict["_id"] = doc.get_doc_id()
+                if doc.get_rev_id():
+                    doc_dict["_rev"] = doc.get_rev_id()
+                doc_dict["value"] = doc.get_values()
+                docs.append(doc_dict)
+            uri = CouchURI()
+            uri.append(self._name)
+            uri.append("_bulk_docs")
+            response = self._http_helper.post(uri, json.dumps({"docs": docs}))
+            elements = response.get_elements()
+            if type(elements) == list:
+                result = []
+                doc_dict = {}
+                for doc in doc_list:
+                    doc_dict[doc.get_doc_id()] = doc
+                for element in elements:
+                    doc = doc_dict.get(element.get("id"))
+                    if doc == None:
+                        continue
+                    if element.has_key("rev") and not element.has_key("error"):
+                        doc.set_rev_id(element["rev"])
+                    elif element.get("error") == "conflict":
+                        result.append(doc)
+        return result
+
     def load_document(self, doc_id):
         """
         loads a document from the database
@@ -632,6 +857,41 @@ class CouchDatabase(object):
                     result.append(doc_id)
         return result
 
+    def iterate_documents(self, page_size=COUCH_PAGE_SIZE):
+        """
+        retrieves all documents in the database. The documents are
+        retrieved page by page, so that only one page is kept in
+        memory.
+        Parameters:
+        - page_size
+          number of documents to retrieve with one request
+        Returns:
+        - generator of CouchDocument instances
+        """
+        startkey = None
+        while self._name:
+            uri = CouchURI()
+            uri.append(self._name)
+            uri.append("_all_docs")
+            uri.append("include_docs", "true")
+            uri.append("limit", str(page_size))
+            if startkey != None:
+                uri.append("startkey", json.dumps(startkey))
+                uri.append("skip", "1")
+            response = self._http_helper.get(uri)
+            if response.get_error() != None:
+                break
+            rows = response.get_elements()["rows"]
+            for row in rows:
+                doc_id = row["id"]
+                if not doc_id.startswith("_") and row.get("doc"):
+                    doc = CouchDocument(doc_id)
+                    doc.load_values(row["doc"])
+                    yield doc
+            if len(rows) < page_size:
+                break
+            startkey = rows[-1]["id"]
+
     def add_view(self, view_name, view_source):
         """
         defines a new view in the database
@@ -27,20 +27,27 @@ import cryptboxgtk
 from subprocess import Popen, PIPE
 from threading import Thread
 
+from cancellation import *
 from cryptboxgtk import *
 from cryptlog import *
 from cryptstore import *
 from config import *
+from digestcache import *
 from dirscanner import *
 from downloader import *
+from merkle import *
+from syncplan import *
 from fileinfo import *
 from uploader import *
+from watcher import *
 
 # Application constants
 CRYPTBOX_PORT = 5000
 # interval for checking: 15 minutes
 CRYPTBOX_RUNNER_INTERVAL = 900
-CRYPTBOX_LISTENER_INTERVAL = 2
+# seconds without changes in the source directory before changed files
+# are uploaded
+CRYPTBOX_WATCH_SETTLE_TIME = 2
 
 # State of the Runner Thread
 RUNNER_STATE_NOT_STARTED = 0
@@ -53,6 +60,13 @@ COMMAND_STOP = "stop"
 # Numbers of log entries to store before saving
 MAX_LOG_COUNTER = 50
 
+# Number of the largest directories to upload shown by --plan
+PLAN_LARGEST_DIRECTORIES = 10
+
+# Number of times --rekey encrypts the files that other computers
+# uploaded while the rekey was running
+REKEY_MAX_PASSES = 3
+
 class PIDLock(object):
     """
     utility class to check if CryptBox is already running
@@ -168,9 +182,12 @@ class Runner(object):
         self._state = RUNNER_STATE_NOT_STARTED
         self._sleep_interval = CRYPTBOX_RUNNER_INTERVAL
         self._cryptstore = cryptstore
-        self._uploader = Uploader(self._cryptstore)
-        self._downloader = Downloader(self._cryptstore)
-        self._sleep_counter = 0
+        self._digests = DigestCache()
+        self._uploader = Uploader(self._cryptstore, None, self._digests)
+        self._downloader = Downloader(self._cryptstore, None, self._digests)
+        self._watcher = None
+        self._merkle = MerkleTracker()
+        self._sleep_deadline = 0
         runner_instance = self
 
     def is_running(self):
@@ -183,10 +200,33 @@ class Runner(object):
 
     def stop(self):
         """
-        signals the thread to stop
+        signals the thread to stop. Running uploads and downloads are
+        cancelled after the current chunk of data.
         """
         self._state = RUNNER_STATE_STOPPING
-        self._sleep_counter = 0
+        self._sleep_deadline = 0
+        request_cancel()
+
+    def log_statistics(self, previous):
+        """
+        logs the number of database requests of a cycle
+        Parameters:
+        - previous
+          request counters before the cycle
+        """
+        current = get_http_statistics()
+        requests = current.get("requests", 0) - previous.get("requests", 0)
+        connections = current.get("connections", 0) - previous.get("connections", 0)
+        cryptlog("%i database requests using %i new connections." % (requests, connections))
+
+    def upload_changes(self):
+        """
+        uploads the files that were reported as changed by the watcher
+        """
+        relpaths = self._watcher.get_changes(CRYPTBOX_WATCH_SETTLE_TIME)
+        if relpaths and self.is_running():
+            cryptlog("Running Uploader for %i changed files ..." % len(relpaths))
+            self._uploader.run_changes(relpaths)
 
     def start(self):
         """
@@ -195,30 +235,58 @@ class Runner(object):
         cryptlog("Syncronization started.")
         lock = PIDLock()
         lock.write()
+        resume_cryptstore(self._cryptstore)
         self._state = RUNNER_STATE_RUNNING
         log_counter = MAX_LOG_COUNTER
+        config = CryptBoxConfig()
+        self._watcher = InotifyWatcher(config.get_source_directory())
+        if self._watcher.start():
+            cryptlog("Watching source directory for changes.")
         while self.is_running():
             if self._state == RUNNER_STATE_RUNNING:
+                if self._watcher.is_rescan_required():
+                    self._watcher.start()
+                self._watcher.clear_changes()
                 cryptlog("Checking password timestamp ...")
                 if not self._cryptstore.check_password_timestamp():
                     cryptlog("Password seemed to be changed.")
                     client = RunnerClient(CRYPTBOX_PORT)
                     client.stop()
                 else:
+                    statistics = get_http_statistics()
                     cryptlog("Refreshing CryptStore ...")
                     self._cryptstore.refresh()
+                    directories = self._merkle.compute(self._cryptstore, self._watcher)
+                    if directories != None:
+                        cryptlog("%i directories changed." % len(directories))
+                    cryptlog("Planning synchronization ...")
+                    planner = SyncPlanner(self._cryptstore, self._digests)
+                    plan = planner.create_plan(directories=directories)
                     cryptlog("Running Uploader ...")
-                    self._uploader.run()
+                    self._uploader.execute(plan)
                     cryptlog("Running Downloader ...")
-                    self._downloader.run()
+                    self._downloader.execute(plan)
+                    if not is_cancelled():
+                        self._merkle.commit(plan.get_relative_paths())
+                    self.log_statistics(statistics)
                 log_counter = log_counter - 1
                 if log_counter == 0:
                     save_cryptlog()
                     log_counter = MAX_LOG_COUNTER
-            self._sleep_counter = self._sleep_interval
-            while self._sleep_counter > 0:
-                time.sleep(1)
-                self._sleep_counter = self._sleep_counter - 1
+            # the watcher returns early when events arrive, so the end
+            # of the interval is determined by the clock
+            self._sleep_deadline = time.time() + self._sleep_interval
+            while self.is_running():
+                remaining = self._sleep_deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._watcher.wait(min(remaining, 1))
+                if self._watcher.is_rescan_required():
+                    cryptlog("Rescanning source directory ...")
+                    break
+                self.upload_changes()
+        self._watcher.close()
+        flush_states()
         cryptlog("Syncronization stopped.")
         lock.delete()
         save_cryptlog()
@@ -240,7 +308,6 @@ class ListenerThread(Thread):
         Thread.__init__(self)
         self._runner = runner
         self._socket = self.init_socket(port)
-        self._sleep_interval = CRYPTBOX_LISTENER_INTERVAL
 
     def init_socket(self, port):
         """
@@ -263,7 +330,6 @@ class ListenerThread(Thread):
             if data == COMMAND_STOP:
                 self._runner.stop()
                 flag = False
-            time.sleep(self._sleep_interval)
 
 class RunnerClient(object):
     """
@@ -324,8 +390,38 @@ def print_usage():
     print "  --download      download files from the destination directory"
     print "  --upload        upload files to the destination directory"
     print "  --purge         purge deleted files from destination directory"
+    print "  --cleanup       remove orphaned encrypted files from the destination"
+    print "                  directory"
+    print "  --plan          show what a synchronization would transfer and"
+    print "                  estimate its duration"
+    print "  --rekey         encrypt all files in the destination directory"
+    print "                  with a new key"
+    print "  --migrate-chunks  store all files in the destination directory as"
+    print "                  deduplicated chunks"
+    print "  --migrate-state copy the state information of the local files"
+    print "                  from CouchDB into an SQLite database"
     print "  --src-list      list information of the source directory"
     print "  --dest-list     list information of the destination directory"
+    print ""
+    print "Additional options for --upload, --download, --plan and --rekey:"
+    print ""
+    print "  --workers=N     number of processes to encrypt or decrypt files"
+
+def get_workers_option():
+    """
+    reads the number of worker processes from the command line
+    Returns:
+    - number of worker processes or None if the option is not set
+    """
+    result = None
+    for arg in sys.argv[2:]:
+        if arg.startswith("--workers="):
+            try:
+                result = int(arg[len("--workers="):])
+            except ValueError:
+                print "Invalid number of workers: %s" % arg
+                sys.exit(-1)
+    return result
 
 def init_cryptstore():
     """
@@ -346,6 +442,18 @@ def init_cryptstore():
             result = None
     return result
 
+def resume_cryptstore(cryptstore):
+    """
+    writes the changes of an interrupted synchronization to the
+    CryptStore (see CryptStore.resume())
+    Parameters:
+    - cryptstore
+      CryptStore instance
+    """
+    count = cryptstore.resume()
+    if count > 0:
+        cryptlog("%i changes of an interrupted synchronization resumed." % count)
+
 def timestamp_string(timestamp_float):
     """
     converts a float timestamp into a string
@@ -361,6 +469,34 @@ def timestamp_string(timestamp_float):
         result = time.strftime("%c", timestamp_struct)
     return result
 
+def size_string(size):
+    """
+    converts a number of bytes into a string
+    Parameters:
+    - size
+      number of bytes
+    Returns:
+    - string representation of the size
+    """
+    result = "%i bytes" % size
+    for unit, factor in [("GB", 1024 ** 3), ("MB", 1024 ** 2), ("KB", 1024)]:
+        if size >= factor:
+            result = "%.1f %s" % (float(size) / factor, unit)
+            break
+    return result
+
+def duration_string(seconds):
+    """
+    converts a duration into a string
+    Parameters:
+    - seconds
+      duration in seconds
+    Returns:
+    - string representation of the duration
+    """
+    seconds = int(round(seconds))
+    return "%i:%02i:%02i" % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
 def check_lock():
     """
     checks if CryptBox process is running. If such a process is
@@ -403,39 +539,25 @@ def stop():
 
 def new_password():
     """
-    sets up a new password
+    sets up a new password. The files in the destination directory are
+    not encrypted again, since only the key that encrypts the data key
+    of the store changes.
     """
     check_lock()
     cryptstore = init_cryptstore()
-    set_cryptlog_verbose(True)
-    cryptlog("Changing password ...")
-    # Update the local files
     if cryptstore:
-        uploader = Uploader(cryptstore)
-        uploader.run()
-        downloader = Downloader(cryptstore)
-        downloader.run()
-    password = show_new_password_window()
-    if password:
-        # Change the password
-        cryptstore = CryptStore()
-        cryptstore.set_new_password(password, False)
-        # Upload all local files with new password
-        config = CryptBoxConfig()
-        srcpath = config.get_source_directory()
-        scanner = DirScanner(srcpath)
-        timestamp = time.time()
-        for fileinfo in scanner.get_list().get_entries():
-            fileinfo.scan()
-            if fileinfo.exists():
-                fileinfo.set_timestamp(timestamp)    
-                relpath = fileinfo.get_relative_path()
-                cryptstore.upload_file(fileinfo)
-                cryptlog("%s uploaded." % relpath)
-        cryptlog("Changing password completed.")
+        set_cryptlog_verbose(True)
+        cryptlog("Changing password ...")
+        resume_cryptstore(cryptstore)
+        password = show_new_password_window()
+        if password:
+            cryptstore.change_password(password)
+            cryptlog("Changing password completed.")
+        else:
+            cryptlog("Changing password canceled.")
+        save_cryptlog()
     else:
-        cryptlog("Changing password canceled.")
-    save_cryptlog()
+        print "Login failed."
 
 def download():
     """
@@ -446,7 +568,8 @@ def download():
     if cryptstore:
         set_cryptlog_verbose(True)
         cryptlog("Download started.")
-        downloader = Downloader(cryptstore)
+        resume_cryptstore(cryptstore)
+        downloader = Downloader(cryptstore, get_workers_option())
         downloader.run()
         cryptlog("Download finished.")
         save_cryptlog()
@@ -462,7 +585,8 @@ def upload():
     if cryptstore:
         set_cryptlog_verbose(True)
         cryptlog("Upload started.")
-        uploader = Uploader(cryptstore)
+        resume_cryptstore(cryptstore)
+        uploader = Uploader(cryptstore, get_workers_option())
         uploader.run()
         cryptlog("Upload finished.")
         save_cryptlog()
@@ -491,9 +615,8 @@ def source_list():
     """
     config = CryptBoxConfig()
     srcpath = config.get_source_directory()
-    scanner = DirScanner(srcpath)
-    fileinfolist = scanner.get_list()
-    for entry in fileinfolist.get_entries():
+    scanner = DirScanner(srcpath, config.get_scan_threads())
+    for entry in scanner.iterate():
         print "filepath: %s" % entry.get_relative_path()
         timestamp = timestamp_string(entry.get_file_timestamp())
         print "file timestamp: %s" % timestamp
@@ -516,6 +639,153 @@ def purge():
         for path in pathlist:
             cryptlog("%s purged." % path)
 
+def cleanup():
+    """
+    removes encrypted files in the destination directory that don't
+    belong to any file
+    """
+    check_lock()
+    cryptstore = init_cryptstore()
+    if cryptstore:
+        set_cryptlog_verbose(True)
+        resume_cryptstore(cryptstore)
+        namelist = cryptstore.remove_orphans()
+        if len(namelist) == 0:
+            cryptlog("no orphaned files removed.")
+        else:
+            for name in namelist:
+                cryptlog("%s removed." % name)
+        save_cryptlog()
+    else:
+        print "Login failed."
+
+def rekey():
+    """
+    encrypts the files in the destination directory with a new key.
+    The local files are not changed, so other computers don't have to
+    download the files again.
+    """
+    check_lock()
+    cryptstore = init_cryptstore()
+    if cryptstore:
+        set_cryptlog_verbose(True)
+        cryptlog("Rekey started.")
+        resume_cryptstore(cryptstore)
+        finished = False
+        for rekey_pass in range(REKEY_MAX_PASSES):
+            failed = False
+            for name, flag in cryptstore.rekey(get_workers_option()):
+                if flag:
+                    cryptlog("%s encrypted with the new key." % name)
+                else:
+                    failed = True
+            finished = cryptstore.commit_rekey()
+            if finished or failed or is_cancelled():
+                break
+            cryptlog("Files were added meanwhile.")
+        if finished:
+            cryptlog("Rekey finished.")
+        else:
+            cryptlog("Rekey incomplete. Run --rekey again to continue.")
+        save_cryptlog()
+    else:
+        print "Login failed."
+
+def migrate_chunks():
+    """
+    converts the files in the destination directory into chunks
+    """
+    check_lock()
+    cryptstore = init_cryptstore()
+    if cryptstore:
+        set_cryptlog_verbose(True)
+        cryptlog("Migration to chunks started.")
+        resume_cryptstore(cryptstore)
+        config = CryptBoxConfig()
+        config.set_storage(STORAGE_CHUNKED)
+        config.save()
+        for entry, flag in cryptstore.migrate_to_chunks(get_workers_option()):
+            if flag:
+                cryptlog("%s converted." % entry.get_filepath())
+        cryptlog("Migration to chunks finished.")
+        save_cryptlog()
+    else:
+        print "Login failed."
+
+def show_plan():
+    """
+    shows what a synchronization would transfer without changing the
+    source or the destination directory
+    """
+    cryptstore = CryptStore()
+    cryptstore.set_read_only(True)
+    if not cryptstore.has_password():
+        print "No password set."
+        return
+    if not show_login_window(cryptstore):
+        print "Login failed."
+        return
+    config = CryptBoxConfig()
+    planner = SyncPlanner(cryptstore, DigestCache())
+    planner.set_read_only(True)
+    plan = planner.create_plan()
+    upload_size = plan.get_upload_size()
+    download_size = plan.get_download_size(cryptstore)
+    print "Files checked:          %i" % plan.get_file_count()
+    print "Files to upload:        %i" % len(plan.get_actions(PLAN_UPLOAD))
+    downloads = plan.get_actions(PLAN_DOWNLOAD)
+    # the content of existing files is not compared in plan mode
+    existing = len([action for action in downloads if action.get_fileinfo().get_size() != None])
+    print "Files to download:      %i (%i unless their content is unchanged)" % \
+        (len(downloads), existing)
+    print "Files to delete:        %i" % len(plan.get_actions(PLAN_DELETE_LOCAL))
+    print "Entries to delete:      %i" % len(plan.get_actions(PLAN_DELETE_REMOTE))
+    print "Timestamps to update:   %i" % (len(plan.get_actions(PLAN_TOUCH_LOCAL)) +
+                                          len(plan.get_actions(PLAN_TOUCH_REMOTE)))
+    print "Bytes to encrypt:       %s" % size_string(upload_size)
+    print "Bytes to decrypt:       %s" % size_string(download_size)
+    print "Index size:             %s" % size_string(cryptstore.get_index_size())
+    workers = get_workers_option()
+    if workers == None:
+        workers = config.get_workers()
+    workers = get_worker_count(workers)
+    encrypt_rate, decrypt_rate = measure_cipher_throughput(cryptstore.get_key())
+    duration = upload_size / (encrypt_rate * workers) + \
+               download_size / (decrypt_rate * workers)
+    print "Cipher throughput:      %s/s encrypt, %s/s decrypt" % \
+        (size_string(encrypt_rate), size_string(decrypt_rate))
+    print "Estimated duration:     %s (%i workers)" % (duration_string(duration), workers)
+    # the largest directories to upload reveal missing ignore rules
+    directories = {}
+    for action in plan.get_actions(PLAN_UPLOAD):
+        reldir = os.path.dirname(action.get_relative_path())
+        size = action.get_fileinfo().get_size() or 0
+        directories[reldir] = directories.get(reldir, 0) + size
+    largest = sorted(directories.items(), key=lambda item: item[1], reverse=True)
+    if len(largest) > 0:
+        print ""
+        print "Largest directories to upload:"
+        for reldir, size in largest[:PLAN_LARGEST_DIRECTORIES]:
+            print "  %10s  %s" % (size_string(size), reldir or ".")
+
+def migrate_state():
+    """
+    copies the state information of the local files from CouchDB into
+    an SQLite database and uses the SQLite database from now on
+    """
+    check_lock()
+    set_cryptlog_verbose(True)
+    cryptlog("Migration of state information started.")
+    target = SQLiteStateStore()
+    count = migrate_states(CouchStateStore(), target)
+    target.close()
+    config = CryptBoxConfig()
+    config.set_state_backend(STATE_BACKEND_SQLITE)
+    config.save()
+    cryptlog("%i entries copied to %s." % (count, target.get_filepath()))
+    cryptlog("Migration of state information finished.")
+    save_cryptlog()
+
 def main():
     """
     main function
@@ -542,6 +812,16 @@ def main():
             source_list()
         elif option == "--purge":
             purge()
+        elif option == "--cleanup":
+            cleanup()
+        elif option == "--rekey":
+            rekey()
+        elif option == "--migrate-chunks":
+            migrate_chunks()
+        elif option == "--plan":
+            show_plan()
+        elif option == "--migrate-state":
+            migrate_state()
         else:
             print_usage()
 
@@ -0,0 +1,447 @@
+# -*- coding: iso-8859-15 -*-
+
+# cryptbox - helper functions for encryption and decryption
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import binascii
+import hashlib
+import hmac
+import os
+import os.path
+import random
+import struct
+import time
+
+from Crypto.Cipher import AES
+from StringIO import StringIO
+
+from blobformat import *
+from cancellation import *
+
+# suffix of files that are written. They are renamed when they are
+# complete, so that an interrupted process doesn't leave incomplete files.
+PARTIAL_SUFFIX = ".cryptbox-partial"
+
+# number of bytes encrypted to measure the throughput of the cipher
+CIPHER_BENCHMARK_SIZE = 8 * 1024 * 1024
+
+def normalize_key(key):
+    """
+    normalize a key to a valid length
+    - key
+      key to normalize
+    Returns:
+    - normalized keys
+    """
+    result = key
+    targetlength = 16
+    if len(key) > 16:
+        targetlength = 24
+    if len(key) > 24:
+        targetlength = 32
+    part = key
+    while len(result) < targetlength:
+        part = part[::-1]
+        result = result + part
+    return result[:targetlength]
+
+def split_line(line, length):
+    """
+    splits a line into several substrings with a given
+    length
+    Parameters:
+    - line
+      line to split into substrings
+    - length
+      length of each substring
+    Returns:
+    - list of substrings
+    """
+    result = []
+    pos = 0
+    while pos + length < len(line):
+        part = line[pos:pos + length]
+        result.append(part)
+        pos = pos + length
+    if pos < len(line):
+        result.append(line[pos:])
+    return result
+
+def remove_partial_file(filename):
+    """
+    removes an incomplete file after an error
+    Parameters:
+    - filename
+      name of the incomplete file
+    """
+    if os.path.exists(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+def adjust_time(srcfilename, destfilename):
+    """
+    sets atime and mtime of a destination file corresponding to a
+    source file
+    Parameters:
+    - srcfilename
+      name of the source file
+    - destfilename
+      name of the destination file
+    """
+    atime = os.path.getatime(srcfilename)
+    mtime = os.path.getmtime(srcfilename)
+    os.utime(destfilename, (atime, mtime))
+
+def get_change_time(filename):
+    """
+    determines when a file was written or renamed the last time. The
+    modification time isn't sufficient, because adjust_time() sets it to
+    the time of another file, e.g. an encrypted file gets the time of the
+    file it contains. The inode change time is updated by adjust_time()
+    and can't be set to an earlier time.
+    Parameters:
+    - filename
+      name of the file
+    Returns:
+    - later one of the modification time and the inode change time
+    """
+    return max(os.path.getmtime(filename), os.path.getctime(filename))
+
+def create_iv():
+    """
+    creates a random initialization vector
+    Returns:
+    - initialization vector of 16 bytes
+    """
+    rlist = []
+    for i in range(16):
+        rlist.append(chr(random.randint(0, 255)))
+    return "".join(rlist)
+
+def encrypt_string(data, key):
+    """
+    encrypts a string using AES with a given key. The result has the
+    former layout of files encrypted by encrypt_file(), which
+    decrypt_file() still reads.
+    Parameters:
+    - data
+      string to encrypt
+    - key
+      encryption key. The encryption key must be 16, 24 or 32
+      bytes long.
+    Returns:
+    - encrypted string
+    """
+    iv = create_iv()
+    encryptor = AES.new(key, AES.MODE_CBC, iv)
+    padded = data
+    if len(padded) % 16 != 0:
+        padded += ' ' * (16 - len(padded) % 16)
+    return "".join([struct.pack('<Q', len(data)), iv, encryptor.encrypt(padded)])
+
+def read_encrypted_string(srcfile, key):
+    """
+    reads and decrypts a string written by encrypt_string()
+    Parameters:
+    - srcfile
+      opened file to read from
+    - key
+      encryption key. The encryption key must be 16, 24 or 32
+      bytes long.
+    Returns:
+    - decrypted string or None if the file ends or the string is
+      incomplete
+    """
+    header = srcfile.read(struct.calcsize('Q'))
+    if len(header) < struct.calcsize('Q'):
+        return None
+    origsize = struct.unpack('<Q', header)[0]
+    iv = srcfile.read(16)
+    if len(iv) < 16:
+        return None
+    cryptsize = origsize
+    if cryptsize % 16 != 0:
+        cryptsize += 16 - cryptsize % 16
+    data = srcfile.read(cryptsize)
+    if len(data) < cryptsize:
+        return None
+    decryptor = AES.new(key, AES.MODE_CBC, iv)
+    return decryptor.decrypt(data)[:origsize]
+
+def derive_key(password, salt, iterations, length=32):
+    """
+    derives a key from a password using PBKDF2 with HMAC-SHA256
+    Parameters:
+    - password
+      password to derive the key from
+    - salt
+      random salt
+    - iterations
+      number of iterations
+    - length
+      length of the key in bytes
+    Returns:
+    - derived key
+    """
+    if isinstance(password, unicode):
+        password = password.encode("utf-8")
+    return hashlib.pbkdf2_hmac("sha256", password, salt, iterations, length)
+
+def derive_wrapping_keys(wrapping_key):
+    """
+    derives the keys to encrypt and to authenticate a wrapped key from
+    a wrapping key
+    Parameters:
+    - wrapping_key
+      key derived from a password
+    Returns:
+    - tuple of the encryption key and the authentication key
+    """
+    encryption_key = hmac.new(wrapping_key, "cryptbox-key-encryption", hashlib.sha256).digest()
+    authentication_key = hmac.new(wrapping_key, "cryptbox-key-authentication", hashlib.sha256).digest()
+    return (encryption_key, authentication_key)
+
+def wrap_key(key, wrapping_key):
+    """
+    encrypts a key with another key
+    Parameters:
+    - key
+      key to encrypt
+    - wrapping_key
+      key to encrypt with. The key must be 16, 24 or 32 bytes long.
+    Returns:
+    - tuple of the encrypted key and its authentication code as hex
+      strings
+    """
+    encryption_key, authentication_key = derive_wrapping_keys(wrapping_key)
+    wrapped = encrypt_string(key, encryption_key)
+    mac = hmac.new(authentication_key, wrapped, hashlib.sha256).hexdigest()
+    return (binascii.hexlify(wrapped), mac)
+
+def unwrap_key(wrapped, mac, wrapping_key, legacy=False):
+    """
+    decrypts a key encrypted by wrap_key()
+    Parameters:
+    - wrapped
+      encrypted key as a hex string
+    - mac
+      authentication code of the encrypted key as a hex string
+    - wrapping_key
+      key to decrypt with
+    - legacy
+      True, if the key was encrypted by an earlier version, which used
+      the wrapping key itself to encrypt and to authenticate
+    Returns:
+    - decrypted key or None, if the wrapping key is wrong or the
+      encrypted key was modified
+    """
+    try:
+        wrapped = binascii.unhexlify(wrapped)
+    except TypeError:
+        return None
+    if legacy:
+        encryption_key, authentication_key = (wrapping_key, wrapping_key)
+    else:
+        encryption_key, authentication_key = derive_wrapping_keys(wrapping_key)
+    expected = hmac.new(authentication_key, wrapped, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, str(mac)):
+        return None
+    return read_encrypted_string(StringIO(wrapped), encryption_key)
+
+def get_password_verifier(wrapping_key):
+    """
+    derives a value that shows that a password is set and changes with
+    the password. Since it is derived from the key derived from the
+    password, guessing the password from it is as slow as guessing it
+    from the key file.
+    Parameters:
+    - wrapping_key
+      key derived from the password
+    Returns:
+    - verifier as a hex string
+    """
+    return hmac.new(wrapping_key, "cryptbox-password-verifier", hashlib.sha256).hexdigest()
+
+def sample_file_codec(srcfilename, codec):
+    """
+    decides whether a file is compressed (see choose_codec())
+    Parameters:
+    - srcfilename
+      name of the file
+    - codec
+      configured codec
+    Returns:
+    - codec to use for the file
+    """
+    result = codec
+    if codec != BLOB_CODEC_NONE:
+        srcfile = open(srcfilename, "rb")
+        try:
+            result = choose_codec(srcfile.read(BLOB_SAMPLE_SIZE), codec)
+        finally:
+            srcfile.close()
+    return result
+
+def encrypt_file(srcfilename, destfilename, key, codec=BLOB_CODEC_NONE):
+    """
+    encrypts a file into the segmented format (see blobformat). If a
+    codec is given, the file is compressed unless a sample of its start
+    doesn't compress well.
+    Parameters:
+    - srcfilename
+      name of the file to encrypt
+    - destfilename
+      name of the destination file
+    - key
+      encryption key
+    - codec
+      codec to compress the file with
+    Returns:
+    - digest of the content of the file (see compute_file_digest())
+    """
+    filesize = os.path.getsize(srcfilename)
+    codec = sample_file_codec(srcfilename, codec)
+    segment_size = BLOB_SEGMENT_SIZE
+    if codec != BLOB_CODEC_NONE:
+        segment_size = BLOB_COMPRESSED_SEGMENT_SIZE
+    srcfile = open(srcfilename, "rb")
+    destfile = open(destfilename, "wb")
+    try:
+        digest = write_segments(srcfile, destfile, key, filesize, segment_size, codec)
+    finally:
+        srcfile.close()
+        destfile.close()
+    adjust_time(srcfilename, destfilename)
+    return digest
+
+def compute_file_digest(filename, chunksize=1024*1024, cancellable=False):
+    """
+    computes the digest of the content of a file
+    Parameters:
+    - filename
+      name of the file
+    - chunksize
+      size of the chunks to read the file
+    - cancellable
+      True, if a cancelled synchronization stops the computation
+    Returns:
+    - SHA-256 digest of the content as a hex string
+    """
+    digest = hashlib.sha256()
+    srcfile = open(filename, "rb")
+    try:
+        while True:
+            if cancellable:
+                check_cancelled()
+            chunk = srcfile.read(chunksize)
+            if len(chunk) == 0:
+                break
+            digest.update(chunk)
+    finally:
+        srcfile.close()
+    return digest.hexdigest()
+
+def decrypt_file(srcfilename, destfilename, key, chunksize=64*1024):
+    """
+    decrypt a file of either format using AES with a given key
+    Parameters:
+    - srcfilename
+      name of the file to decrypt
+    - destfilename
+      name of the destination file
+    - key
+      encryption key. The encryption key must be 16, 24 or 32
+      bytes long.
+    - chunksize
+      size of the chunks to decrypt and write the file
+    """
+    srcfile = open_encrypted_file(srcfilename, key)
+    destfile = open(destfilename, "wb")
+    try:
+        while True:
+            check_cancelled()
+            chunk = srcfile.read(chunksize)
+            if len(chunk) == 0:
+                break
+            destfile.write(chunk)
+    finally:
+        srcfile.close()
+        destfile.close()
+    adjust_time(srcfilename, destfilename)
+
+def transcode_file(srcfilename, destfilename, old_key, new_key):
+    """
+    encrypts an encrypted file of either format with another key into
+    the segmented format. The file is decrypted and encrypted again in
+    a single pass, so that the content is neither written to disk nor
+    kept in memory completely. Compressed files stay compressed with
+    the same codec. The destination file gets the times of the source
+    file.
+    Parameters:
+    - srcfilename
+      name of the encrypted file
+    - destfilename
+      name of the destination file
+    - old_key
+      key the source file is encrypted with
+    - new_key
+      key to encrypt the destination file with
+    """
+    srcfile = open_encrypted_file(srcfilename, old_key)
+    segment_size = BLOB_SEGMENT_SIZE
+    codec = BLOB_CODEC_NONE
+    if isinstance(srcfile, SegmentedFile):
+        segment_size = srcfile.get_segment_size()
+        codec = srcfile.get_codec()
+    destfile = open(destfilename, "wb")
+    try:
+        write_segments(srcfile, destfile, new_key, srcfile.get_size(), segment_size, codec)
+    finally:
+        srcfile.close()
+        destfile.close()
+    adjust_time(srcfilename, destfilename)
+
+def measure_cipher_throughput(key, size=CIPHER_BENCHMARK_SIZE, segment_size=BLOB_SEGMENT_SIZE):
+    """
+    measures how fast data is encrypted and decrypted by a single
+    process in the way encrypt_file() and decrypt_file() do it. No
+    files are read or written.
+    Parameters:
+    - key
+      encryption key
+    - size
+      number of bytes to encrypt
+    - segment_size
+      size of the segments to encrypt
+    Returns:
+    - tuple of the encrypted and the decrypted bytes per second
+    """
+    data = os.urandom(segment_size)
+    count = max(size / segment_size, 1)
+    keys = derive_segment_keys(key)
+    header = create_header(count * segment_size, segment_size)
+    digest = hashlib.sha256()
+    start = time.time()
+    for index in range(count):
+        digest.update(data)
+        segment = encrypt_segment(keys, header, index, data)
+    encrypt_time = time.time() - start
+    start = time.time()
+    for index in range(count):
+        decrypt_segment(keys, header, count - 1, segment)
+    decrypt_time = time.time() - start
+    total = float(count * segment_size)
+    return (total / max(encrypt_time, 1e-6), total / max(decrypt_time, 1e-6))
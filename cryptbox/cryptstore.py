@@ -14,12 +14,14 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+import binascii
 import getpass
 import hashlib
 import json
 import os
 import os.path
 import random
+import re
 import struct
 import tempfile
 import time
@@ -27,156 +29,305 @@ import time
 from Crypto.Cipher import AES
 from tempfile import *
 
+from chunkstore import *
 from config import *
+from crypthelper import *
 from fileinfo import *
 
 from debug import *
+from workerpool import *
 
-# helper functions for encryption and decryption
+# names of the files in the destination directory
+CRYPTSTORE_PASSWORD_NAME = "cryptbox.00000000"
+CRYPTSTORE_INDEX_NAME = "cryptbox.00000001"
+CRYPTSTORE_JOURNAL_NAME = "cryptbox.00000001.journal"
+CRYPTSTORE_KEYS_NAME = "cryptbox.keys"
+CRYPTSTORE_REKEY_NAME = "cryptbox.rekey"
 
-def normalize_key(key):
+# suffix of the files that are encrypted with the new key by a rekey
+CRYPTSTORE_REKEY_SUFFIX = ".rekey"
+
+# length in bytes of the random data key of a new store
+CRYPTSTORE_KEY_SIZE = 32
+
+# number of PBKDF2 iterations to derive the key that encrypts the data
+# key from the password
+CRYPTSTORE_KEY_ITERATIONS = 200000
+
+# version of the key file. Key files of version 1 used the key derived
+# from the password to encrypt and to authenticate the data key.
+CRYPTSTORE_KEYS_VERSION = 2
+
+# local file containing the changes of the current batch that are not
+# written to the journal yet
+CRYPTSTORE_PROGRESS_FILENAME = "~/.cryptbox.progress"
+
+# names of the encrypted files of entries
+CRYPTSTORE_BLOB_PATTERN = re.compile(r"^cryptbox\.[0-9]{8}(%s)?$" % re.escape(PARTIAL_SUFFIX))
+
+# minimal age in seconds of orphaned encrypted files to be removed.
+# Younger files may belong to an upload of another computer whose index
+# changes are not synchronized yet.
+CRYPTSTORE_ORPHAN_MIN_AGE = 24 * 60 * 60
+
+# size of the parts of a large file that are encrypted or decrypted by
+# different worker processes
+CRYPTSTORE_PART_SIZE = 8 * 1024 * 1024
+
+# minimal number of journal records before the index is checkpointed
+CRYPTSTORE_JOURNAL_MIN_CHECKPOINT = 1000
+
+# operations recorded in the journal
+JOURNAL_OP_PUT = "put"
+JOURNAL_OP_REMOVE = "remove"
+
+# helper functions for the destination directory
+
+def create_path(filepath):
     """
-    normalize a key to a valid length
-    - key
-      key to normalize
+    checks, if a given filepath exists, and creates the path
+    if it doesn't exists.
+    Parameters:
+    - filepath
+      filepath to check
     Returns:
-    - normalized keys
+    - filepath was successfully checked or created
     """
-    result = key
-    targetlength = 16
-    if len(key) > 16:
-        targetlength = 24
-    if len(key) > 24:
-        targetlength = 32
-    part = key
-    while len(result) < targetlength:
-        part = part[::-1]
-        result = result + part
-    return result[:targetlength]
-
-def split_line(line, length):
+    result = True
+    dir_list = filepath.split("/")
+    test_path = "/"
+    for index in range(0, len(dir_list) - 1):
+        test_path = os.path.join(test_path, dir_list[index])
+        if len(test_path) > 1:
+            if not os.path.exists(test_path):
+                try:
+                    os.mkdir(test_path)
+                except OSError:
+                    result = False
+    return result
+
+def store_file(srcfilename, destfilename, chunkdir, key, codec=BLOB_CODEC_NONE,
+               unchanged_digest=None):
     """
-    splits a line into several substrings with a given
-    length
+    stores an encrypted file either as a single file or as chunks. A
+    single file is written under a temporary name and renamed when it
+    is complete; it is compressed with the given codec, if its content
+    is compressible. The digest of the content is computed while the
+    file is encrypted. If it equals unchanged_digest, the existing
+    encrypted file is kept.
     Parameters:
-    - line
-      line to split into substrings
-    - length
-      length of each substring
+    - srcfilename
+      name of the file to store
+    - destfilename
+      name of the encrypted file, if the file is stored as a single
+      file
+    - chunkdir
+      directory containing the chunks or None, if the file is stored
+      as a single file
+    - key
+      encryption key
+    - codec
+      codec to compress a single file with
+    - unchanged_digest
+      digest of the content of the existing encrypted file or None
     Returns:
-    - list of substrings
+    - tuple of the list of the ids of the chunks or None and the
+      digest of the content of the file
     """
-    result = []
-    pos = 0
-    while pos + length < len(line):
-        part = line[pos:pos + length]
-        result.append(part)
-        pos = pos + length
-    if pos < len(line):
-        result.append(line[pos:])
+    if chunkdir == None:
+        partialname = destfilename + PARTIAL_SUFFIX
+        try:
+            digest = encrypt_file(srcfilename, partialname, key, codec)
+            if digest == unchanged_digest:
+                remove_partial_file(partialname)
+            else:
+                os.rename(partialname, destfilename)
+        except:
+            remove_partial_file(partialname)
+            raise
+        result = (None, digest)
+    else:
+        result = store_file_chunks(srcfilename, chunkdir, key)
     return result
 
-def adjust_time(srcfilename, destfilename):
+def restore_file(srcfilename, chunkdir, chunk_ids, destfilename, key, timestamp):
     """
-    sets atime and mtime of a destination file corresponding to a
-    source file
+    restores an encrypted file stored by store_file(). The file is
+    written under a temporary name and renamed when it is complete, so
+    that an interrupted download doesn't leave an incomplete file.
     Parameters:
     - srcfilename
-      name of the source file
+      name of the encrypted file, if the file is stored as a single
+      file
+    - chunkdir
+      directory containing the chunks
+    - chunk_ids
+      list of the ids of the chunks or None, if the file is stored
+      as a single file
     - destfilename
-      name of the destination file
+      name of the file to restore
+    - key
+      encryption key
+    - timestamp
+      timestamp of the stored file
     """
-    atime = os.path.getatime(srcfilename)
-    mtime = os.path.getmtime(srcfilename)
-    os.utime(destfilename, (atime, mtime))
+    partialname = destfilename + PARTIAL_SUFFIX
+    try:
+        if chunk_ids == None:
+            decrypt_file(srcfilename, partialname, key)
+        else:
+            restore_file_chunks(chunkdir, chunk_ids, partialname, key, timestamp)
+        os.rename(partialname, destfilename)
+    except:
+        remove_partial_file(partialname)
+        raise
 
-def encrypt_file(srcfilename, destfilename, key, chunksize=64*1024):
-    """ 
-    encrypts a file using AES with a given key
+def create_store_jobs(srcfilename, destfilename, key, part_size):
+    """
+    creates the jobs to encrypt a large file into a single encrypted
+    file by several worker processes. The first job computes the digest
+    of the content while the other jobs encrypt the parts of the file.
+    The encrypted file is written under a temporary name and renamed by
+    finish_store().
     Parameters:
     - srcfilename
-      name of the file to encrypt
+      name of the file to store
     - destfilename
-      name of the destination file
+      name of the encrypted file
     - key
-      encryption key. The encryption key must be 16, 24 or 32
-      bytes long.
-    - chunksize
-      size of the chunks to read and encrypt the file
+      encryption key
+    - part_size
+      size of the parts of the file
+    Returns:
+    - list of tuples (function, args)
     """
-    rlist = []
-    for i in range(16):
-        rlist.append(chr(random.randint(0, 255)))
-    iv = "".join(rlist)
-    encryptor = AES.new(key, AES.MODE_CBC, iv)
-    filesize = os.path.getsize(srcfilename)
-    srcfile = open(srcfilename, "rb")
-    destfile = open(destfilename, "wb")
-    destfile.write(struct.pack('<Q', filesize))
-    destfile.write(iv)
-    while True:
-        chunk = srcfile.read(chunksize)
-        if len(chunk) == 0:
-            break
-        elif len(chunk) % 16 != 0:
-            chunk += ' ' * (16 - len(chunk) % 16)
-        destfile.write(encryptor.encrypt(chunk))
-    srcfile.close()
-    destfile.close()
-    adjust_time(srcfilename, destfilename)
+    partialname = destfilename + PARTIAL_SUFFIX
+    size = os.path.getsize(srcfilename)
+    header = create_segmented_file(partialname, key, size)
+    result = [(compute_file_digest, (srcfilename, 1024 * 1024, True))]
+    for first, count in split_segments(size, BLOB_SEGMENT_SIZE, part_size):
+        result.append((encrypt_segments, (srcfilename, partialname, key, header, first, count)))
+    return result
+
+def finish_store(srcfilename, destfilename, timestamp, digest, unchanged_digest=None):
+    """
+    completes a file encrypted by the jobs of create_store_jobs(). If
+    the digest equals unchanged_digest, the existing encrypted file is
+    kept.
+    Parameters:
+    - srcfilename
+      name of the stored file
+    - destfilename
+      name of the encrypted file
+    - timestamp
+      modification time of the file when the jobs were created
+    - digest
+      digest of the content of the file
+    - unchanged_digest
+      digest of the content of the existing encrypted file or None
+    Returns:
+    - tuple of None and the digest of the content (see store_file())
+    """
+    partialname = destfilename + PARTIAL_SUFFIX
+    if os.path.getmtime(srcfilename) != timestamp:
+        raise IOError("%s was changed while it was encrypted." % srcfilename)
+    if digest == unchanged_digest:
+        remove_partial_file(partialname)
+    else:
+        adjust_time(srcfilename, partialname)
+        os.rename(partialname, destfilename)
+    return (None, digest)
 
-def decrypt_file(srcfilename, destfilename, key, chunksize=64*1024):
+def create_restore_jobs(srcfilename, destfilename, key, part_size):
     """
-    decrypt a file using AES with a given key
+    creates the jobs to decrypt a large file of the segmented format by
+    several worker processes. The file is written under a temporary
+    name and renamed by finish_restore().
     Parameters:
     - srcfilename
-      name of the file to decrypt
+      name of the encrypted file
     - destfilename
-      name of the destination file
+      name of the file to restore
     - key
-      encryption key. The encryption key must be 16, 24 or 32
-      bytes long.
-    - chunksize
-      size of the chunks to read and encrypt the file
+      encryption key
+    - part_size
+      size of the parts of the file
+    Returns:
+    - list of tuples (function, args) or None, if the file can't be
+      decrypted in parts
     """
-    srcfile = open(srcfilename, "rb")
-    origsize = struct.unpack('<Q', srcfile.read(struct.calcsize('Q')))[0]
-    iv = srcfile.read(16)
-    decryptor = AES.new(key, AES.MODE_CBC, iv)
-    destfile = open(destfilename, "wb")
-    while True:
-        chunk = srcfile.read(chunksize)
-        if len(chunk) == 0:
-            break
-        destfile.write(decryptor.decrypt(chunk))
-    destfile.truncate(origsize)
+    srcfile = open_encrypted_file(srcfilename, key)
     srcfile.close()
+    if not isinstance(srcfile, SegmentedFile):
+        return None
+    partialname = destfilename + PARTIAL_SUFFIX
+    destfile = open(partialname, "wb")
+    destfile.truncate(srcfile.get_size())
     destfile.close()
-    adjust_time(srcfilename, destfilename)
+    result = []
+    parts = split_segments(srcfile.get_size(), srcfile.get_segment_size(), part_size)
+    for first, count in parts:
+        result.append((decrypt_segments, (srcfilename, partialname, key, first, count)))
+    return result
 
-def create_path(filepath):
+def finish_restore(srcfilename, destfilename):
     """
-    checks, if a given filepath exists, and creates the path
-    if it doesn't exists.
+    completes a file decrypted by the jobs of create_restore_jobs()
     Parameters:
-    - filepath
-      filepath to check
+    - srcfilename
+      name of the encrypted file
+    - destfilename
+      name of the restored file
+    """
+    partialname = destfilename + PARTIAL_SUFFIX
+    adjust_time(srcfilename, partialname)
+    os.rename(partialname, destfilename)
+
+def convert_to_chunks(srcfilename, chunkdir, key):
+    """
+    converts a single encrypted file into chunks
+    Parameters:
+    - srcfilename
+      name of the encrypted file
+    - chunkdir
+      directory containing the chunks
+    - key
+      encryption key
     Returns:
-    - filepath was successfully checked or created
+    - tuple of the list of the ids of the chunks and the digest of
+      the content of the file
     """
-    result = True
-    dir_list = filepath.split("/")
-    test_path = "/"
-    for index in range(0, len(dir_list) - 1):
-        test_path = os.path.join(test_path, dir_list[index])
-        if len(test_path) > 1:
-            if not os.path.exists(test_path):
-                try:
-                    os.mkdir(test_path)
-                except OSError:
-                    result = False
+    tempname = NamedTemporaryFile().name
+    try:
+        decrypt_file(srcfilename, tempname, key)
+        result = store_file_chunks(tempname, chunkdir, key)
+    finally:
+        if os.path.exists(tempname):
+            os.remove(tempname)
     return result
 
+def rekey_blob(srcfilename, destfilename, old_key, new_key):
+    """
+    encrypts a single encrypted file with a new key. The file is
+    written under a temporary name and renamed when it is complete.
+    Parameters:
+    - srcfilename
+      name of the encrypted file
+    - destfilename
+      name of the file encrypted with the new key
+    - old_key
+      key the file is encrypted with
+    - new_key
+      key to encrypt the file with
+    """
+    partialname = destfilename + PARTIAL_SUFFIX
+    try:
+        transcode_file(srcfilename, partialname, old_key, new_key)
+        os.rename(partialname, destfilename)
+    except:
+        remove_partial_file(partialname)
+        raise
+
 # STATE_UPLOADED = "u"
 # STATE_DELETED = "d"
 
@@ -202,6 +353,8 @@ class CryptStoreEntry(object):
         self._timestamp = timestamp
         self._state = state
         self._entry_id = entry_id
+        self._chunks = None
+        self._digest = None
 
     def get_filepath(self):
         """
@@ -231,6 +384,41 @@ class CryptStoreEntry(object):
         """
         return self._entry_id
 
+    def get_chunks(self):
+        """
+        Returns:
+        - list of the ids of the chunks of the file or None, if the
+          file is stored as a single file
+        """
+        return self._chunks
+
+    def set_chunks(self, chunks):
+        """
+        sets the chunks of the file
+        Parameters:
+        - chunks
+          list of the ids of the chunks or None, if the file is
+          stored as a single file
+        """
+        self._chunks = chunks
+
+    def get_digest(self):
+        """
+        Returns:
+        - digest of the content of the file or None, if the digest is
+          unknown
+        """
+        return self._digest
+
+    def set_digest(self, digest):
+        """
+        sets the digest of the content of the file
+        Parameters:
+        - digest
+          digest to set
+        """
+        self._digest = digest
+
     def set_state(self, state):
         """
         sets the state
@@ -249,6 +437,36 @@ class CryptStoreEntry(object):
         """
         self._timestamp = timestamp
 
+    def get_values(self):
+        """
+        Returns:
+        - dictionary of the entry values as stored in the index
+        """
+        entry_dict = {}
+        entry_dict["filepath"] = self._filepath
+        entry_dict["timestamp"] = self._timestamp
+        entry_dict["state"] = self._state
+        entry_dict["entry_id"] = self._entry_id
+        if self._chunks != None:
+            entry_dict["chunks"] = self._chunks
+        if self._digest != None:
+            entry_dict["digest"] = self._digest
+        return entry_dict
+
+    def set_values(self, entry_dict):
+        """
+        sets the entry values as stored in the index
+        Parameters:
+        - entry_dict
+          dictionary of the entry values
+        """
+        self._filepath = entry_dict["filepath"]
+        self._timestamp = entry_dict["timestamp"]
+        self._state = entry_dict["state"]
+        self._entry_id = entry_dict["entry_id"]
+        self._chunks = entry_dict.get("chunks")
+        self._digest = entry_dict.get("digest")
+
     def delete_file(self, timestamp):
         """
         deletes the corresponding file
@@ -273,6 +491,52 @@ class CryptStoreEntry(object):
             self._state = FILEINFO_STATE_DELETED
         return flag
 
+class CryptStoreBatch(object):
+    """
+    context manager for a batch of changes in a CryptStore. The
+    batch is committed when the with statement is left, even if an
+    exception was raised, since all collected changes refer to files
+    that were already written.
+    """
+
+    def __init__(self, cryptstore):
+        """
+        creates an instance
+        Parameters:
+        - cryptstore
+          CryptStore instance to use
+        """
+        self._cryptstore = cryptstore
+
+    def __enter__(self):
+        """
+        begins the batch
+        Returns:
+        - CryptStore instance
+        """
+        self._cryptstore.begin_batch()
+        return self._cryptstore
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        commits the batch
+        """
+        self._cryptstore.commit_batch()
+        return False
+
+def create_store_entry(entry_dict):
+    """
+    creates an entry from the values stored in the index
+    Parameters:
+    - entry_dict
+      dictionary of the entry values
+    Returns:
+    - CryptStoreEntry instance
+    """
+    entry = CryptStoreEntry(None, None, None, None)
+    entry.set_values(entry_dict)
+    return entry
+
 class CryptStore(object):
     """
     class to store encrypted files
@@ -291,26 +555,38 @@ class CryptStore(object):
         self._entries = []
         self._entry_dict = {}
         self._max_id = 2
+        self._journal_records = 0
+        self._batch_level = 0
+        self._batch_records = []
+        self._batch_timestamp = None
+        self._obsolete_blobs = []
         self._password = None
         self._password_hash = None
         self._password_timestamp = None
+        self._data_key = None
+        self._pending_key = None
+        self._wrapping_params = None
+        self._wrapping_key = None
+        self._read_only = False
         self._load_password_hash()
 
     def refresh(self):
         """
         reloads the entries
         """
+        self._flush_batch()
         self._entries = []
         self._entry_dict = {}
         self._max_id = 2
-        self._load_entries() 
+        self._journal_records = 0
+        self._load_entries()
 
     def _load_password_hash(self):
         """
         loads the password hash
         """
         destination = self._rootpath
-        fname = "cryptbox.00000000"
+        fname = CRYPTSTORE_PASSWORD_NAME
         filepath = os.path.join(destination, fname)
         try:
             hash_file = open(filepath, "r")
@@ -329,36 +605,48 @@ class CryptStore(object):
         saves the password hash
         """
         destination = self._rootpath
-        fname = "cryptbox.00000000"
+        fname = CRYPTSTORE_PASSWORD_NAME
         filepath = os.path.join(destination, fname)
         try:
-            hash_file = open(filepath, "w")
+            hash_file = open(filepath + ".tmp", "w")
             hash_file.write(self._password_hash)
             hash_file.close()
-        except IOError:
+            os.rename(filepath + ".tmp", filepath)
+        except (IOError, OSError):
             show_error_message("Unable to write %s." % filepath, True)
 
     def _load_entries(self):
         """
-        loads the file entries
+        loads the file entries from the index and replays the journal
         """
-        # decrypt entries file to a temporary file
         key = self.get_key()
-        fname = "cryptbox.00000001"
+        fname = CRYPTSTORE_INDEX_NAME
         srcpath = os.path.join(self._rootpath, fname)
-        if not os.path.isfile(srcpath):
-            # entry file does not exist
-            return
-        tempname = NamedTemporaryFile().name
-        decrypt_file(srcpath, tempname, key)
-        # read decrypted file
+        if os.path.isfile(srcpath):
+            self._load_index(srcpath, key)
+        self._load_journal(key)
+
+    def _load_index(self, srcpath, key):
+        """
+        loads the file entries of the index. The index is decrypted in
+        memory like the journal, so that a cancelled synchronization
+        doesn't interrupt loading it.
+        Parameters:
+        - srcpath
+          path of the encrypted index
+        - key
+          key to decrypt the index
+        """
         line = None
         try:
-            tempfile = open(tempname, "r")
-            line = tempfile.readline()
-            tempfile.close()
+            index_file = open(srcpath, "rb")
+            line = read_encrypted_string(index_file, key)
+            index_file.close()
         except IOError:
-            show_error_message("Unable to read temporary file %s." % tempname, True)
+            show_error_message("Unable to read index %s." % srcpath, True)
+        if line == None:
+            show_error_message("The index %s is incomplete." % srcpath, True)
+            return
         # parse JSON content
         try:
             store_dict = json.loads(line)
@@ -368,24 +656,86 @@ class CryptStore(object):
                 self._entries = []
                 self._entry_dict = {}
                 for entry_dict in entry_list:
-                    filepath = entry_dict["filepath"]
-                    timestamp = entry_dict["timestamp"]
-                    state = entry_dict["state"]
-                    entry_id = entry_dict["entry_id"]
-                    entry = CryptStoreEntry(filepath, timestamp, state, entry_id)
+                    entry = create_store_entry(entry_dict)
                     self._entries.append(entry)
-                    self._entry_dict[unicode(filepath)] = entry
+                    self._entry_dict[unicode(entry.get_filepath())] = entry
         except ValueError:
             show_error_message("Unable to parse entry file.", False)
-        # delete temporary file
+
+    def _load_journal(self, key):
+        """
+        replays the records of the journal on the loaded entries. An
+        incomplete record at the end of the journal (e.g. caused by a
+        crash while appending) is discarded.
+        Parameters:
+        - key
+          key to decrypt the journal records
+        """
+        self._journal_records = 0
+        journalpath = os.path.join(self._rootpath, CRYPTSTORE_JOURNAL_NAME)
+        if not os.path.isfile(journalpath):
+            return
+        valid_size = 0
         try:
-            os.remove(tempname)
-        except OSError:
-            show_error_message("Unable to remove temporary file %s." % tempname)
+            journal_file = open(journalpath, "rb")
+            while True:
+                data = read_encrypted_string(journal_file, key)
+                if data == None:
+                    break
+                try:
+                    record = json.loads(data)
+                except ValueError:
+                    show_error_message("Unable to parse journal record.", False)
+                    break
+                self._apply_record(record)
+                self._journal_records += 1
+                valid_size = journal_file.tell()
+            journal_file.seek(0, os.SEEK_END)
+            journal_size = journal_file.tell()
+            journal_file.close()
+        except IOError:
+            show_error_message("Unable to read journal %s." % journalpath, False)
+            return
+        if journal_size > valid_size and not self._read_only:
+            # remove the incomplete record, so that new records can
+            # be appended
+            try:
+                journal_file = open(journalpath, "r+b")
+                journal_file.truncate(valid_size)
+                journal_file.close()
+            except IOError:
+                show_error_message("Unable to truncate journal %s." % journalpath, False)
+
+    def _apply_record(self, record):
+        """
+        applies a journal record to the entries
+        Parameters:
+        - record
+          dictionary of the journal record
+        """
+        operation = record["op"]
+        if operation == JOURNAL_OP_PUT:
+            entry_dict = record["entry"]
+            filepath = unicode(entry_dict["filepath"])
+            entry = self._entry_dict.get(filepath)
+            if entry == None:
+                entry = create_store_entry(entry_dict)
+                self._entries.append(entry)
+                self._entry_dict[filepath] = entry
+            else:
+                entry.set_values(entry_dict)
+            self._max_id = max(self._max_id, record["max_id"])
+        elif operation == JOURNAL_OP_REMOVE:
+            filepath = unicode(record["filepath"])
+            existing = self._entry_dict.get(filepath)
+            if existing != None:
+                self._entries.remove(existing)
+                del self._entry_dict[filepath]
 
     def _get_password_hash(self, password):
         """
-        computes a hash for a given password
+        computes a hash for a given password. Only stores of earlier
+        versions without a key file are checked with this hash.
         Parameters:
         - password
         Returns:
@@ -410,39 +760,268 @@ class CryptStore(object):
  
     def _save_entries(self):
         """
-        saves the file entries
+        saves all file entries to the index (checkpoint) and resets
+        the journal. The index is replaced atomically, so that an
+        interrupted checkpoint leaves the previous index valid.
         """
-        tempname = NamedTemporaryFile().name
-        # create a JSON dictionary
-        store_dict = {}
-        store_dict["max_id"] = self._max_id
         entry_list = []
         for entry in self._entries:
-            entry_dict = {}
-            entry_dict["filepath"] = entry.get_filepath()
-            entry_dict["timestamp"] = entry.get_timestamp()
-            entry_dict["state"] = entry.get_state()
-            entry_dict["entry_id"] = entry.get_entry_id()
-            entry_list.append(entry_dict)
+            entry_list.append(entry.get_values())
+        destpath = os.path.join(self._rootpath, CRYPTSTORE_INDEX_NAME)
+        self._write_index(destpath + ".tmp", self.get_key(), entry_list)
+        os.rename(destpath + ".tmp", destpath)
+        # the journal is contained in the new index
+        journalpath = os.path.join(self._rootpath, CRYPTSTORE_JOURNAL_NAME)
+        if os.path.exists(journalpath):
+            try:
+                os.remove(journalpath)
+            except OSError:
+                show_error_message("Unable to remove journal %s." % journalpath)
+        self._journal_records = 0
+        # pending changes of a batch are contained in the new index
+        self._batch_records = []
+        self._clear_progress()
+        self._batch_timestamp = time.time()
+        self._remove_obsolete_blobs()
+
+    def _write_index(self, destpath, key, entry_list):
+        """
+        writes an encrypted index. The index is encrypted in memory, so
+        that neither a cancelled synchronization interrupts it nor the
+        plain index is written to a temporary file.
+        Parameters:
+        - destpath
+          path of the file to write
+        - key
+          key to encrypt the index
+        - entry_list
+          list of the dictionaries of the entry values
+        """
+        store_dict = {}
+        store_dict["max_id"] = self._max_id
         store_dict["entries"] = entry_list
         line = json.dumps(store_dict)
-        # crite JSON to temporary file
         try:
-            tempfile = open(tempname, "w")
-            tempfile.write(line)
-            tempfile.close()
+            index_file = open(destpath, "wb")
+            index_file.write(encrypt_string(line, key))
+            index_file.close()
         except IOError:
-            show_error_message("Unable to create temporary file %s." % tempname, True)
-        # copy encrypted temporary file to cryptstore
+            show_error_message("Unable to write index %s." % destpath, True)
+
+    def _append_journal(self, record_list):
+        """
+        appends records to the journal. If the journal grows larger
+        than the index, a checkpoint is written instead.
+        Parameters:
+        - record_list
+          list of record dictionaries to append
+        """
+        count = self._journal_records + len(record_list)
+        if count >= max(CRYPTSTORE_JOURNAL_MIN_CHECKPOINT, len(self._entries)):
+            self._save_entries()
+            return
         key = self.get_key()
-        fname = "cryptbox.00000001"
-        destpath = os.path.join(self._rootpath, fname)
-        encrypt_file(tempname, destpath, key)
-        # delete temporary file
+        datalist = []
+        for record in record_list:
+            datalist.append(encrypt_string(json.dumps(record), key))
+        journalpath = os.path.join(self._rootpath, CRYPTSTORE_JOURNAL_NAME)
         try:
-            os.remove(tempname)
-        except OSError:
-            show_error_message("Unable to remove temporary file %s." % tempname)
+            journal_file = open(journalpath, "ab")
+            journal_file.write("".join(datalist))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+            journal_file.close()
+        except (IOError, OSError):
+            show_error_message("Unable to write journal %s." % journalpath, True)
+        self._journal_records = count
+        self._remove_obsolete_blobs()
+
+    def _journal_put(self, entry):
+        """
+        records a new or changed entry in the journal
+        Parameters:
+        - entry
+          entry to record
+        """
+        record = {}
+        record["op"] = JOURNAL_OP_PUT
+        record["max_id"] = self._max_id
+        record["entry"] = entry.get_values()
+        self._write_records([record])
+
+    def _write_records(self, record_list):
+        """
+        writes journal records. Within a batch the records are
+        collected and written as soon as the configured number of
+        changes or the configured interval is reached. Until then they
+        are kept in the local progress file (see resume()).
+        Parameters:
+        - record_list
+          list of record dictionaries to write
+        """
+        if self._batch_level > 0:
+            self._batch_records.extend(record_list)
+            self._append_progress(record_list)
+            count = len(self._batch_records)
+            interval = time.time() - self._batch_timestamp
+            if count >= self._config.get_index_flush_count() or \
+               interval >= self._config.get_index_flush_interval():
+                self._flush_batch()
+        else:
+            self._append_journal(record_list)
+
+    def _flush_batch(self):
+        """
+        writes the collected records of the current batch
+        """
+        if len(self._batch_records) > 0:
+            record_list = self._batch_records
+            self._batch_records = []
+            self._append_journal(record_list)
+            self._clear_progress()
+        self._batch_timestamp = time.time()
+
+    def _get_progress_path(self):
+        """
+        Returns:
+        - path of the local progress file
+        """
+        return os.path.expanduser(CRYPTSTORE_PROGRESS_FILENAME)
+
+    def _append_progress(self, record_list):
+        """
+        appends records of the current batch to the local progress
+        file. The file is written at once, so that the changes of files
+        that are already encrypted are not lost, if the process is
+        killed before the batch is written to the journal.
+        Parameters:
+        - record_list
+          list of record dictionaries to append
+        """
+        key = self.get_key()
+        datalist = []
+        for record in record_list:
+            progress = {"root": self._rootpath, "record": record}
+            datalist.append(encrypt_string(json.dumps(progress), key))
+        progresspath = self._get_progress_path()
+        try:
+            progress_file = open(progresspath, "ab")
+            progress_file.write("".join(datalist))
+            progress_file.close()
+        except IOError:
+            show_error_message("Unable to write %s." % progresspath)
+
+    def _clear_progress(self):
+        """
+        removes the local progress file after its records were written
+        to the journal
+        """
+        progresspath = self._get_progress_path()
+        if os.path.exists(progresspath):
+            try:
+                os.remove(progresspath)
+            except OSError:
+                show_error_message("Unable to remove %s." % progresspath)
+
+    def _is_progress_valid(self, record):
+        """
+        checks if a record of the progress file can be applied
+        Parameters:
+        - record
+          dictionary of the record
+        Returns:
+        - True:  the record is newer than the entry and the encrypted
+                 data of the file exists
+        - False: the record is obsolete or incomplete
+        """
+        if record.get("op") != JOURNAL_OP_PUT:
+            return False
+        entry_dict = record["entry"]
+        entry = self._entry_dict.get(unicode(entry_dict["filepath"]))
+        if entry != None and entry.get_timestamp() >= entry_dict["timestamp"]:
+            return False
+        if entry_dict["state"] == FILEINFO_STATE_DELETED:
+            return True
+        chunks = entry_dict.get("chunks")
+        if chunks == None:
+            paths = [self._get_blob_path(entry_dict["entry_id"])]
+        else:
+            chunkdir = self._get_chunk_dir()
+            paths = [get_chunk_path(chunkdir, chunk_id) for chunk_id in chunks]
+        for path in paths:
+            if not os.path.isfile(path):
+                return False
+        return True
+
+    def resume(self):
+        """
+        writes the changes of an interrupted batch to the journal. They
+        are read from the local progress file; changes of files whose
+        encrypted data is missing or that were changed by another
+        computer are skipped. Files that were encrypted before the
+        process was killed are not encrypted again.
+        Returns:
+        - number of the changes that were written
+        """
+        if self._password == None:
+            show_error_message("No passort set.", True)
+        progresspath = self._get_progress_path()
+        if not os.path.isfile(progresspath):
+            return 0
+        key = self.get_key()
+        record_list = []
+        try:
+            progress_file = open(progresspath, "rb")
+            while True:
+                data = read_encrypted_string(progress_file, key)
+                if data == None:
+                    break
+                try:
+                    progress = json.loads(data)
+                except ValueError:
+                    break
+                if progress.get("root") != self._rootpath:
+                    continue
+                record = progress["record"]
+                if self._is_progress_valid(record):
+                    self._apply_record(record)
+                    record_list.append(record)
+            progress_file.close()
+        except IOError:
+            show_error_message("Unable to read %s." % progresspath)
+            return 0
+        if len(record_list) > 0:
+            self._append_journal(record_list)
+        self._clear_progress()
+        return len(record_list)
+
+    def begin_batch(self):
+        """
+        starts a batch of changes. Until the batch is committed,
+        changes of the entries are collected and written together.
+        Batches may be nested; the changes are written when the
+        outermost batch is committed.
+        """
+        if self._batch_level == 0:
+            self._batch_timestamp = time.time()
+        self._batch_level += 1
+
+    def commit_batch(self):
+        """
+        commits a batch of changes
+        """
+        if self._batch_level > 0:
+            self._batch_level -= 1
+            if self._batch_level == 0:
+                self._flush_batch()
+
+    def batch(self):
+        """
+        creates a batch to use in a with statement
+        Returns:
+        - CryptStoreBatch instance
+        """
+        return CryptStoreBatch(self)
 
     def get_entry(self, filepath):
         """
@@ -454,7 +1033,7 @@ class CryptStore(object):
         - corresponding file entry
         """
         result = None
-        if filepath in self._entry_dict.keys():
+        if filepath in self._entry_dict:
             result = self._entry_dict[unicode(filepath)]
         return result
 
@@ -465,6 +1044,61 @@ class CryptStore(object):
         """
         return self._entries
 
+    def get_stored_size(self, entry):
+        """
+        determines the size of the encrypted data of an entry
+        Parameters:
+        - entry
+          entry of a file
+        Returns:
+        - number of bytes of the encrypted file or the sum of the sizes
+          of its chunks
+        """
+        result = 0
+        chunks = entry.get_chunks()
+        if chunks == None:
+            paths = [self._get_blob_path(entry.get_entry_id())]
+        else:
+            chunkdir = self._get_chunk_dir()
+            paths = [get_chunk_path(chunkdir, chunk_id) for chunk_id in chunks]
+        for path in paths:
+            try:
+                result += os.path.getsize(path)
+            except OSError:
+                pass
+        return result
+
+    def get_index_size(self):
+        """
+        Returns:
+        - number of bytes of the encrypted index and its journal
+        """
+        result = 0
+        for fname in [CRYPTSTORE_INDEX_NAME, CRYPTSTORE_JOURNAL_NAME]:
+            try:
+                result += os.path.getsize(os.path.join(self._rootpath, fname))
+            except OSError:
+                pass
+        return result
+
+    def set_read_only(self, flag):
+        """
+        sets, if logging in and loading the entries must not change the
+        destination directory. Then an incomplete journal record is not
+        removed and an interrupted rekey is not finished.
+        Parameters:
+        - flag
+          True, if the destination directory must not be changed
+        """
+        self._read_only = flag
+
+    def is_read_only(self):
+        """
+        Returns:
+        - True, if the destination directory must not be changed
+        """
+        return self._read_only
+
     def has_password(self):
         """
         checks, if a password has been set
@@ -476,15 +1110,20 @@ class CryptStore(object):
 
     def check_password(self, password):
         """
-        checks, if a password matches the password of the cryptstore
+        checks, if a password matches the password of the cryptstore.
+        The password matches, if it decrypts the data key of the key
+        file.
         Parameters:
         - True:  password matches
         - False: password doesn't match
         """
         result = False
         if self.has_password():
-            if self._get_password_hash(password) == self._password_hash:
-                result = True
+            keys = self._load_keys()
+            if keys == None:
+                result = self._get_password_hash(password) == self._password_hash
+            else:
+                result = self._unwrap_keys(password, keys)[0] != None
         return result
 
     def check_password_timestamp(self):
@@ -497,7 +1136,7 @@ class CryptStore(object):
         """
         result = True
         destination = self._rootpath
-        fname = "cryptbox.00000000"
+        fname = CRYPTSTORE_PASSWORD_NAME
         filepath = os.path.join(destination, fname)
         try:
             timestamp = os.path.getmtime(filepath)
@@ -507,29 +1146,189 @@ class CryptStore(object):
             result = False
         return result
 
-    def set_new_password(self, password, load_entries=True):
+    def _load_keys(self):
         """
-        sets a new password for the cryptstore
-        Parameters:
+        loads the key file
+        Returns:
+        - dictionary of the key file or None, if the store has no key
+          file
+        """
+        result = None
+        filepath = os.path.join(self._rootpath, CRYPTSTORE_KEYS_NAME)
+        if os.path.exists(filepath):
+            try:
+                keys_file = open(filepath, "r")
+                result = json.load(keys_file)
+                keys_file.close()
+            except (IOError, ValueError):
+                show_error_message("Unable to read %s." % filepath, True)
+        return result
+
+    def _save_keys(self, password, data_key, pending_key=None, commit=False):
+        """
+        saves the data key encrypted with a key derived from a password.
+        The key file is replaced atomically.
+        Parameters:
+        - password
+          password to derive the key encryption key from
+        - data_key
+          key that encrypts the files
+        - pending_key
+          new key of an unfinished rekey or None
+        - commit
+          True, if the files encrypted with the new key of a rekey
+          still have to replace the previous files
+        The password verifier of the new key file is set as password
+        hash; it is written by _save_password_hash().
+        """
+        salt = os.urandom(16)
+        iterations = CRYPTSTORE_KEY_ITERATIONS
+        wrapping_key = derive_key(password, salt, iterations)
+        self._wrapping_params = (password, salt, iterations)
+        self._wrapping_key = wrapping_key
+        wrapped, mac = wrap_key(data_key, wrapping_key)
+        keys = {}
+        keys["version"] = CRYPTSTORE_KEYS_VERSION
+        keys["kdf"] = "pbkdf2-sha256"
+        keys["salt"] = binascii.hexlify(salt)
+        keys["iterations"] = iterations
+        keys["data_key"] = wrapped
+        keys["mac"] = mac
+        if pending_key != None:
+            wrapped, mac = wrap_key(pending_key, wrapping_key)
+            keys["pending_key"] = wrapped
+            keys["pending_mac"] = mac
+        if commit:
+            keys["rekey_commit"] = True
+        filepath = os.path.join(self._rootpath, CRYPTSTORE_KEYS_NAME)
+        try:
+            keys_file = open(filepath + ".tmp", "w")
+            json.dump(keys, keys_file)
+            keys_file.flush()
+            os.fsync(keys_file.fileno())
+            keys_file.close()
+            os.rename(filepath + ".tmp", filepath)
+        except (IOError, OSError):
+            show_error_message("Unable to write %s." % filepath, True)
+        self._password_hash = get_password_verifier(wrapping_key)
+
+    def _derive_wrapping_key(self, password, keys):
+        """
+        derives the key that encrypts the keys of a key file from a
+        password. The last derived key is kept, because the derivation
+        is slow on purpose and a login checks the password before the
+        store is unlocked.
+        Parameters:
+        - password
+          password of the store
+        - keys
+          dictionary of the key file
+        Returns:
+        - derived key
+        """
+        salt = binascii.unhexlify(keys["salt"])
+        params = (password, salt, keys["iterations"])
+        if self._wrapping_params != params:
+            self._wrapping_key = derive_key(password, salt, keys["iterations"])
+            self._wrapping_params = params
+        return self._wrapping_key
+
+    def _unwrap_keys(self, password, keys):
+        """
+        decrypts the keys of a key file
+        Parameters:
+        - password
+          password of the store
+        - keys
+          dictionary of the key file
+        Returns:
+        - tuple of the data key and the pending key of a rekey. The
+          data key is None, if the password is wrong.
+        """
+        wrapping_key = self._derive_wrapping_key(password, keys)
+        legacy = keys.get("version", 1) < CRYPTSTORE_KEYS_VERSION
+        data_key = unwrap_key(keys["data_key"], keys["mac"], wrapping_key, legacy)
+        pending_key = None
+        if data_key != None and keys.has_key("pending_key"):
+            pending_key = unwrap_key(keys["pending_key"], keys["pending_mac"],
+                                     wrapping_key, legacy)
+        return (data_key, pending_key)
+
+    def _unlock(self, password):
+        """
+        determines the data key of the store. Stores without a key file
+        use the normalized password as data key. Such stores and key
+        files of earlier versions are converted, so that no password
+        hash remains that can be attacked by brute force.
+        Parameters:
+        - password
+          password of the store
+        """
+        self._pending_key = None
+        keys = self._load_keys()
+        if keys == None:
+            self._data_key = normalize_key(password)
+        else:
+            self._data_key, self._pending_key = self._unwrap_keys(password, keys)
+            if self._data_key == None:
+                show_error_message("Unable to decrypt the key of the CryptStore.", True)
+            if keys.get("rekey_commit", False):
+                # a rekey was interrupted after the new key was saved
+                if self._read_only:
+                    show_error_message("A rekey has to be finished first. " +
+                                       "Start cryptbox without --plan.", True)
+                self._finish_rekey(password)
+                return
+        if self._read_only:
+            return
+        if keys == None or keys.get("version", 1) < CRYPTSTORE_KEYS_VERSION:
+            self._save_keys(password, self._data_key, self._pending_key)
+            self._save_password_hash()
+            self._load_password_hash()
+
+    def set_new_password(self, password):
+        """
+        sets the password of a new cryptstore. A random data key is
+        created that encrypts the files.
+        Parameters:
         - password 
           new password to set
-        - load_entries
-          flag, if entries should be loaded
         """
         self._password = password
-        self._password_hash = self._get_password_hash(self._password)
+        self._data_key = os.urandom(CRYPTSTORE_KEY_SIZE)
+        self._save_keys(password, self._data_key)
         self._save_password_hash()
-        if load_entries:
-            self._load_entries()
+        self._load_password_hash()
+        self._load_entries()
+
+    def change_password(self, password):
+        """
+        changes the password of the cryptstore. Only the data key is
+        encrypted again with the new password; the files and the index
+        are not changed. A store without a key file keeps the key
+        derived from the previous password as data key.
+        Parameters:
+        - password
+          new password to set
+        """
+        if self._data_key == None:
+            show_error_message("No passort set.", True)
+        # the key file alone decides which password is valid, so an
+        # interruption before the password verifier is written leaves
+        # only the new password valid
+        self._save_keys(password, self._data_key, self._pending_key)
+        self._password = password
+        self._save_password_hash()
+        self._load_password_hash()
 
     def get_key(self):
         """
         Return:
         - key to encrypt or decrypt files
         """
-        if self._password == None:
+        if self._data_key == None:
             show_error_message("No passort set.", True)
-        return normalize_key(self._password)
+        return self._data_key
 
     def set_password(self, password):
         """
@@ -540,35 +1339,122 @@ class CryptStore(object):
         """
         if self.check_password(password):
             self._password = password
+            self._unlock(password)
             self._load_entries()
 
-    def upload_file(self, fileinfo):
+    def _get_upload_id(self, filepath):
         """
-        uploads a file to the store
-        - fileinfo
-          file info of the (local) file to upload
+        determines the id of the entry to upload a file to. For new
+        files a new id is allocated.
+        Parameters:
+        - filepath
+          relative path of the file
+        Returns:
+        - id of the entry
         """
-        # create an entry
-        if self._password == None:
-            show_error_message("No passwort set.", True)
-        # set entry information
-        filepath = fileinfo.get_relative_path()
-        timestamp = fileinfo.get_file_timestamp() 
-        state = FILEINFO_STATE_UPLOADED
-        # check, if entry already exists
-        entry = None
-        if filepath in self._entry_dict.keys():
-            entry = self._entry_dict[unicode(filepath)]
+        entry = self.get_entry(filepath)
+        if entry:
             entry_id = entry.get_entry_id()
         else:
             entry_id = self._max_id
             self._max_id = self._max_id + 1
-        # upload the encrypted file
-        srcpath = fileinfo.get_absolute_path()
-        destname = "cryptbox.%08i" % entry_id
-        destpath = os.path.join(self._rootpath, destname)
-        encrypt_file(srcpath, destpath, self.get_key())
-        # update entry information
+        return entry_id
+
+    def _get_unchanged_digest(self, filepath, chunkdir):
+        """
+        determines the digest of the content of the single encrypted
+        file of an uploaded file. If the content of the file didn't
+        change, its encrypted file is kept, so that an unchanged file
+        is read only once and the destination isn't modified.
+        Parameters:
+        - filepath
+          relative path of the file
+        - chunkdir
+          directory the file is stored to as chunks or None
+        Returns:
+        - digest or None, if the file isn't stored as a single
+          encrypted file
+        """
+        entry = self.get_entry(filepath)
+        if chunkdir != None or entry == None or entry.get_chunks() != None:
+            return None
+        if entry.get_state() == FILEINFO_STATE_DELETED:
+            return None
+        if not os.path.isfile(self._get_blob_path(entry.get_entry_id())):
+            return None
+        return entry.get_digest()
+
+    def _get_blob_path(self, entry_id):
+        """
+        Parameters:
+        - entry_id
+          id of an entry
+        Returns:
+        - path of the encrypted file of the entry
+        """
+        return os.path.join(self._rootpath, "cryptbox.%08i" % entry_id)
+
+    def _get_chunk_dir(self):
+        """
+        Returns:
+        - directory containing the chunks
+        """
+        return os.path.join(self._rootpath, CHUNKSTORE_DIRECTORY_NAME)
+
+    def _get_upload_chunk_dir(self):
+        """
+        Returns:
+        - directory containing the chunks, if uploaded files are
+          stored as chunks, otherwise None
+        """
+        result = None
+        if self._config.get_storage() == STORAGE_CHUNKED:
+            result = self._get_chunk_dir()
+        return result
+
+    def _remove_blob(self, entry):
+        """
+        marks the single encrypted file of an entry that is stored
+        as chunks now for removal. The file is removed after the
+        changed entry was written.
+        Parameters:
+        - entry
+          entry of the file
+        """
+        self._obsolete_blobs.append(self._get_blob_path(entry.get_entry_id()))
+
+    def _remove_obsolete_blobs(self):
+        """
+        removes the single encrypted files that were replaced by
+        chunks
+        """
+        for blobpath in self._obsolete_blobs:
+            if os.path.exists(blobpath):
+                try:
+                    os.remove(blobpath)
+                except OSError:
+                    show_error_message("Unable to delete %s." % blobpath)
+        self._obsolete_blobs = []
+
+    def _finish_upload(self, fileinfo, entry_id, timestamp, chunks=None, digest=None):
+        """
+        updates the entry of a file after the file was encrypted
+        Parameters:
+        - fileinfo
+          file info of the uploaded file
+        - entry_id
+          id of the entry
+        - timestamp
+          timestamp of the uploaded file
+        - chunks
+          list of the ids of the chunks of the file or None, if the
+          file was stored as a single file
+        - digest
+          digest of the content of the file
+        """
+        filepath = fileinfo.get_relative_path()
+        state = FILEINFO_STATE_UPLOADED
+        entry = self.get_entry(filepath)
         if entry == None:
             entry = CryptStoreEntry(filepath, timestamp, state, entry_id)
             self._entries.append(entry)
@@ -576,10 +1462,183 @@ class CryptStore(object):
         else:
             entry.set_timestamp(timestamp)
             entry.set_state(state)
-        self._save_entries()
+            if chunks != None and entry.get_chunks() == None:
+                self._remove_blob(entry)
+        entry.set_chunks(chunks)
+        entry.set_digest(digest)
+        self._journal_put(entry)
         # update file info
         fileinfo.update_state(state, timestamp)
 
+    def upload_file(self, fileinfo):
+        """
+        uploads a file to the store
+        - fileinfo
+          file info of the (local) file to upload
+        """
+        if self._password == None:
+            show_error_message("No passwort set.", True)
+        filepath = fileinfo.get_relative_path()
+        timestamp = fileinfo.get_file_timestamp()
+        entry_id = self._get_upload_id(filepath)
+        # upload the encrypted file
+        srcpath = fileinfo.get_absolute_path()
+        destpath = self._get_blob_path(entry_id)
+        chunkdir = self._get_upload_chunk_dir()
+        chunks, digest = store_file(srcpath, destpath, chunkdir, self.get_key(),
+                                    self._get_upload_codec(),
+                                    self._get_unchanged_digest(filepath, chunkdir))
+        self._finish_upload(fileinfo, entry_id, timestamp, chunks, digest)
+
+    def upload_files(self, fileinfos, workers=None):
+        """
+        uploads several files to the store. The files are encrypted
+        in parallel by a pool of worker processes, while the ids and
+        the entries are managed by the current process.
+        Parameters:
+        - fileinfos
+          iterable of file infos of the (local) files to upload
+        - workers
+          number of worker processes (None: use the configured value)
+        Returns:
+        - generator of tuples (fileinfo, flag) for each file; flag
+          is True if the file was uploaded
+        """
+        if self._password == None:
+            show_error_message("No passwort set.", True)
+        if workers == None:
+            workers = self._config.get_workers()
+        key = self.get_key()
+        pool = WorkerPool(workers)
+        try:
+            jobs = self._create_upload_jobs(fileinfos, key, self._get_parallel_file_size(pool))
+            results = combine_results(pool.run_jobs(jobs), self._finish_upload_parts,
+                                      self._abort_upload_parts)
+            for item, result, error in results:
+                fileinfo, entry_id, timestamp = item
+                if error:
+                    relpath = fileinfo.get_relative_path()
+                    if not is_cancelled():
+                        show_error_message("Unable to upload %s:\n%s" % (relpath, error))
+                    yield (fileinfo, False)
+                else:
+                    chunks, digest = result
+                    self._finish_upload(fileinfo, entry_id, timestamp, chunks, digest)
+                    yield (fileinfo, True)
+            pool.close()
+        finally:
+            pool.terminate()
+
+    def _get_parallel_file_size(self, pool):
+        """
+        determines the size from which a single file is encrypted or
+        decrypted by several worker processes
+        Parameters:
+        - pool
+          WorkerPool that executes the jobs
+        Returns:
+        - size in bytes or None, if files are not split
+        """
+        result = None
+        size = self._config.get_parallel_file_size()
+        if pool.get_size() > 1 and size > 0:
+            result = size * 1024 * 1024
+        return result
+
+    def _get_upload_codec(self):
+        """
+        Returns:
+        - codec to compress uploaded single encrypted files
+        """
+        compression = self._config.get_compression()
+        if not BLOB_CODEC_NAMES.has_key(compression):
+            show_error_message("Compression %s is not available." % compression)
+            compression = COMPRESSION_NONE
+        return BLOB_CODEC_NAMES[compression]
+
+    def _create_upload_jobs(self, fileinfos, key, parallel_size=None):
+        """
+        creates the jobs to encrypt files. Files that are stored as
+        single encrypted files and are larger than parallel_size are
+        split into several jobs, unless they are compressed.
+        Parameters:
+        - fileinfos
+          iterable of file infos of the files to upload
+        - key
+          key to encrypt the files
+        - parallel_size
+          size from which files are split or None
+        Returns:
+        - generator of jobs for WorkerPool.run_jobs()
+        """
+        chunkdir = self._get_upload_chunk_dir()
+        codec = self._get_upload_codec()
+        for fileinfo in fileinfos:
+            timestamp = fileinfo.get_file_timestamp()
+            entry_id = self._get_upload_id(fileinfo.get_relative_path())
+            srcpath = fileinfo.get_absolute_path()
+            destpath = self._get_blob_path(entry_id)
+            item = (fileinfo, entry_id, timestamp)
+            jobs = None
+            if chunkdir == None and parallel_size != None:
+                try:
+                    if (os.path.getsize(srcpath) >= parallel_size
+                        and sample_file_codec(srcpath, codec) == BLOB_CODEC_NONE):
+                        jobs = create_store_jobs(srcpath, destpath, key, CRYPTSTORE_PART_SIZE)
+                except (IOError, OSError):
+                    # the error is reported by a job for the whole file
+                    jobs = None
+            if not jobs:
+                unchanged_digest = self._get_unchanged_digest(fileinfo.get_relative_path(), chunkdir)
+                yield ((item, JOB_ITEM), store_file,
+                       (srcpath, destpath, chunkdir, key, codec, unchanged_digest))
+            else:
+                for function, args in jobs[:-1]:
+                    yield ((item, JOB_PART), function, args)
+                function, args = jobs[-1]
+                yield ((item, JOB_LAST_PART), function, args)
+
+    def _finish_upload_parts(self, item, results):
+        """
+        completes a file that was encrypted by several jobs
+        Parameters:
+        - item
+          tuple (fileinfo, entry_id, timestamp) of the file
+        - results
+          results of the jobs of create_store_jobs()
+        Returns:
+        - tuple of None and the digest of the content
+        """
+        fileinfo, entry_id, timestamp = item
+        unchanged_digest = self._get_unchanged_digest(fileinfo.get_relative_path(), None)
+        return finish_store(fileinfo.get_absolute_path(), self._get_blob_path(entry_id),
+                            timestamp, results[0], unchanged_digest)
+
+    def _abort_upload_parts(self, item):
+        """
+        removes the incomplete file of a file that was encrypted by
+        several jobs
+        Parameters:
+        - item
+          tuple (fileinfo, entry_id, timestamp) of the file
+        """
+        remove_partial_file(self._get_blob_path(item[1]) + PARTIAL_SUFFIX)
+
+    def update_timestamp(self, fileinfo):
+        """
+        updates the timestamp of the entry of a file whose content
+        didn't change
+        Parameters:
+        - fileinfo
+          file info of the (local) file
+        """
+        entry = self.get_entry(fileinfo.get_relative_path())
+        timestamp = fileinfo.get_file_timestamp()
+        entry.set_timestamp(timestamp)
+        entry.set_state(FILEINFO_STATE_UPLOADED)
+        self._journal_put(entry)
+        fileinfo.update_state(FILEINFO_STATE_UPLOADED, timestamp)
+
     def download_file(self, entry, rootpath):
         """
         downloads a file
@@ -593,21 +1652,167 @@ class CryptStore(object):
             show_error_message("No passort set.", True)
         # create source path
         entry_id = entry.get_entry_id()
-        srcname = "cryptbox.%08i" % entry_id
-        srcpath = os.path.join(self._rootpath, srcname)
+        srcpath = self._get_blob_path(entry_id)
         # create destination path
         destpath = os.path.join(rootpath, entry.get_filepath())
         # download the file
         flag = create_path(destpath)
         if not flag:
             show_error_message("Unable to create directory path %s." % destpath, True)
-        decrypt_file(srcpath, destpath, self.get_key())
+        restore_file(srcpath, self._get_chunk_dir(), entry.get_chunks(),
+                     destpath, self.get_key(), entry.get_timestamp())
         # update file info
         fileinfo = FileInfo(rootpath, destpath)
+        self._finish_download(fileinfo)
+
+    def _finish_download(self, fileinfo):
+        """
+        updates the state of a file after it was downloaded
+        Parameters:
+        - fileinfo
+          file info of the downloaded file
+        """
         timestamp = time.time()
         state = FILEINFO_STATE_DOWNLOADED
         fileinfo.update_state(state, timestamp)
 
+    def download_files(self, downloads, rootpath, workers=None):
+        """
+        downloads several files. The files are decrypted in parallel
+        by a pool of worker processes, while directories and file
+        states are managed by the current process.
+        Parameters:
+        - downloads
+          iterable of tuples (entry, fileinfo) of the files to
+          download. fileinfo is the FileInfo instance of the local
+          file or None.
+        - rootpath
+          root path of the destination to copy the files to
+        - workers
+          number of worker processes (None: use the configured value)
+        Returns:
+        - generator of tuples (entry, flag) for each file; flag is
+          True if the file was downloaded
+        """
+        if self._password == None:
+            show_error_message("No passort set.", True)
+        if workers == None:
+            workers = self._config.get_workers()
+        key = self.get_key()
+        pool = WorkerPool(workers)
+        try:
+            jobs = self._create_download_jobs(downloads, rootpath, key,
+                                              self._get_parallel_file_size(pool))
+            results = combine_results(pool.run_jobs(jobs), self._finish_download_parts,
+                                      self._abort_download_parts)
+            for item, result, error in results:
+                entry, fileinfo, destpath = item
+                if error:
+                    relpath = entry.get_filepath()
+                    if not is_cancelled():
+                        show_error_message("Unable to download %s:\n%s" % (relpath, error))
+                    yield (entry, False)
+                else:
+                    if fileinfo == None:
+                        fileinfo = FileInfo(rootpath, destpath)
+                    self._finish_download(fileinfo)
+                    yield (entry, True)
+            pool.close()
+        finally:
+            pool.terminate()
+
+    def _create_download_jobs(self, downloads, rootpath, key, parallel_size=None):
+        """
+        creates the jobs to decrypt files. The directories of the
+        files are created once for each directory. Single encrypted
+        files that are larger than parallel_size are split into several
+        jobs.
+        Parameters:
+        - downloads
+          iterable of tuples (entry, fileinfo) of the files to
+          download
+        - rootpath
+          root path of the destination to copy the files to
+        - key
+          key to decrypt the files
+        - parallel_size
+          size from which files are split or None
+        Returns:
+        - generator of jobs for WorkerPool.run_jobs()
+        """
+        directories = set()
+        chunkdir = self._get_chunk_dir()
+        for entry, fileinfo in downloads:
+            srcpath = self._get_blob_path(entry.get_entry_id())
+            destpath = os.path.join(rootpath, entry.get_filepath())
+            dirpath = os.path.dirname(destpath)
+            if not dirpath in directories:
+                if not create_path(destpath):
+                    show_error_message("Unable to create directory path %s." % destpath)
+                    continue
+                directories.add(dirpath)
+            item = (entry, fileinfo, destpath)
+            jobs = None
+            if entry.get_chunks() == None and parallel_size != None:
+                try:
+                    if os.path.getsize(srcpath) >= parallel_size:
+                        jobs = create_restore_jobs(srcpath, destpath, key, CRYPTSTORE_PART_SIZE)
+                except (IOError, OSError):
+                    # the error is reported by a job for the whole file
+                    jobs = None
+            if not jobs:
+                args = (srcpath, chunkdir, entry.get_chunks(), destpath, key,
+                        entry.get_timestamp())
+                yield ((item, JOB_ITEM), restore_file, args)
+            else:
+                for function, args in jobs[:-1]:
+                    yield ((item, JOB_PART), function, args)
+                function, args = jobs[-1]
+                yield ((item, JOB_LAST_PART), function, args)
+
+    def _finish_download_parts(self, item, results):
+        """
+        completes a file that was decrypted by several jobs
+        Parameters:
+        - item
+          tuple (entry, fileinfo, destpath) of the file
+        - results
+          results of the jobs of create_restore_jobs()
+        """
+        entry, fileinfo, destpath = item
+        finish_restore(self._get_blob_path(entry.get_entry_id()), destpath)
+
+    def _abort_download_parts(self, item):
+        """
+        removes the incomplete file of a file that was decrypted by
+        several jobs
+        Parameters:
+        - item
+          tuple (entry, fileinfo, destpath) of the file
+        """
+        remove_partial_file(item[2] + PARTIAL_SUFFIX)
+
+    def open_entry(self, entry):
+        """
+        opens the content of a stored file for reading with random
+        access. Only the segments or chunks containing the bytes that
+        are read are decrypted, so reading a part of a large file
+        doesn't decrypt the whole file.
+        Parameters:
+        - entry
+          entry of the file
+        Returns:
+        - file-like object with read(), seek(), tell() and close()
+        """
+        if self._password == None:
+            show_error_message("No passort set.", True)
+        if entry.get_chunks() == None:
+            blobpath = self._get_blob_path(entry.get_entry_id())
+            result = open_encrypted_file(blobpath, self.get_key())
+        else:
+            result = ChunkedFile(self._get_chunk_dir(), entry.get_chunks(), self.get_key())
+        return result
+
     def delete_file(self, entry):
         """
         deletes a file
@@ -617,7 +1822,7 @@ class CryptStore(object):
         """
         flag = entry.delete_file(time.time())
         if flag:
-            self._save_entries()
+            self._journal_put(entry)
 
     def purge(self):
         """
@@ -632,16 +1837,17 @@ class CryptStore(object):
             if entry.get_state() == FILEINFO_STATE_DELETED: 
                 entry_path = entry.get_filepath()
                 success = True
-                # create full file path
-                entry_id = entry.get_entry_id()
-                filename = "cryptbox.%08i" % entry_id
-                filepath = os.path.join(self._rootpath, filename)
-                # delete file
-                try:
-                    os.remove(filepath)
-                except OSError:
-                    show_error_message("Unable to delete %s." % filepath)
-                    success = False
+                if entry.get_chunks() == None:
+                    # create full file path
+                    entry_id = entry.get_entry_id()
+                    filename = "cryptbox.%08i" % entry_id
+                    filepath = os.path.join(self._rootpath, filename)
+                    # delete file
+                    try:
+                        os.remove(filepath)
+                    except OSError:
+                        show_error_message("Unable to delete %s." % filepath)
+                        success = False
                 if success:
                     # remove meta infomation
                     del self._entries[index]
@@ -651,5 +1857,344 @@ class CryptStore(object):
                 index += 1
         if len(result) > 0:
             self._save_entries()
+        # delete chunks that are not used anymore
+        used_ids = set()
+        for entry in self._entries:
+            chunks = entry.get_chunks()
+            if chunks != None:
+                used_ids.update(chunks)
+        remove_unused_chunks(self._get_chunk_dir(), used_ids)
+        return result
+
+    def remove_orphans(self):
+        """
+        removes encrypted files in the destination directory that
+        don't belong to any entry, e.g. files of an interrupted upload
+        or files that were replaced by chunks. Only files older than
+        CRYPTSTORE_ORPHAN_MIN_AGE are removed; their age is determined
+        by get_change_time(), since an encrypted file gets the
+        modification time of the file it contains. The chunks are
+        removed by purge().
+        Returns:
+        - list of the names of the removed files
+        """
+        result = []
+        used_names = set([CRYPTSTORE_PASSWORD_NAME, CRYPTSTORE_INDEX_NAME])
+        for entry in self._entries:
+            if entry.get_chunks() == None:
+                used_names.add(os.path.basename(self._get_blob_path(entry.get_entry_id())))
+        min_timestamp = time.time() - CRYPTSTORE_ORPHAN_MIN_AGE
+        for fname in sorted(os.listdir(self._rootpath)):
+            if fname in used_names or not CRYPTSTORE_BLOB_PATTERN.match(fname):
+                continue
+            filepath = os.path.join(self._rootpath, fname)
+            try:
+                if os.path.isfile(filepath) and get_change_time(filepath) < min_timestamp:
+                    os.remove(filepath)
+                    result.append(fname)
+            except OSError:
+                show_error_message("Unable to delete %s." % filepath)
+        return result
+
+    def migrate_to_chunks(self, workers=None):
+        """
+        converts all files that are stored as single encrypted files
+        into chunks
+        Parameters:
+        - workers
+          number of worker processes (None: use the configured value)
+        Returns:
+        - generator of tuples (entry, flag) for each converted file;
+          flag is True if the file was converted
+        """
+        if self._password == None:
+            show_error_message("No passort set.", True)
+        if workers == None:
+            workers = self._config.get_workers()
+        key = self.get_key()
+        chunkdir = self._get_chunk_dir()
+        jobs = []
+        for entry in self._entries:
+            if entry.get_chunks() == None and entry.get_state() != FILEINFO_STATE_DELETED:
+                blobpath = self._get_blob_path(entry.get_entry_id())
+                jobs.append((entry, (blobpath, chunkdir, key)))
+        pool = WorkerPool(workers)
+        try:
+            with self.batch():
+                for entry, result, error in pool.run(convert_to_chunks, jobs):
+                    if error:
+                        relpath = entry.get_filepath()
+                        if not is_cancelled():
+                            show_error_message("Unable to convert %s:\n%s" % (relpath, error))
+                        yield (entry, False)
+                    else:
+                        chunks, digest = result
+                        entry.set_chunks(chunks)
+                        entry.set_digest(digest)
+                        self._journal_put(entry)
+                        self._remove_blob(entry)
+                        yield (entry, True)
+            pool.close()
+        finally:
+            pool.terminate()
+
+
+    def _get_rekey_path(self):
+        """
+        Returns:
+        - path of the checkpoint of a rekey
+        """
+        return os.path.join(self._rootpath, CRYPTSTORE_REKEY_NAME)
+
+    def _get_rekey_items(self):
+        """
+        determines the files and chunks that have to be encrypted with
+        a new key
+        Returns:
+        - tuple of the list of the ids of the entries that are stored
+          as single encrypted files and the set of the ids of the
+          chunks
+        """
+        entry_ids = []
+        chunk_ids = set()
+        for entry in self._entries:
+            chunks = entry.get_chunks()
+            if chunks == None:
+                entry_ids.append(entry.get_entry_id())
+            else:
+                chunk_ids.update(chunks)
+        return (entry_ids, chunk_ids)
+
+    def _is_blob_rekeyed(self, entry_id):
+        """
+        checks, if the single encrypted file of an entry was encrypted
+        with the new key. The file encrypted with the new key has the
+        modification time of the current file (which may be truncated
+        to microseconds).
+        Parameters:
+        - entry_id
+          id of the entry
+        Returns:
+        - True:  the file was encrypted with the new key
+        - False: the file has to be encrypted with the new key
+        """
+        result = False
+        blobpath = self._get_blob_path(entry_id)
+        rekeypath = blobpath + CRYPTSTORE_REKEY_SUFFIX
+        try:
+            mtime = os.path.getmtime(blobpath)
+            result = abs(os.path.getmtime(rekeypath) - mtime) < 0.001
+        except OSError:
+            result = False
+        return result
+
+    def _get_metadata_state(self):
+        """
+        Returns:
+        - tuple of the sizes and modification times of the index and
+          the journal, which changes when another computer writes
+          either of them
+        """
+        result = []
+        for fname in [CRYPTSTORE_INDEX_NAME, CRYPTSTORE_JOURNAL_NAME]:
+            try:
+                st = os.stat(os.path.join(self._rootpath, fname))
+                result.append((st.st_size, st.st_mtime))
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    def _load_rekey_checkpoint(self):
+        """
+        loads the chunks that were encrypted with the new key
+        Returns:
+        - dictionary that maps the ids of the chunks to their new ids
+        """
+        result = {}
+        rekeypath = self._get_rekey_path()
+        if os.path.exists(rekeypath):
+            try:
+                rekey_file = open(rekeypath, "r")
+                for line in rekey_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # incomplete record of an interrupted rekey
+                        continue
+                    result[record["chunk"]] = record["new"]
+                rekey_file.close()
+            except IOError:
+                show_error_message("Unable to read %s." % rekeypath, True)
         return result
 
+    def _discard_rekey(self):
+        """
+        removes the files of an unfinished rekey whose key is lost
+        """
+        suffixes = (CRYPTSTORE_REKEY_SUFFIX, CRYPTSTORE_REKEY_SUFFIX + PARTIAL_SUFFIX)
+        for fname in os.listdir(self._rootpath):
+            if fname == CRYPTSTORE_REKEY_NAME or fname.endswith(suffixes):
+                filepath = os.path.join(self._rootpath, fname)
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    show_error_message("Unable to delete %s." % filepath)
+
+    def rekey(self, workers=None):
+        """
+        encrypts all files and chunks in the destination directory with
+        a new data key. The files are decrypted and encrypted again in
+        a single pass by a pool of worker processes and written next to
+        the current files, which stay valid until commit_rekey()
+        replaces them. An interrupted rekey continues with the files
+        and chunks that aren't encrypted with the new key yet. The
+        local files are not changed.
+        Parameters:
+        - workers
+          number of worker processes (None: use the configured value)
+        Returns:
+        - generator of tuples (name, flag) for each file or chunk; flag
+          is True if it was encrypted with the new key
+        """
+        if self._password == None:
+            show_error_message("No passort set.", True)
+        if workers == None:
+            workers = self._config.get_workers()
+        old_key = self.get_key()
+        if self._pending_key == None:
+            self._discard_rekey()
+            self._pending_key = os.urandom(CRYPTSTORE_KEY_SIZE)
+            self._save_keys(self._password, old_key, self._pending_key)
+        new_key = self._pending_key
+        entry_ids, chunk_ids = self._get_rekey_items()
+        chunk_map = self._load_rekey_checkpoint()
+        chunkdir = self._get_chunk_dir()
+        rekeypath = self._get_rekey_path()
+        try:
+            rekey_file = open(rekeypath, "a")
+        except IOError:
+            show_error_message("Unable to write %s." % rekeypath, True)
+        pool = WorkerPool(workers)
+        try:
+            jobs = []
+            for entry_id in entry_ids:
+                if not self._is_blob_rekeyed(entry_id):
+                    blobpath = self._get_blob_path(entry_id)
+                    args = (blobpath, blobpath + CRYPTSTORE_REKEY_SUFFIX, old_key, new_key)
+                    jobs.append((os.path.basename(blobpath), args))
+            for name, result, error in pool.run(rekey_blob, jobs):
+                if error:
+                    if not is_cancelled():
+                        show_error_message("Unable to rekey %s:\n%s" % (name, error))
+                    yield (name, False)
+                else:
+                    yield (name, True)
+            jobs = []
+            for chunk_id in sorted(chunk_ids):
+                if not chunk_map.has_key(chunk_id):
+                    jobs.append((chunk_id, (chunkdir, chunk_id, old_key, new_key)))
+            for chunk_id, result, error in pool.run(transcode_chunk, jobs):
+                if error:
+                    if not is_cancelled():
+                        show_error_message("Unable to rekey chunk %s:\n%s" % (chunk_id, error))
+                    yield (chunk_id, False)
+                else:
+                    rekey_file.write(json.dumps({"chunk": chunk_id, "new": result}) + "\n")
+                    rekey_file.flush()
+                    yield (chunk_id, True)
+            pool.close()
+        finally:
+            pool.terminate()
+            rekey_file.close()
+
+    def commit_rekey(self):
+        """
+        replaces the files in the destination directory by the files
+        encrypted with the new key, if rekey() encrypted all files and
+        chunks. The new key is saved before the files are replaced; if
+        replacing is interrupted, it is finished by the next login.
+        The index and the journal are loaded again first, because other
+        computers may have uploaded files while rekey() was running. If
+        they change while the new index is written, the commit is
+        abandoned as well.
+        Returns:
+        - True:  the store is encrypted with the new key
+        - False: the rekey is not complete; rekey() has to encrypt the
+          files and chunks that were added meanwhile
+        """
+        if self._pending_key == None:
+            return False
+        self.refresh()
+        metadata = self._get_metadata_state()
+        entry_ids, chunk_ids = self._get_rekey_items()
+        chunk_map = self._load_rekey_checkpoint()
+        for entry_id in entry_ids:
+            if not self._is_blob_rekeyed(entry_id):
+                return False
+        for chunk_id in chunk_ids:
+            if not chunk_map.has_key(chunk_id):
+                return False
+        # write the index with the new key and the new ids of the chunks
+        entry_list = []
+        for entry in self._entries:
+            entry_dict = entry.get_values()
+            if entry.get_chunks() != None:
+                entry_dict["chunks"] = [chunk_map[chunk_id] for chunk_id in entry.get_chunks()]
+            entry_list.append(entry_dict)
+        indexpath = os.path.join(self._rootpath, CRYPTSTORE_INDEX_NAME)
+        self._write_index(indexpath + CRYPTSTORE_REKEY_SUFFIX, self._pending_key, entry_list)
+        if self._get_metadata_state() != metadata:
+            remove_partial_file(indexpath + CRYPTSTORE_REKEY_SUFFIX)
+            return False
+        self._save_keys(self._password, self._pending_key, None, True)
+        self._data_key = self._pending_key
+        self._pending_key = None
+        self._finish_rekey(self._password)
+        self.refresh()
+        return True
+
+    def _finish_rekey(self, password):
+        """
+        replaces the files in the destination directory by the files
+        encrypted with the new key after the new key was saved. The
+        steps may be repeated, if they were interrupted.
+        Parameters:
+        - password
+          password of the store
+        """
+        indexpath = os.path.join(self._rootpath, CRYPTSTORE_INDEX_NAME)
+        journalpath = os.path.join(self._rootpath, CRYPTSTORE_JOURNAL_NAME)
+        try:
+            if os.path.exists(indexpath + CRYPTSTORE_REKEY_SUFFIX):
+                os.rename(indexpath + CRYPTSTORE_REKEY_SUFFIX, indexpath)
+            # the journal is contained in the new index
+            if os.path.exists(journalpath):
+                os.remove(journalpath)
+            for fname in os.listdir(self._rootpath):
+                if fname.endswith(CRYPTSTORE_REKEY_SUFFIX) and fname != CRYPTSTORE_REKEY_NAME:
+                    filepath = os.path.join(self._rootpath, fname)
+                    os.rename(filepath, filepath[:-len(CRYPTSTORE_REKEY_SUFFIX)])
+        except OSError:
+            show_error_message("Unable to replace the files of the CryptStore.", True)
+        # remove the chunks encrypted with the previous key
+        chunk_map = self._load_rekey_checkpoint()
+        new_ids = set(chunk_map.values())
+        chunkdir = self._get_chunk_dir()
+        for chunk_id in chunk_map.keys():
+            chunkpath = get_chunk_path(chunkdir, chunk_id)
+            if not chunk_id in new_ids and os.path.exists(chunkpath):
+                try:
+                    os.remove(chunkpath)
+                except OSError:
+                    show_error_message("Unable to delete %s." % chunkpath)
+        rekeypath = self._get_rekey_path()
+        if os.path.exists(rekeypath):
+            try:
+                os.remove(rekeypath)
+            except OSError:
+                show_error_message("Unable to remove %s." % rekeypath)
+        self._clear_progress()
+        self._save_keys(password, self._data_key)
+        # other computers login again to load the new key
+        self._save_password_hash()
+        self._load_password_hash()
@@ -0,0 +1,151 @@
+# cryptbox - cache of the digests of local files
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import json
+import os
+import os.path
+
+from crypthelper import *
+
+class DigestCache(object):
+    """
+    class to cache the digests of the content of local files. A
+    cached digest is valid as long as inode, size and modification
+    time of the file are unchanged.
+    """
+
+    def __init__(self):
+        """
+        creates an instance
+        """
+        self._filepath = os.path.expanduser("~/.cryptbox.digests")
+        self._digests = None
+        self._modified = False
+
+    def _load(self):
+        """
+        loads the cache file
+        """
+        self._digests = {}
+        if os.path.exists(self._filepath):
+            try:
+                cache_file = open(self._filepath, "r")
+                self._digests = json.load(cache_file)
+                cache_file.close()
+            except (IOError, ValueError):
+                print "Unable to read: %s" % self._filepath
+                self._digests = {}
+
+    def save(self):
+        """
+        saves the cache file, if it was modified
+        """
+        if not self._modified:
+            return
+        temppath = self._filepath + ".tmp"
+        try:
+            cache_file = open(temppath, "w")
+            json.dump(self._digests, cache_file)
+            cache_file.close()
+            os.rename(temppath, self._filepath)
+            self._modified = False
+        except (IOError, OSError):
+            print "Unable to write: %s" % self._filepath
+
+    def get_digest(self, fileinfo):
+        """
+        returns the cached digest of a file
+        Parameters:
+        - fileinfo
+          scanned file info of the file
+        Returns:
+        - digest or None, if the digest is not cached or outdated
+        """
+        if self._digests == None:
+            self._load()
+        result = None
+        relpath = fileinfo.get_relative_path()
+        value = self._digests.get(relpath)
+        if value != None:
+            inode, size, timestamp, digest = value
+            if inode == fileinfo.get_inode() and \
+               size == fileinfo.get_size() and \
+               timestamp == fileinfo.get_file_timestamp():
+                result = digest
+        return result
+
+    def set_digest(self, fileinfo, digest):
+        """
+        caches the digest of a file
+        Parameters:
+        - fileinfo
+          scanned file info of the file. inode, size and timestamp
+          must be scanned before the digest was computed.
+        - digest
+          digest to cache
+        """
+        if self._digests == None:
+            self._load()
+        relpath = fileinfo.get_relative_path()
+        value = [fileinfo.get_inode(), fileinfo.get_size(),
+                 fileinfo.get_file_timestamp(), digest]
+        self._digests[relpath] = value
+        self._modified = True
+
+    def remove_digest(self, relpath):
+        """
+        removes the cached digest of a file, e.g. of a deleted file
+        Parameters:
+        - relpath
+          relative path of the file
+        """
+        if self._digests == None:
+            self._load()
+        if self._digests.has_key(relpath):
+            del self._digests[relpath]
+            self._modified = True
+
+    def retain(self, relpaths):
+        """
+        removes the cached digests of all files except the given ones
+        Parameters:
+        - relpaths
+          set of the relative paths of the files as UTF-8 encoded
+          strings
+        """
+        if self._digests == None:
+            self._load()
+        for relpath in self._digests.keys():
+            key = relpath
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            if not key in relpaths:
+                del self._digests[relpath]
+                self._modified = True
+
+    def compute_digest(self, fileinfo):
+        """
+        returns the digest of a file. The digest is computed, if it
+        is not cached.
+        Parameters:
+        - fileinfo
+          scanned file info of the file
+        Returns:
+        - digest of the content of the file
+        """
+        result = self.get_digest(fileinfo)
+        if result == None:
+            result = compute_file_digest(fileinfo.get_absolute_path())
+            self.set_digest(fileinfo, result)
+        return result
@@ -12,91 +12,337 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-import glob
+import heapq
 import os
 import os.path
-import re
+import stat
+import threading
+
+from multiprocessing.pool import ThreadPool
 
 from fileinfo import *
+from ignorerules import *
+
+# number of directory listings per thread that are read in advance by a
+# parallel scan
+SCAN_PREFETCH_PER_THREAD = 64
 
-# Regular expressions for temporary lock files
-TEMP_PATTERNS = ["'\..+\.swp", ".+\.lock", "\.~lock\..+#"]
+def get_ancestors(ancestors, st):
+    """
+    adds a directory to the set of the directories containing a path
+    Parameters:
+    - ancestors
+      set of the (st_dev, st_ino) tuples of the parent directories
+    - st
+      stat result of the directory
+    Returns:
+    - new set including the (st_dev, st_ino) tuple of the directory
+    """
+    return ancestors | frozenset([(st.st_dev, st.st_ino)])
 
 class DirScanner(object):
     """
     class to scan the source directory
     """
 
-    def __init__(self, rootpath):
+    def __init__(self, rootpath, threads=1):
         """
         creates an instance
         Parameters:
         - rootpath
           path of the root to scen
+        - threads
+          number of threads that read directories in parallel. 1
+          scans serially.
         """
-        self._pattern_list = self._init_patterns(TEMP_PATTERNS)
-        self._list = FileInfoList()
+        self._rules = IgnoreRules(rootpath)
+        self._list = None
         self._rootpath = rootpath
-        self._scan(self._rootpath)
+        self._threads = max(threads, 1)
+        self._pool = None
+        self._pending = {}
+        self._ancestors = {}
+        self._queue = []
+        self._prefetch_lock = threading.Condition()
 
-    def _init_patterns(self, pattern_list):
+    def _list_directory(self, path, ancestors=frozenset()):
         """
-        initializes the list of patterns for identifying
-        temporary lock files
+        reads the entries of a directory. Each entry is examined with a
+        single lstat call; only symbolic links are resolved with an
+        additional stat call. Ignored entries are skipped, so ignored
+        directories are not read at all. Subdirectories that are the
+        directory itself or one of its parents (e.g. reached by a
+        symbolic link) are skipped, so that the scan doesn't loop.
         Parameters:
-        - pattern list
-          list of regular expressions
+        - path
+          path of the directory
+        - ancestors
+          set of the (st_dev, st_ino) tuples of the directory and its
+          parent directories
         Returns:
-        - list of pattern instances
+        - list of tuples (sortkey, path, stat result, directory flag)
+          sorted by the sortkey. The sortkey of a directory ends with a
+          slash, so that the entries are sorted like relative paths.
         """
         result = []
-        for pattern_string in pattern_list:
-            p = re.compile(pattern_string)
-            result.append(p)
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return result
+        reldir = path[len(self._rootpath):].lstrip("/")
+        self._rules.load_directory(reldir, names)
+        for name in names:
+            entrypath = os.path.join(path, name)
+            relpath = os.path.join(reldir, name)
+            if self._rules.match(relpath, False) and self._rules.match(relpath, True):
+                # ignored whether it is a file or a directory
+                continue
+            try:
+                st = os.lstat(entrypath)
+                if stat.S_ISLNK(st.st_mode):
+                    st = os.stat(entrypath)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if (st.st_dev, st.st_ino) in ancestors:
+                    continue
+                if not self._rules.match(relpath, True):
+                    result.append((name + "/", entrypath, st, True))
+            elif stat.S_ISREG(st.st_mode):
+                if not self._rules.match(relpath, False):
+                    result.append((name, entrypath, st, False))
+        result.sort()
         return result
 
-    def _is_lockfile(self, filename):
+    def _prefetch(self, entries, ancestors):
+        """
+        queues the subdirectories of a directory to be read in advance
+        by the thread pool. The threads read the queued directories in
+        the order of the scan. The number of listings read in advance
+        is limited; skipped subdirectories are queued again when their
+        parent listing is used.
+        Parameters:
+        - entries
+          listing of the directory
+        - ancestors
+          set of the (st_dev, st_ino) tuples of the directory and its
+          parent directories
+        """
+        if self._pool == None:
+            return
+        limit = self._threads * SCAN_PREFETCH_PER_THREAD
+        self._prefetch_lock.acquire()
+        try:
+            for sortkey, entrypath, st, dirflag in entries:
+                if len(self._pending) >= limit:
+                    break
+                if dirflag and not self._pending.has_key(entrypath):
+                    self._pending[entrypath] = None
+                    self._ancestors[entrypath] = get_ancestors(ancestors, st)
+                    heapq.heappush(self._queue, entrypath + "/")
+                    self._pool.apply_async(self._read_next)
+        finally:
+            self._prefetch_lock.release()
+
+    def _read_next(self):
+        """
+        reads the queued directory that comes first in the order of
+        the scan. This method is executed by the thread pool.
+        """
+        self._prefetch_lock.acquire()
+        try:
+            if len(self._queue) == 0:
+                return
+            path = heapq.heappop(self._queue)[:-1]
+            ancestors = self._ancestors.pop(path)
+        finally:
+            self._prefetch_lock.release()
+        result = None
+        try:
+            result = self._list_directory(path, ancestors)
+            self._prefetch(result, ancestors)
+        finally:
+            self._prefetch_lock.acquire()
+            try:
+                if self._pending.has_key(path):
+                    self._pending[path] = [result]
+                    self._prefetch_lock.notify_all()
+            finally:
+                self._prefetch_lock.release()
+
+    def _get_listing(self, path, ancestors):
         """
-        checks if a filename is a temporary filename
+        returns the listing of a directory. Listings that are read in
+        advance are used; otherwise the directory is read now.
         Parameters:
-        - filename
-          filename to check
+        - path
+          path of the directory
+        - ancestors
+          set of the (st_dev, st_ino) tuples of the directory and its
+          parent directories
         Returns:
-        - True:  file is a temporary file
-        - False: file is not a temporary file
-        """
-        result = False
-        for p in self._pattern_list:
-            m = p.match(filename)
-            if m != None:
-                result = True
+        - listing of the directory (see _list_directory())
+        """
+        result = None
+        self._prefetch_lock.acquire()
+        try:
+            if self._pending.has_key(path):
+                while self._pending[path] == None:
+                    self._prefetch_lock.wait(1)
+                result = self._pending.pop(path)[0]
+        finally:
+            self._prefetch_lock.release()
+        if result == None:
+            result = self._list_directory(path, ancestors)
+        # subdirectories may have been skipped while the limit of
+        # listings read in advance was reached
+        self._prefetch(result, ancestors)
         return result
 
-    def _scan(self, path):
+    def iterate(self):
+        """
+        scans the files of the root directory and its subdirectories
+        (see iterate_stats())
+        Returns:
+        - generator of scanned FileInfo instances
+        """
+        for relpath, st in self.iterate_stats():
+            fileinfo = FileInfo(self._rootpath, os.path.join(self._rootpath, relpath))
+            fileinfo.set_stat(st)
+            yield fileinfo
+
+    def iterate_stats(self):
         """
-        scans the files of a given directory and its subdirectories
-        and creates a FileInfo instance for each file
+        scans the files of the root directory and its subdirectories.
+        The directories are traversed iteratively and the files are
+        returned while the scan proceeds, ordered by their relative
+        paths. If several threads are used, the listings of the
+        directories ahead are read in advance by a pool of threads;
+        the order of the files is the same as in a serial scan.
+        Symbolic links to directories are followed, but not into the
+        directories containing them.
+        Returns:
+        - generator of tuples (relative path, stat result)
+        """
+        rootlen = len(self._rootpath.rstrip("/")) + 1
+        self._pending = {}
+        self._ancestors = {}
+        self._queue = []
+        try:
+            root_ancestors = get_ancestors(frozenset(), os.stat(self._rootpath))
+        except OSError:
+            return
+        if self._threads > 1:
+            self._pool = ThreadPool(self._threads)
+        try:
+            listing = self._get_listing(self._rootpath, root_ancestors)
+            stack = [(iter(listing), root_ancestors)]
+            while len(stack) > 0:
+                try:
+                    sortkey, entrypath, st, dirflag = stack[-1][0].next()
+                except StopIteration:
+                    stack.pop()
+                    continue
+                if dirflag:
+                    ancestors = get_ancestors(stack[-1][1], st)
+                    listing = self._get_listing(entrypath, ancestors)
+                    stack.append((iter(listing), ancestors))
+                else:
+                    yield (entrypath[rootlen:], st)
+        finally:
+            if self._pool != None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+            self._pending = {}
+            self._ancestors = {}
+            self._queue = []
+
+    def iterate_directories(self, reldirs):
+        """
+        scans the files of the given directories without their
+        subdirectories (see iterate_directory_stats())
         Parameters:
-        - path
-          path of the directory to scan
-        """
-        dirlist = []
-        for entry in glob.glob(os.path.join(path, "*")):
-            if os.path.isfile(entry):
-                basename = os.path.basename(entry)
-                if not self._is_lockfile(basename):
-                    fileinfo = FileInfo(self._rootpath, entry)
-                    fileinfo.scan()
-                    self._list.append(fileinfo)
-            if os.path.isdir(entry):
-                dirlist.append(entry)
-        for entry in dirlist:
-            self._scan(entry)
+        - reldirs
+          relative paths of the directories
+        Returns:
+        - generator of scanned FileInfo instances
+        """
+        for relpath, st in self.iterate_directory_stats(reldirs):
+            fileinfo = FileInfo(self._rootpath, os.path.join(self._rootpath, relpath))
+            fileinfo.set_stat(st)
+            yield fileinfo
+
+    def iterate_directory_stats(self, reldirs):
+        """
+        scans the files of the given directories without their
+        subdirectories
+        Parameters:
+        - reldirs
+          relative paths of the directories
+        Returns:
+        - generator of tuples (relative path, stat result)
+        """
+        for reldir in sorted(reldirs):
+            if reldir != "" and self._rules.is_ignored(reldir, True):
+                continue
+            path = os.path.join(self._rootpath, reldir)
+            for sortkey, entrypath, st, dirflag in self._list_directory(path):
+                if not dirflag:
+                    yield (os.path.join(reldir, sortkey), st)
+
+    def scan_paths(self, relpaths):
+        """
+        scans the given files (see scan_path_stats())
+        Parameters:
+        - relpaths
+          relative paths of the files
+        Returns:
+        - generator of scanned FileInfo instances ordered by their
+          relative paths
+        """
+        for relpath, st in self.scan_path_stats(relpaths):
+            fileinfo = FileInfo(self._rootpath, os.path.join(self._rootpath, relpath))
+            fileinfo.set_stat(st)
+            yield fileinfo
+
+    def scan_path_stats(self, relpaths):
+        """
+        scans the given files, e.g. files that were reported as
+        changed. Paths of files that don't exist or are ignored are
+        skipped.
+        Parameters:
+        - relpaths
+          relative paths of the files
+        Returns:
+        - generator of tuples (relative path, stat result) ordered by
+          the relative paths
+        """
+        for relpath in sorted(relpaths):
+            if self._rules.is_ignored(relpath):
+                continue
+            filepath = os.path.join(self._rootpath, relpath)
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                yield (relpath, st)
+
+    def get_rules(self):
+        """
+        Returns:
+        - IgnoreRules of the source directory
+        """
+        return self._rules
 
     def get_list(self):
         """
         Returns:
-        - FileInfoList
+        - FileInfoList of all scanned files
         """
+        if self._list == None:
+            self._list = FileInfoList()
+            for fileinfo in self.iterate():
+                self._list.append(fileinfo)
         return self._list
-
@@ -14,83 +14,84 @@
 
 import time
 
+from cancellation import *
 from config import *
 from cryptlog import *
-from debug import *
+from digestcache import *
 from fileinfo import *
+from syncplan import *
 
 class Downloader(object):
     """
     class to process downloads from the CryptStore
     """
 
-    def __init__(self, cryptstore):
+    def __init__(self, cryptstore, workers=None, digests=None):
         """
         creates an instance
         Parameters:
         - cryptstore
           CryptStore instance to use
+        - workers
+          number of worker processes to decrypt files (None: use
+          the configured value)
+        - digests
+          DigestCache to use (None: use an own instance)
         """
         self._cryptstore = cryptstore
+        self._workers = workers
+        if digests == None:
+            digests = DigestCache()
+        self._digests = digests
         config = CryptBoxConfig()
         self._rootpath = config.get_source_directory()
 
-    def _debug(self, action, entry, fileinfo):
+    def run(self, directories=None):
         """
-        logs debug information
+        executes the Downloader
         Parameters:
-        - action
-          action to log
-        - entry
-          corresponding cryptstore entry
-        - fileinfo
-          corresponding file info
+        - directories
+          set of relative paths of the directories whose entries are
+          checked. If None, all entries are checked.
+        Returns:
+        - executed SyncPlan
         """
-        debuglog = DebugLogger("cryptbox", "Downloader")
-        debuglog.debug_value("entry.filepath", entry.get_filepath())
-        debuglog.debug_value("entry.state", entry.get_state())
-        debuglog.debug_value("entry.timestamp", entry.get_timestamp())
-        debuglog.debug_value("fileinfo.exist", fileinfo.exists())
-        debuglog.debug_value("fileinfo.file_timestamp", fileinfo.get_file_timestamp())
-        debuglog.debug(action)
+        planner = SyncPlanner(self._cryptstore, self._digests)
+        plan = planner.create_plan(upload=False, directories=directories)
+        self.execute(plan)
+        return plan
 
-    def run(self):
+    def execute(self, plan):
         """
-        executes the Downloader
+        executes the downloads, deletions and timestamp updates of a
+        plan. Files that were deleted in the destination directory,
+        but modified in the source directory afterwards, are uploaded
+        again by the Uploader. If the synchronization is cancelled, the
+        remaining actions are skipped.
+        Parameters:
+        - plan
+          SyncPlan to execute
         """
-        for entry in self._cryptstore.get_entries():
-            relpath = entry.get_filepath()
-            entry_timestamp = entry.get_timestamp()
-            fileinfo = FileInfo(self._rootpath, relpath)
-            if entry.get_state() != FILEINFO_STATE_DELETED:
-                download_flag = True
-                if fileinfo.exists():
-                    file_timestamp = fileinfo.get_file_timestamp()
-                    if entry_timestamp - file_timestamp <= 1:
-                        # the file in the source directory is newer than
-                        # in the destination directory; it will not be
-                        # downloaded.
-                        download_flag = False
-                        self._debug("file not downloaded", entry, fileinfo)
-                if download_flag:
-                    self._debug("file downloaded", entry, fileinfo)
-                    self._cryptstore.download_file(entry, self._rootpath)
-                    cryptlog("%s downloaded." % relpath)
-            else:
-                delete_flag = True
-                if fileinfo.exists():
-                    file_timestamp = fileinfo.get_file_timestamp()
-                    if entry_timestamp - file_timestamp <= 1:
-                        # the file in the source directory was modified
-                        # after the file was deleted in  the destination
-                        # directory; it will be not deleted but uploaded
-                        # again.
-                        delete_flag = False
-                        self._debug("file uploaded", entry, fileinfo)
-                        self._crypstore.upload_file(fileinfo)
-                        cryptlog("%s uploaded." % relpath)
-                    if delete_flag:
-                        self._debug("file deleted", entry, fileinfo)
-                        fileinfo.delete_file(time.time())
-                        cryptlog("%s deleted." % relpath)
-
+        with self._cryptstore.batch():
+            for action in plan.get_actions(PLAN_TOUCH_LOCAL):
+                if is_cancelled():
+                    break
+                entry = action.get_entry()
+                fileinfo = action.get_fileinfo()
+                fileinfo.set_timestamp(entry.get_timestamp())
+                self._digests.set_digest(fileinfo, entry.get_digest())
+                cryptlog("%s timestamp updated." % action.get_relative_path())
+            for action in plan.get_actions(PLAN_DELETE_LOCAL):
+                if is_cancelled():
+                    break
+                action.get_fileinfo().delete_file(time.time())
+                self._digests.remove_digest(action.get_relative_path())
+                cryptlog("%s deleted." % action.get_relative_path())
+            downloads = [(action.get_entry(), action.get_fileinfo())
+                         for action in plan.get_actions(PLAN_DOWNLOAD)]
+            for entry, flag in self._cryptstore.download_files(downloads, self._rootpath,
+                                                               self._workers):
+                if flag:
+                    cryptlog("%s downloaded." % entry.get_filepath())
+        flush_states()
+        self._digests.save()
@@ -14,10 +14,9 @@
 
 import os
 import os.path
-import getpass
 
 from config import *
-from couchhelper import *
+from statestore import *
 
 FILEINFO_STATE_UPLOADED = "uploaded"
 FILEINFO_STATE_DOWNLOADED = "downloaded" 
@@ -32,9 +31,7 @@ class FileInfoDatabase(object):
         """
         creates an instance
         """
-        user = getpass.getuser()
-        database_name = "cryptbox-%s" % user
-        self._database = CouchDatabase(database_name)
+        self._database = get_state_store()
         config = CryptBoxConfig()
         self._rootpath = config.get_source_directory()
 
@@ -44,13 +41,19 @@ class FileInfoDatabase(object):
         Returns:
         - list of FileInfo instances
         """
-        result = []
-        for doc_id in self._database.get_document_list():
-            doc = self._database.load_document(doc_id)
-            relpath = doc.get_value("relpath")
-            fileinfo = FileInfo(self._rootpath, relpath)
-            result.append(fileinfo)
-        return result
+        return list(self.iterate_all())
+
+    def iterate_all(self):
+        """
+        iterates over all file state information
+        Returns:
+        - generator of FileInfo instances
+        """
+        for values in self._database.iterate_states():
+            fileinfo = FileInfo(self._rootpath)
+            fileinfo.set_relative_path(values.get("relpath"))
+            fileinfo.load_state(values)
+            yield fileinfo
 
 class FileInfo(object):
     """
@@ -71,6 +74,7 @@ class FileInfo(object):
         self._relpath = None
         self._file_timestamp = None
         self._size = None
+        self._inode = None
         self._state = None
         self._state_timestamp = None
         if filepath:
@@ -81,11 +85,9 @@ class FileInfo(object):
         """
         inits the database to store state information
         Returns:
-        - CouchDatabase instance
+        - StateStore instance
         """
-        user = getpass.getuser()
-        database_name = "cryptbox-%s" % user
-        return CouchDatabase(database_name)
+        return get_state_store()
 
     def set_filepath(self, filepath):
         """
@@ -143,35 +145,53 @@ class FileInfo(object):
         scans the file properties from the file system
         """
         path = self.get_absolute_path()
-        if os.path.exists(path):
-            self._file_timestamp = os.path.getmtime(path)
-            self._size = os.path.getsize(path)
-        else:
-            self._timestamp = None
+        try:
+            self.set_stat(os.stat(path))
+        except OSError:
+            self._file_timestamp = None
             self._size = None
+            self._inode = None
+
+    def set_stat(self, stat):
+        """
+        sets the file properties from the result of a stat call
+        Parameters:
+        - stat
+          result of os.stat() or os.lstat()
+        """
+        self._file_timestamp = stat.st_mtime
+        self._size = stat.st_size
+        self._inode = stat.st_ino
 
     def read_state(self):
         """
         reads the state information
         """
-        key = CouchKey([self._relpath])
-        doc = self._database.load_document(key.get_key())
-        if doc:
-            self._state = doc.get_value("state")
-            self._state_timestamp = doc.get_value("state_timestamp")
+        values = self._database.load_state(self._relpath)
+        if values:
+            self.load_state(values)
+
+    def load_state(self, values):
+        """
+        sets the state information
+        Parameters:
+        - values
+          dictionary of the state information
+        """
+        self._state = values.get("state")
+        self._state_timestamp = values.get("state_timestamp")
 
     def save_state(self):
         """
-        saves the state information
+        saves the state information. The state document is written
+        later together with other changed state documents (see
+        flush_states()).
         """
-        key = CouchKey([self._relpath])
-        doc = self._database.load_document(key.get_key())
-        if doc == None:
-            doc = CouchDocument(key.get_key())
-        doc.set_value("relpath", self._relpath)
-        doc.set_value("state", self._state)
-        doc.set_value("state_timestamp", self._state_timestamp)
-        self._database.save_document(doc)
+        values = {}
+        values["relpath"] = self._relpath
+        values["state"] = self._state
+        values["state_timestamp"] = self._state_timestamp
+        self._database.save_state(values)
 
     def exists(self):
         """
@@ -236,6 +256,13 @@ class FileInfo(object):
         """
         return self._size
 
+    def get_inode(self):
+        """
+        Returns:
+        - inode number of the file
+        """
+        return self._inode
+
     def delete_file(self, timestamp):
         """
         deletes the corresponding file
@@ -294,7 +321,7 @@ class FileInfoList(object):
         - FileInfo
         """
         result = None
-        if relpath in self._dict().keys():
+        if relpath in self._dict:
             result = self._dict[relpath]
         return result
 
@@ -0,0 +1,262 @@
+# cryptbox - rules for files that are not synchronized
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import os
+import os.path
+import re
+import threading
+
+# name of the files containing ignore rules in the source directory and
+# its subdirectories
+IGNORE_FILENAME = ".cryptboxignore"
+
+# file containing ignore rules for all directories
+IGNORE_GLOBAL_FILENAME = "~/.cryptboxignore"
+
+# rules that are applied before all other rules: hidden files and
+# directories are ignored, unless a rule includes them again. Temporary
+# lock files and files that are being downloaded are always ignored.
+DEFAULT_IGNORE_RULES = [".*", ".*.swp", "*.lock", ".~lock.*#", "*.cryptbox-partial"]
+
+# maximal number of rules in one regular expression. Python supports
+# only 100 named groups per expression.
+RULES_PER_EXPRESSION = 90
+
+def translate_glob(pattern):
+    """
+    translates a gitignore-style glob pattern into a regular expression
+    Parameters:
+    - pattern
+      glob pattern without leading or trailing slashes
+    Returns:
+    - regular expression as a string
+    """
+    result = []
+    pos = 0
+    length = len(pattern)
+    while pos < length:
+        c = pattern[pos]
+        if pattern.startswith("**/", pos):
+            result.append("(?:.*/)?")
+            pos += 3
+        elif pattern.startswith("/**", pos) and pos + 3 == length:
+            result.append("/.+")
+            pos += 3
+        elif pattern.startswith("**", pos):
+            result.append(".*")
+            pos += 2
+        elif c == "*":
+            result.append("[^/]*")
+            pos += 1
+        elif c == "?":
+            result.append("[^/]")
+            pos += 1
+        elif c == "[" and pattern.find("]", pos + 2) > 0:
+            end = pattern.find("]", pos + 2)
+            content = pattern[pos + 1:end].replace("\\", "\\\\")
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            result.append("[%s]" % content)
+            pos = end + 1
+        elif c == "\\" and pos + 1 < length:
+            result.append(re.escape(pattern[pos + 1]))
+            pos += 2
+        else:
+            result.append(re.escape(c))
+            pos += 1
+    return "".join(result)
+
+def parse_rule(line, reldir):
+    """
+    parses a line of an ignore file
+    Parameters:
+    - line
+      line to parse
+    - reldir
+      relative path of the directory containing the ignore file
+    Returns:
+    - tuple (regular expression, negation flag) or None, if the line
+      contains no rule
+    """
+    line = line.rstrip()
+    if len(line) == 0 or line.startswith("#"):
+        return None
+    negation = line.startswith("!")
+    if negation:
+        line = line[1:]
+    dironly = line.endswith("/")
+    line = line.rstrip("/")
+    anchored = "/" in line
+    line = line.lstrip("/")
+    if len(line) == 0:
+        return None
+    prefix = ""
+    if reldir:
+        prefix = re.escape(reldir + "/")
+    if not anchored:
+        prefix = prefix + "(?:.*/)?"
+    if dironly:
+        suffix = "/"
+    else:
+        suffix = "/?"
+    return ("%s%s%s$" % (prefix, translate_glob(line), suffix), negation)
+
+class IgnoreRules(object):
+    """
+    class to determine files and directories in the source directory
+    that are not synchronized. The rules are read from the global
+    ignore file and from the ignore files in the source directory and
+    its subdirectories; they are written like the rules in .gitignore
+    files. All rules are compiled into combined regular expressions,
+    so that a path is matched at once; the last matching rule wins.
+    """
+
+    def __init__(self, rootpath):
+        """
+        creates an instance and reads the global rules and the rules
+        of the source directory
+        Parameters:
+        - rootpath
+          path of the source directory
+        """
+        self._rootpath = rootpath
+        self._lock = threading.Lock()
+        self._rules = []
+        self._expressions = []
+        self._loaded = set()
+        for line in DEFAULT_IGNORE_RULES:
+            self._add_rule(line, "")
+        self._read_file(os.path.expanduser(IGNORE_GLOBAL_FILENAME), "")
+        self._compile()
+        self.load_directory("")
+
+    def _add_rule(self, line, reldir):
+        """
+        adds a rule
+        Parameters:
+        - line
+          line of an ignore file
+        - reldir
+          relative path of the directory containing the ignore file
+        """
+        rule = parse_rule(line, reldir)
+        if rule:
+            self._rules.append(rule)
+
+    def _read_file(self, filepath, reldir):
+        """
+        reads the rules of an ignore file
+        Parameters:
+        - filepath
+          path of the ignore file
+        - reldir
+          relative path of the directory the rules apply to
+        Returns:
+        - True:  the file was read
+        - False: the file doesn't exist or can't be read
+        """
+        try:
+            ignore_file = open(filepath, "r")
+            lines = ignore_file.readlines()
+            ignore_file.close()
+        except IOError:
+            return False
+        for line in lines:
+            self._add_rule(line, reldir)
+        return True
+
+    def _compile(self):
+        """
+        compiles the rules into combined regular expressions. The
+        rules are combined in reversed order, so that the first match
+        is the last matching rule.
+        """
+        expressions = []
+        index = len(self._rules)
+        while index > 0:
+            start = max(index - RULES_PER_EXPRESSION, 0)
+            groups = []
+            for number in range(index - 1, start - 1, -1):
+                groups.append("(?P<r%i>%s)" % (number, self._rules[number][0]))
+            expressions.append(re.compile("|".join(groups)))
+            index = start
+        self._expressions = expressions
+
+    def load_directory(self, reldir, names=None):
+        """
+        reads the ignore file of a directory, if it wasn't read yet
+        Parameters:
+        - reldir
+          relative path of the directory
+        - names
+          names of the entries of the directory, if they are known. The
+          ignore file is only read, if it is one of the entries.
+        """
+        if reldir in self._loaded:
+            return
+        self._lock.acquire()
+        try:
+            if reldir in self._loaded:
+                return
+            if names == None or IGNORE_FILENAME in names:
+                filepath = os.path.join(self._rootpath, reldir, IGNORE_FILENAME)
+                if self._read_file(filepath, reldir):
+                    self._compile()
+            self._loaded.add(reldir)
+        finally:
+            self._lock.release()
+
+    def match(self, relpath, dirflag=False):
+        """
+        checks a path against the rules that are read. The parent
+        directories are not checked.
+        Parameters:
+        - relpath
+          relative path of a file or directory
+        - dirflag
+          True, if the path is a directory
+        Returns:
+        - True:  the path is ignored
+        - False: the path is not ignored
+        """
+        if dirflag:
+            relpath = relpath + "/"
+        for expression in self._expressions:
+            m = expression.match(relpath)
+            if m:
+                number = int(m.lastgroup[1:])
+                return not self._rules[number][1]
+        return False
+
+    def is_ignored(self, relpath, dirflag=False):
+        """
+        checks if a path is ignored. The path is ignored as well, if
+        one of its parent directories is ignored.
+        Parameters:
+        - relpath
+          relative path of a file or directory
+        - dirflag
+          True, if the path is a directory
+        Returns:
+        - True:  the path is ignored
+        - False: the path is not ignored
+        """
+        parts = relpath.split("/")
+        reldir = ""
+        for name in parts[:-1]:
+            reldir = os.path.join(reldir, name)
+            if self.match(reldir, True):
+                return True
+            self.load_directory(reldir)
+        return self.match(relpath, dirflag)
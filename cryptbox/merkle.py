@@ -0,0 +1,470 @@
+# cryptbox - digest trees of the source directory and the CryptStore
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import hashlib
+import json
+import os
+import os.path
+
+from cancellation import *
+from config import *
+from dirscanner import *
+from ignorerules import *
+
+# file to store the digest trees of the last synchronization
+MERKLE_FILENAME = "~/.cryptbox.merkle"
+
+# version of the digests. Digests of another version are not compared.
+MERKLE_VERSION = 2
+
+# digest of a directory without files
+MERKLE_EMPTY_DIGEST = hashlib.sha1().hexdigest()
+
+def is_ancestor(reldir, relpath):
+    """
+    checks if a directory contains a path
+    Parameters:
+    - reldir
+      relative path of the directory
+    - relpath
+      relative path to check
+    Returns:
+    - True:  relpath is reldir or is contained in reldir
+    - False: relpath is not contained in reldir
+    """
+    return reldir == "" or relpath == reldir or relpath.startswith(reldir + "/")
+
+def get_file_line(name, value):
+    """
+    Parameters:
+    - name
+      name of a file
+    - value
+      string describing the state of the file
+    Returns:
+    - line describing the file in the digest of its directory, encoded
+      with UTF-8
+    """
+    line = "f %s %s\n" % (name, value)
+    if isinstance(line, unicode):
+        line = line.encode("utf-8")
+    return line
+
+def get_directory_digest(files_digest, subdirs, digests):
+    """
+    computes the digest of a directory
+    Parameters:
+    - files_digest
+      digest of the files of the directory
+    - subdirs
+      relative paths of the subdirectories
+    - digests
+      dictionary of the digests by relative directory path including
+      the subdirectories
+    Returns:
+    - digest of the directory
+    """
+    digest = hashlib.sha1()
+    digest.update("f %s\n" % files_digest)
+    for reldir in sorted(subdirs):
+        line = "d %s %s\n" % (os.path.basename(reldir), digests[reldir])
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+        digest.update(line)
+    return digest.hexdigest()
+
+def update_tree(tree, changes):
+    """
+    updates the digests of changed directories and of the directories
+    containing them. The digests of the other directories are kept.
+    Directories without files in their subtree are removed.
+    Parameters:
+    - tree
+      tuple of the digests, the subdirectories and the digests of the
+      files (see DigestTreeBuilder.finish()). The tree is updated in
+      place.
+    - changes
+      dictionary of the new digests of the files by relative
+      directory path. None marks a directory without files.
+    """
+    digests, children, files = tree
+    affected = set([""])
+    for reldir, files_digest in changes.items():
+        if files_digest == None:
+            files.pop(reldir, None)
+        else:
+            files[reldir] = files_digest
+        while reldir not in affected:
+            affected.add(reldir)
+            reldir = os.path.dirname(reldir)
+    # subdirectories are updated before the directories containing them
+    depths = [(reldir.count("/") + (reldir != ""), reldir) for reldir in affected]
+    depths.sort(reverse=True)
+    for depth, reldir in depths:
+        subdirs = children.get(reldir, [])
+        parent = os.path.dirname(reldir)
+        if reldir == "" or reldir in files or len(subdirs) > 0:
+            digests[reldir] = get_directory_digest(files.get(reldir, MERKLE_EMPTY_DIGEST),
+                                                   subdirs, digests)
+            if reldir != "" and reldir not in children.setdefault(parent, []):
+                children[parent].append(reldir)
+        else:
+            digests.pop(reldir, None)
+            children.pop(reldir, None)
+            if reldir in children.get(parent, []):
+                children[parent].remove(reldir)
+
+class DigestTreeBuilder(object):
+    """
+    class to compute the digests of all directories of a tree. The
+    digest of a directory covers the digest of the values of its files
+    and the digests of its subdirectories, so that it can be updated
+    without reading its files again (see update_tree()). The files
+    have to be added in the order of their relative paths, so that
+    each directory is completed before the next one starts.
+    """
+
+    def __init__(self):
+        """
+        creates an instance
+        """
+        self._digests = {}
+        self._children = {}
+        self._files = {}
+        self._stack = [["", hashlib.sha1(), False]]
+
+    def _leave(self):
+        """
+        completes the current directory
+        """
+        reldir, digest, has_files = self._stack.pop()
+        if has_files:
+            self._files[reldir] = digest.hexdigest()
+        self._digests[reldir] = get_directory_digest(self._files.get(reldir, MERKLE_EMPTY_DIGEST),
+                                                     self._children.get(reldir, []),
+                                                     self._digests)
+        if len(self._stack) > 0:
+            self._children.setdefault(self._stack[-1][0], []).append(reldir)
+
+    def _enter(self, reldir):
+        """
+        makes a directory the current directory
+        Parameters:
+        - reldir
+          relative path of the directory
+        """
+        while not is_ancestor(self._stack[-1][0], reldir):
+            self._leave()
+        current = self._stack[-1][0]
+        if current == reldir:
+            return
+        rest = reldir[len(current):].lstrip("/")
+        for name in rest.split("/"):
+            current = os.path.join(current, name)
+            self._stack.append([current, hashlib.sha1(), False])
+
+    def add(self, relpath, value):
+        """
+        adds a file
+        Parameters:
+        - relpath
+          relative path of the file
+        - value
+          string describing the state of the file
+        """
+        reldir, name = os.path.split(relpath)
+        self._enter(reldir)
+        self._stack[-1][1].update(get_file_line(name, value))
+        self._stack[-1][2] = True
+
+    def finish(self):
+        """
+        completes all directories
+        Returns:
+        - tuple of a dictionary of the digests by relative directory
+          path, a dictionary of the subdirectories by relative
+          directory path and a dictionary of the digests of the files
+          of the directories containing files
+        """
+        while len(self._stack) > 0:
+            self._leave()
+        return (self._digests, self._children, self._files)
+
+def get_local_value(st):
+    """
+    Parameters:
+    - st
+      stat result of a file
+    Returns:
+    - string describing the state of a file in the source directory
+    """
+    return "%i %r" % (st.st_size, st.st_mtime)
+
+def create_local_tree(rootpath, threads=1):
+    """
+    computes the digest tree of the source directory over the sizes and
+    modification times of the files
+    Parameters:
+    - rootpath
+      path of the source directory
+    - threads
+      number of threads to scan the directory
+    Returns:
+    - digest tree (see DigestTreeBuilder.finish())
+    """
+    builder = DigestTreeBuilder()
+    scanner = DirScanner(rootpath, threads)
+    for relpath, st in scanner.iterate_stats():
+        if is_cancelled():
+            break
+        builder.add(relpath, get_local_value(st))
+    return builder.finish()
+
+def update_local_tree(tree, rootpath, reldirs):
+    """
+    updates the digest tree of the source directory by reading only
+    the files of changed directories
+    Parameters:
+    - tree
+      digest tree to update in place
+    - rootpath
+      path of the source directory
+    - reldirs
+      relative paths of the directories whose files changed
+    """
+    scanner = DirScanner(rootpath)
+    changes = {}
+    for reldir in reldirs:
+        digest = None
+        for relpath, st in scanner.iterate_directory_stats([reldir]):
+            if digest == None:
+                digest = hashlib.sha1()
+            digest.update(get_file_line(os.path.basename(relpath), get_local_value(st)))
+        changes[reldir] = None
+        if digest != None:
+            changes[reldir] = digest.hexdigest()
+    update_tree(tree, changes)
+
+def get_index_values(cryptstore):
+    """
+    determines the values of the entries of a CryptStore
+    Parameters:
+    - cryptstore
+      CryptStore instance
+    Returns:
+    - dictionary of dictionaries of the values by file name by relative
+      directory path
+    """
+    result = {}
+    for entry in cryptstore.get_entries():
+        reldir, name = os.path.split(entry.get_filepath())
+        value = "%s %r %s %s" % (entry.get_state(), entry.get_timestamp(),
+                                 entry.get_entry_id(), entry.get_digest())
+        result.setdefault(reldir, {})[name] = value
+    return result
+
+def update_index_tree(tree, values, previous):
+    """
+    updates the digest tree of the entries of a CryptStore for the
+    directories whose entries changed
+    Parameters:
+    - tree
+      digest tree of the previous values to update in place
+    - values
+      current values of the entries (see get_index_values())
+    - previous
+      values of the entries the tree was computed for
+    """
+    changes = {}
+    for reldir in set(values.keys()) | set(previous.keys()):
+        entries = values.get(reldir)
+        if entries == previous.get(reldir):
+            continue
+        changes[reldir] = None
+        if entries:
+            digest = hashlib.sha1()
+            for name, value in sorted(entries.items()):
+                digest.update(get_file_line(name, value))
+            changes[reldir] = digest.hexdigest()
+    update_tree(tree, changes)
+
+def create_index_tree(cryptstore):
+    """
+    computes the digest tree of the entries of a CryptStore
+    Parameters:
+    - cryptstore
+      CryptStore instance
+    Returns:
+    - digest tree (see DigestTreeBuilder.finish())
+    """
+    result = ({}, {}, {})
+    update_index_tree(result, get_index_values(cryptstore), {})
+    return result
+
+class MerkleTracker(object):
+    """
+    class to determine the directories that changed since the last
+    synchronization. The digest trees of the source directory and of
+    the CryptStore are compared to the trees stored after the last
+    synchronization; only subtrees with different digests are
+    examined. The trees are kept between the synchronizations, so that
+    only the directories that changed since are read again.
+    """
+
+    def __init__(self):
+        """
+        creates an instance
+        """
+        self._filepath = os.path.expanduser(MERKLE_FILENAME)
+        self._local_tree = None
+        self._index_tree = None
+        self._index_values = None
+        self._committed = None
+        self._context = None
+
+    def _get_context(self, config):
+        """
+        computes a digest of the settings that affect the
+        synchronization of all files
+        Parameters:
+        - config
+          CryptBoxConfig instance
+        Returns:
+        - digest as a string
+        """
+        digest = hashlib.sha1()
+        digest.update("%i\n%s\n%s\n" % (MERKLE_VERSION,
+                                        config.get_source_directory(),
+                                        config.get_destination_directory()))
+        try:
+            ignore_file = open(os.path.expanduser(IGNORE_GLOBAL_FILENAME), "r")
+            digest.update(ignore_file.read())
+            ignore_file.close()
+        except IOError:
+            pass
+        return digest.hexdigest()
+
+    def _load(self):
+        """
+        loads the trees of the last synchronization
+        Returns:
+        - dictionary with the keys context, local and index or None
+        """
+        result = None
+        if os.path.exists(self._filepath):
+            try:
+                merkle_file = open(self._filepath, "r")
+                result = json.load(merkle_file)
+                merkle_file.close()
+            except (IOError, ValueError):
+                print "Unable to read: %s" % self._filepath
+        return result
+
+    def compute(self, cryptstore, watcher=None):
+        """
+        computes the digest trees and determines the directories that
+        changed since the last synchronization. The tree of the source
+        directory is only updated for the directories the watcher
+        reports as changed; the tree of the CryptStore is only updated
+        for the directories whose entries changed.
+        Parameters:
+        - cryptstore
+          CryptStore instance
+        - watcher
+          InotifyWatcher instance watching the source directory or
+          None to scan the whole source directory
+        Returns:
+        - set of the relative paths of the changed directories or None,
+          if all directories have to be examined
+        """
+        config = CryptBoxConfig()
+        context = self._get_context(config)
+        if context != self._context:
+            self._local_tree = None
+            self._index_tree = None
+            self._committed = None
+        self._context = context
+        reldirs = None
+        if watcher != None:
+            reldirs = watcher.get_dirty_directories()
+        if self._local_tree == None or reldirs == None:
+            self._local_tree = create_local_tree(config.get_source_directory(),
+                                                 config.get_scan_threads())
+        else:
+            update_local_tree(self._local_tree, config.get_source_directory(), reldirs)
+        if is_cancelled():
+            # the tree may be incomplete
+            self._local_tree = None
+            return None
+        values = get_index_values(cryptstore)
+        if self._index_tree == None:
+            self._index_tree = ({}, {}, {})
+            self._index_values = {}
+        update_index_tree(self._index_tree, values, self._index_values)
+        self._index_values = values
+        previous = self._committed
+        if previous == None:
+            previous = self._load()
+        if previous == None or previous.get("context") != self._context:
+            return None
+        local_digests, local_children = self._local_tree[:2]
+        index_digests, index_children = self._index_tree[:2]
+        result = set()
+        stack = [""]
+        while len(stack) > 0:
+            reldir = stack.pop()
+            if previous["local"].get(reldir) == local_digests.get(reldir) and \
+               previous["index"].get(reldir) == index_digests.get(reldir):
+                continue
+            result.add(reldir)
+            children = set(local_children.get(reldir, []))
+            children.update(index_children.get(reldir, []))
+            stack.extend(children)
+        return result
+
+    def commit(self, dirty):
+        """
+        stores the trees computed at the start of the synchronization.
+        Directories with files that were changed during the
+        synchronization are left out, so that they are examined again.
+        The computed trees are kept to be updated by the next
+        compute().
+        Parameters:
+        - dirty
+          set of relative paths of the changed files
+        """
+        if self._local_tree == None:
+            return
+        local_digests = dict(self._local_tree[0])
+        index_digests = dict(self._index_tree[0])
+        for relpath in dirty:
+            reldir = os.path.dirname(relpath)
+            while True:
+                local_digests.pop(reldir, None)
+                index_digests.pop(reldir, None)
+                if reldir == "":
+                    break
+                reldir = os.path.dirname(reldir)
+        values = {"context": self._context,
+                  "local": local_digests,
+                  "index": index_digests}
+        temppath = self._filepath + ".tmp"
+        try:
+            merkle_file = open(temppath, "w")
+            json.dump(values, merkle_file)
+            merkle_file.close()
+            os.rename(temppath, self._filepath)
+        except (IOError, OSError):
+            print "Unable to write: %s" % self._filepath
+        self._committed = values
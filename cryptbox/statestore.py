@@ -0,0 +1,461 @@
+# cryptbox - databases to store the state information of local files
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import atexit
+import getpass
+import os.path
+import sqlite3
+import threading
+
+from config import *
+from couchhelper import *
+from cryptlog import *
+
+# number of state changes to collect before they are written
+STATE_BUFFER_SIZE = 500
+
+# number of states read from the SQLite database at once
+STATE_PAGE_SIZE = 500
+
+# maximal number of attempts to save a state document with conflicts
+STATE_MAX_ATTEMPTS = 3
+
+# file of the SQLite state database
+STATE_SQLITE_FILENAME = "~/.cryptbox.state.db"
+
+class StateStore(object):
+    """
+    interface of the databases to store the state information of local
+    files. The state information of a file is a dictionary with the
+    keys relpath, state and state_timestamp.
+    """
+
+    def load_state(self, relpath):
+        """
+        reads the state information of a file
+        Parameters:
+        - relpath
+          relative path of the file
+        Returns:
+        - dictionary of the state information or None
+        """
+        raise NotImplementedError
+
+    def save_state(self, values):
+        """
+        saves the state information of a file. The changes may be
+        written later (see flush()).
+        Parameters:
+        - values
+          dictionary of the state information
+        """
+        raise NotImplementedError
+
+    def iterate_states(self):
+        """
+        iterates over the state information of all files
+        Returns:
+        - generator of dictionaries of the state information
+        """
+        raise NotImplementedError
+
+    def iterate_sorted_states(self):
+        """
+        iterates over the state information of all files ordered by
+        the UTF-8 encoded relative paths
+        Returns:
+        - generator of dictionaries of the state information
+        """
+        values_list = []
+        for values in self.iterate_states():
+            relpath = values.get("relpath")
+            if isinstance(relpath, unicode):
+                relpath = relpath.encode("utf-8")
+            values_list.append((relpath, values))
+        values_list.sort(key=lambda item: item[0])
+        for relpath, values in values_list:
+            yield values
+
+    def flush(self):
+        """
+        writes all collected changes
+        """
+        pass
+
+    def close(self):
+        """
+        writes all collected changes and closes the database
+        """
+        self.flush()
+
+class CouchStateStore(StateStore):
+    """
+    stores the state information in the CouchDB database
+    cryptbox-<user>. Changed documents are collected and written in
+    batches; the revisions of the documents are tracked, so that
+    documents can be updated without reading them first.
+    """
+
+    def __init__(self, database=None):
+        """
+        creates an instance
+        Parameters:
+        - database
+          CouchDatabase to use. If None, the database of the current
+          user is used.
+        """
+        if database == None:
+            database = CouchDatabase("cryptbox-%s" % getpass.getuser())
+        self._database = database
+        self._lock = threading.RLock()
+        self._docs = {}
+        self._revs = {}
+
+    def get_database(self):
+        """
+        Returns:
+        - CouchDatabase instance
+        """
+        return self._database
+
+    def load_state(self, relpath):
+        """
+        reads the state information of a file
+        Parameters:
+        - relpath
+          relative path of the file
+        Returns:
+        - dictionary of the state information or None
+        """
+        key = CouchKey([relpath]).get_key()
+        self._lock.acquire()
+        try:
+            doc = self._docs.get(key)
+        finally:
+            self._lock.release()
+        if doc == None:
+            doc = self._database.load_document(key)
+            if doc:
+                self._set_rev_id(key, doc.get_rev_id())
+        result = None
+        if doc:
+            result = doc.get_values()
+        return result
+
+    def save_state(self, values):
+        """
+        saves the state information of a file. The changes are
+        written when STATE_BUFFER_SIZE documents are collected.
+        Parameters:
+        - values
+          dictionary of the state information
+        """
+        doc = CouchDocument(CouchKey([values["relpath"]]).get_key())
+        for key in values.keys():
+            doc.set_value(key, values[key])
+        self._lock.acquire()
+        try:
+            self._docs[doc.get_doc_id()] = doc
+            if len(self._docs) >= STATE_BUFFER_SIZE:
+                self.flush()
+        finally:
+            self._lock.release()
+
+    def iterate_states(self):
+        """
+        iterates over the state information of all files. The state
+        documents are retrieved in pages, so that the memory usage is
+        bounded. Documents that are not written yet are not included.
+        Returns:
+        - generator of dictionaries of the state information
+        """
+        for doc in self._database.iterate_documents():
+            self._set_rev_id(doc.get_doc_id(), doc.get_rev_id())
+            self._lock.acquire()
+            try:
+                pending = self._docs.get(doc.get_doc_id())
+            finally:
+                self._lock.release()
+            if pending:
+                doc = pending
+            yield doc.get_values()
+
+    def _set_rev_id(self, doc_id, rev_id):
+        """
+        records the revision of a state document
+        Parameters:
+        - doc_id
+          id of the document
+        - rev_id
+          revision id of the document
+        """
+        self._lock.acquire()
+        try:
+            self._revs[doc_id] = rev_id
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        writes all collected state documents. Documents with conflicts
+        are written again with the current revision. Documents that
+        can't be written are kept for the next flush.
+        """
+        self._lock.acquire()
+        try:
+            doc_list = self._docs.values()
+            self._docs = {}
+            attempt = 0
+            while len(doc_list) > 0 and attempt < STATE_MAX_ATTEMPTS:
+                attempt += 1
+                for doc in doc_list:
+                    doc.set_rev_id(self._revs.get(doc.get_doc_id()))
+                conflicts = self._database.save_documents(doc_list)
+                if conflicts == None:
+                    break
+                for doc in doc_list:
+                    if doc.get_rev_id():
+                        self._revs[doc.get_doc_id()] = doc.get_rev_id()
+                for doc in conflicts:
+                    current = self._database.load_document(doc.get_doc_id())
+                    if current:
+                        self._revs[doc.get_doc_id()] = current.get_rev_id()
+                doc_list = conflicts
+            if len(doc_list) > 0:
+                cryptlog("Unable to save %i state documents." % len(doc_list))
+                for doc in doc_list:
+                    # documents saved meanwhile are newer
+                    if doc.get_doc_id() not in self._docs:
+                        self._docs[doc.get_doc_id()] = doc
+        finally:
+            self._lock.release()
+
+class SQLiteStateStore(StateStore):
+    """
+    stores the state information in an embedded SQLite database. The
+    database uses write-ahead logging; changes are committed in
+    batches.
+    """
+
+    def __init__(self, filepath=None):
+        """
+        creates an instance
+        Parameters:
+        - filepath
+          path of the database file. If None, STATE_SQLITE_FILENAME is
+          used.
+        """
+        if filepath == None:
+            filepath = os.path.expanduser(STATE_SQLITE_FILENAME)
+        self._filepath = filepath
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS states ("
+                                 "relpath TEXT PRIMARY KEY, "
+                                 "state TEXT, "
+                                 "state_timestamp REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS states_state "
+                                 "ON states (state)")
+        self._connection.commit()
+
+    def get_filepath(self):
+        """
+        Returns:
+        - path of the database file
+        """
+        return self._filepath
+
+    def load_state(self, relpath):
+        """
+        reads the state information of a file
+        Parameters:
+        - relpath
+          relative path of the file
+        Returns:
+        - dictionary of the state information or None
+        """
+        self._lock.acquire()
+        try:
+            cursor = self._connection.execute(
+                "SELECT relpath, state, state_timestamp FROM states "
+                "WHERE relpath = ?", (relpath,))
+            row = cursor.fetchone()
+        finally:
+            self._lock.release()
+        result = None
+        if row:
+            result = self._create_values(row)
+        return result
+
+    def save_state(self, values):
+        """
+        saves the state information of a file. The changes are
+        committed when STATE_BUFFER_SIZE changes are collected.
+        Parameters:
+        - values
+          dictionary of the state information
+        """
+        self._lock.acquire()
+        try:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO states "
+                "(relpath, state, state_timestamp) VALUES (?, ?, ?)",
+                (values["relpath"], values.get("state"),
+                 values.get("state_timestamp")))
+            self._pending += 1
+            if self._pending >= STATE_BUFFER_SIZE:
+                self.flush()
+        finally:
+            self._lock.release()
+
+    def iterate_states(self):
+        """
+        iterates over the state information of all files
+        Returns:
+        - generator of dictionaries of the state information
+        """
+        return self.iterate_sorted_states()
+
+    def iterate_sorted_states(self):
+        """
+        iterates over the state information of all files ordered by
+        the relative paths. SQLite compares text by its UTF-8 encoding.
+        The states are read in pages of STATE_PAGE_SIZE rows, each
+        continuing after the last path of the previous page. So
+        neither all states are kept in memory nor a cursor stays open
+        while states are saved and committed during the iteration.
+        Returns:
+        - generator of dictionaries of the state information
+        """
+        last_relpath = None
+        while True:
+            self._lock.acquire()
+            try:
+                if last_relpath == None:
+                    cursor = self._connection.execute(
+                        "SELECT relpath, state, state_timestamp FROM states "
+                        "ORDER BY relpath LIMIT ?", (STATE_PAGE_SIZE,))
+                else:
+                    cursor = self._connection.execute(
+                        "SELECT relpath, state, state_timestamp FROM states "
+                        "WHERE relpath > ? ORDER BY relpath LIMIT ?",
+                        (last_relpath, STATE_PAGE_SIZE))
+                rows = cursor.fetchmany(STATE_PAGE_SIZE)
+            finally:
+                self._lock.release()
+            for row in rows:
+                yield self._create_values(row)
+            if len(rows) < STATE_PAGE_SIZE:
+                break
+            last_relpath = rows[-1][0]
+
+    def _create_values(self, row):
+        """
+        Parameters:
+        - row
+          row of the states table
+        Returns:
+        - dictionary of the state information
+        """
+        return {"relpath": row[0], "state": row[1], "state_timestamp": row[2]}
+
+    def flush(self):
+        """
+        commits all changes
+        """
+        self._lock.acquire()
+        try:
+            if self._pending > 0:
+                self._connection.commit()
+                self._pending = 0
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        commits all changes and closes the database
+        """
+        self._lock.acquire()
+        try:
+            self.flush()
+            self._connection.close()
+        finally:
+            self._lock.release()
+
+def create_state_store(state_backend):
+    """
+    creates a database to store state information
+    Parameters:
+    - state_backend
+      STATE_BACKEND_COUCHDB or STATE_BACKEND_SQLITE
+    Returns:
+    - StateStore instance
+    """
+    if state_backend == STATE_BACKEND_SQLITE:
+        return SQLiteStateStore()
+    return CouchStateStore()
+
+# database to store state information, shared by all instances
+state_store = None
+state_store_lock = threading.Lock()
+
+def get_state_store():
+    """
+    returns the database to store state information. The database is
+    opened once per process when it is used the first time, depending
+    on the configured state backend. Collected changes are written when
+    the process exits at the latest.
+    Returns:
+    - StateStore instance
+    """
+    global state_store
+    state_store_lock.acquire()
+    try:
+        if state_store == None:
+            config = CryptBoxConfig()
+            state_store = create_state_store(config.get_state_backend())
+            atexit.register(flush_states)
+    finally:
+        state_store_lock.release()
+    return state_store
+
+def flush_states():
+    """
+    writes all collected changes of state information
+    """
+    if state_store != None:
+        state_store.flush()
+
+def migrate_states(source, target):
+    """
+    copies the state information of all files to another database
+    Parameters:
+    - source
+      StateStore to read from
+    - target
+      StateStore to write to
+    Returns:
+    - number of copied entries
+    """
+    result = 0
+    for values in source.iterate_states():
+        if values.get("relpath") == None:
+            continue
+        target.save_state(values)
+        result += 1
+    target.flush()
+    return result
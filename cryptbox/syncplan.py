@@ -0,0 +1,477 @@
+# cryptbox - planning the synchronization of the source directory
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import os.path
+
+from cancellation import *
+from config import *
+from debug import *
+from dirscanner import *
+from fileinfo import *
+
+# actions of a synchronization
+PLAN_UPLOAD = "upload"
+PLAN_TOUCH_REMOTE = "touch-remote"
+PLAN_DELETE_REMOTE = "delete-remote"
+PLAN_DOWNLOAD = "download"
+PLAN_TOUCH_LOCAL = "touch-local"
+PLAN_DELETE_LOCAL = "delete-local"
+
+PLAN_ACTIONS = [PLAN_UPLOAD, PLAN_TOUCH_REMOTE, PLAN_DELETE_REMOTE,
+                PLAN_DOWNLOAD, PLAN_TOUCH_LOCAL, PLAN_DELETE_LOCAL]
+
+def get_path_key(relpath):
+    """
+    Parameters:
+    - relpath
+      relative path as a string or unicode string
+    Returns:
+    - relative path as an UTF-8 encoded string, which is used to sort
+      and compare paths
+    """
+    if isinstance(relpath, unicode):
+        relpath = relpath.encode("utf-8")
+    return relpath
+
+def merge_join(sources):
+    """
+    joins several iterables that are sorted by their keys
+    Parameters:
+    - sources
+      list of iterables of tuples (key, item) sorted by the key. Each
+      key appears once per iterable.
+    Returns:
+    - generator of tuples (key, list of items). The list contains an
+      item for each source or None, if the source doesn't contain the
+      key.
+    """
+    iterators = [iter(source) for source in sources]
+    heads = []
+    for iterator in iterators:
+        heads.append(next(iterator, None))
+    while True:
+        keys = [head[0] for head in heads if head != None]
+        if len(keys) == 0:
+            break
+        key = min(keys)
+        items = []
+        for index in range(len(heads)):
+            head = heads[index]
+            if head != None and head[0] == key:
+                items.append(head[1])
+                heads[index] = next(iterators[index], None)
+            else:
+                items.append(None)
+        yield (key, items)
+
+class SyncAction(object):
+    """
+    action of a synchronization for a single file
+    """
+
+    def __init__(self, action, relpath, entry, fileinfo):
+        """
+        creates an instance
+        Parameters:
+        - action
+          one of the PLAN_* actions
+        - relpath
+          relative path of the file
+        - entry
+          CryptStoreEntry of the file or None
+        - fileinfo
+          FileInfo of the file
+        """
+        self._action = action
+        self._relpath = relpath
+        self._entry = entry
+        self._fileinfo = fileinfo
+
+    def get_action(self):
+        """
+        Returns:
+        - one of the PLAN_* actions
+        """
+        return self._action
+
+    def get_relative_path(self):
+        """
+        Returns:
+        - relative path of the file
+        """
+        return self._relpath
+
+    def get_entry(self):
+        """
+        Returns:
+        - CryptStoreEntry of the file or None
+        """
+        return self._entry
+
+    def get_fileinfo(self):
+        """
+        Returns:
+        - FileInfo of the file
+        """
+        return self._fileinfo
+
+class SyncPlan(object):
+    """
+    list of the actions of a synchronization
+    """
+
+    def __init__(self):
+        """
+        creates an instance
+        """
+        self._actions = {}
+        for action in PLAN_ACTIONS:
+            self._actions[action] = []
+        self._count = 0
+
+    def add(self, action):
+        """
+        adds an action
+        Parameters:
+        - action
+          SyncAction to add
+        """
+        self._actions[action.get_action()].append(action)
+
+    def get_actions(self, action):
+        """
+        Parameters:
+        - action
+          one of the PLAN_* actions
+        Returns:
+        - list of SyncAction instances of this action
+        """
+        return self._actions[action]
+
+    def get_relative_paths(self):
+        """
+        Returns:
+        - set of the relative paths of all files with an action
+        """
+        result = set()
+        for action in PLAN_ACTIONS:
+            for item in self._actions[action]:
+                result.add(item.get_relative_path())
+        return result
+
+    def get_upload_size(self):
+        """
+        Returns:
+        - number of bytes of the files to upload
+        """
+        result = 0
+        for action in self._actions[PLAN_UPLOAD]:
+            result += action.get_fileinfo().get_size() or 0
+        return result
+
+    def get_download_size(self, cryptstore):
+        """
+        Parameters:
+        - cryptstore
+          CryptStore containing the files to download
+        Returns:
+        - number of encrypted bytes of the files to download
+        """
+        result = 0
+        for action in self._actions[PLAN_DOWNLOAD]:
+            result += cryptstore.get_stored_size(action.get_entry())
+        return result
+
+    def set_file_count(self, count):
+        """
+        sets the number of files that were examined
+        Parameters:
+        - count
+          number of files
+        """
+        self._count = count
+
+    def get_file_count(self):
+        """
+        Returns:
+        - number of files that were examined
+        """
+        return self._count
+
+class SyncPlanner(object):
+    """
+    class to plan a synchronization. The files of the source directory,
+    the state information of the local files and the entries of the
+    CryptStore are sorted by their relative paths and joined in a
+    single pass; for each file the actions of the Uploader and the
+    Downloader are determined.
+    """
+
+    def __init__(self, cryptstore, digests=None):
+        """
+        creates an instance
+        Parameters:
+        - cryptstore
+          CryptStore instance to use
+        - digests
+          DigestCache to detect files with unchanged content or None,
+          if the content is not compared
+        """
+        self._cryptstore = cryptstore
+        self._digests = digests
+        config = CryptBoxConfig()
+        self._rootpath = config.get_source_directory()
+        self._threads = config.get_scan_threads()
+        self._upload = True
+        self._download = True
+        self._read_only = False
+
+    def set_read_only(self, flag):
+        """
+        sets, if planning must not read the content of files and must
+        not change the DigestCache. Then only cached digests are used
+        and a file with unchanged content may be planned to be
+        downloaded.
+        Parameters:
+        - flag
+          True, if planning must not read the content of files
+        """
+        self._read_only = flag
+
+    def _debug(self, action, entry, fileinfo):
+        """
+        logs debug information
+        Parameters:
+        - action
+          action to log
+        - entry
+          corresponding cryptstore entry
+        - fileinfo
+          corresponding file info
+        """
+        debuglog = DebugLogger("cryptbox", "SyncPlanner")
+        debuglog.debug_value("fileinfo.relative_path", fileinfo.get_relative_path())
+        debuglog.debug_value("fileinfo.file_timestamp", fileinfo.get_file_timestamp())
+        debuglog.debug_value("fileinfo.state_timestamp", fileinfo.get_state_timestamp())
+        if entry:
+            debuglog.debug_value("entry.state", entry.get_state())
+            debuglog.debug_value("entry.timestamp", entry.get_timestamp())
+        else:
+            debuglog.debug_value("entry", None)
+        debuglog.debug(action)
+
+    def create_plan(self, upload=True, download=True, directories=None, relpaths=None):
+        """
+        creates the plan of a synchronization
+        Parameters:
+        - upload
+          True, if the actions of the Uploader are planned
+        - download
+          True, if the actions of the Downloader are planned. If
+          both are planned, the Downloader actions take the result
+          of the Uploader actions into account.
+        - directories
+          set of relative paths of the directories whose files are
+          planned or None
+        - relpaths
+          set of relative paths of the files that are planned or None.
+          If directories and relpaths are None, all files are planned.
+        If the synchronization is cancelled, the plan is incomplete.
+        Returns:
+        - SyncPlan instance
+        """
+        self._upload = upload
+        self._download = download
+        scanner = DirScanner(self._rootpath, self._threads)
+        rules = scanner.get_rules()
+        if relpaths != None:
+            local = scanner.scan_path_stats(relpaths)
+        elif directories != None:
+            local = scanner.iterate_directory_stats(directories)
+        else:
+            local = scanner.iterate_stats()
+        local = ((get_path_key(relpath), st) for relpath, st in local)
+        if relpaths != None or directories != None:
+            local = sorted(local, key=lambda item: item[0])
+        sources = [local,
+                   self._iterate_states(directories, relpaths),
+                   self._iterate_entries(directories, relpaths)]
+        plan = SyncPlan()
+        count = 0
+        scanned = None
+        if relpaths == None and directories == None:
+            scanned = set()
+        for relpath, items in merge_join(sources):
+            if is_cancelled():
+                scanned = None
+                break
+            st, values, entry = items
+            if scanned != None and st != None:
+                scanned.add(relpath)
+            if st == None and rules.is_ignored(relpath):
+                continue
+            count += 1
+            fileinfo = FileInfo(self._rootpath)
+            fileinfo.set_relative_path(relpath)
+            if values != None:
+                fileinfo.load_state(values)
+            if st != None:
+                fileinfo.set_stat(st)
+            action = self._plan_file(fileinfo, st != None, values != None, entry)
+            if action != None:
+                plan.add(SyncAction(action, relpath, entry, fileinfo))
+        plan.set_file_count(count)
+        if self._digests != None and not self._read_only:
+            if scanned != None:
+                # digests of files that were deleted or are ignored now
+                self._digests.retain(scanned)
+            self._digests.save()
+        return plan
+
+    def _iterate_states(self, directories, relpaths):
+        """
+        Parameters:
+        - directories
+          set of relative paths of directories or None
+        - relpaths
+          set of relative paths of files or None
+        Returns:
+        - generator of tuples (relative path, state information) sorted
+          by the relative paths
+        """
+        store = get_state_store()
+        # state information that is not written yet is included
+        store.flush()
+        if relpaths != None:
+            for relpath in sorted(relpaths):
+                values = store.load_state(relpath)
+                if values != None:
+                    yield (get_path_key(relpath), values)
+            return
+        for values in store.iterate_sorted_states():
+            relpath = get_path_key(values.get("relpath"))
+            if directories == None or os.path.dirname(relpath) in directories:
+                yield (relpath, values)
+
+    def _iterate_entries(self, directories, relpaths):
+        """
+        Parameters:
+        - directories
+          set of relative paths of directories or None
+        - relpaths
+          set of relative paths of files or None
+        Returns:
+        - list of tuples (relative path, CryptStoreEntry) sorted by the
+          relative paths
+        """
+        result = []
+        if relpaths != None:
+            for relpath in relpaths:
+                entry = self._cryptstore.get_entry(relpath)
+                if entry != None:
+                    result.append((get_path_key(relpath), entry))
+        else:
+            for entry in self._cryptstore.get_entries():
+                relpath = get_path_key(entry.get_filepath())
+                if directories == None or os.path.dirname(relpath) in directories:
+                    result.append((relpath, entry))
+        result.sort(key=lambda item: item[0])
+        return result
+
+    def _is_content_unchanged(self, fileinfo, entry):
+        """
+        checks if the content of a file equals the content that was
+        uploaded, although the timestamp of the file changed. Only a
+        cached digest is used. Otherwise the file is planned to be
+        uploaded, so that it is read only once: its digest is computed
+        while it is encrypted and an unchanged encrypted file is kept
+        (see CryptStore.upload_files()).
+        Parameters:
+        - fileinfo
+          scanned file info of the file
+        - entry
+          entry of the file in the CryptStore
+        Returns:
+        - True:  content is unchanged
+        - False: content changed or may have changed
+        """
+        result = False
+        entry_digest = entry.get_digest()
+        if self._digests and entry_digest and entry.get_state() != FILEINFO_STATE_DELETED:
+            result = self._digests.get_digest(fileinfo) == entry_digest
+        return result
+
+    def _plan_file(self, fileinfo, exists, has_state, entry):
+        """
+        determines the action for a file
+        Parameters:
+        - fileinfo
+          FileInfo of the file. It is scanned, if the file exists.
+        - exists
+          True, if the file exists in the source directory
+        - has_state
+          True, if there is state information of the file
+        - entry
+          CryptStoreEntry of the file or None
+        Returns:
+        - one of the PLAN_* actions or None
+        """
+        if self._upload:
+            if not exists:
+                if has_state and fileinfo.get_state() != FILEINFO_STATE_DELETED \
+                   and entry and entry.get_state() != FILEINFO_STATE_DELETED:
+                    if entry.get_timestamp() > fileinfo.get_state_timestamp():
+                        self._debug("file not deleted", entry, fileinfo)
+                    else:
+                        self._debug("file deleted", entry, fileinfo)
+                        return PLAN_DELETE_REMOTE
+            elif entry == None or fileinfo.get_file_timestamp() > entry.get_timestamp():
+                if entry and self._is_content_unchanged(fileinfo, entry):
+                    self._debug("timestamp updated", entry, fileinfo)
+                    return PLAN_TOUCH_REMOTE
+                self._debug("file uploaded", entry, fileinfo)
+                return PLAN_UPLOAD
+            # a file that is uploaded or deleted is up to date in the
+            # CryptStore, so the Downloader has nothing to do
+        if not self._download or entry == None:
+            return None
+        entry_timestamp = entry.get_timestamp()
+        if entry.get_state() != FILEINFO_STATE_DELETED:
+            if exists and entry_timestamp - fileinfo.get_file_timestamp() <= 1:
+                # the file in the source directory is newer than in the
+                # destination directory; it will not be downloaded.
+                self._debug("file not downloaded", entry, fileinfo)
+                return None
+            if exists and entry.get_digest() and self._digests:
+                # a local file with the same content only gets the
+                # timestamp of the entry
+                if self._read_only:
+                    digest = self._digests.get_digest(fileinfo)
+                else:
+                    digest = self._digests.compute_digest(fileinfo)
+                if digest == entry.get_digest():
+                    self._debug("timestamp updated", entry, fileinfo)
+                    return PLAN_TOUCH_LOCAL
+            self._debug("file downloaded", entry, fileinfo)
+            return PLAN_DOWNLOAD
+        if exists:
+            if entry_timestamp - fileinfo.get_file_timestamp() <= 1:
+                # the file in the source directory was modified after
+                # the file was deleted in the destination directory; it
+                # will be not deleted but uploaded again.
+                self._debug("file uploaded", entry, fileinfo)
+                return PLAN_UPLOAD
+            self._debug("file deleted", entry, fileinfo)
+            return PLAN_DELETE_LOCAL
+        return None
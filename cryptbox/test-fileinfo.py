@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# cryptbox - tests scanning the properties of files
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import os
+import os.path
+import shutil
+import tempfile
+
+import statestore
+
+from fileinfo import *
+
+if __name__ == "__main__":
+    rootpath = tempfile.mkdtemp()
+    statestore.state_store = SQLiteStateStore(os.path.join(rootpath, "state.db"))
+    filepath = os.path.join(rootpath, "test.txt")
+    testfile = open(filepath, "w")
+    testfile.write("test")
+    testfile.close()
+    fileinfo = FileInfo(rootpath)
+    fileinfo.set_filepath(filepath)
+    fileinfo.scan()
+    assert fileinfo.get_file_timestamp() == os.path.getmtime(filepath)
+    assert fileinfo.get_size() == 4
+    os.remove(filepath)
+    fileinfo.scan()
+    assert fileinfo.get_file_timestamp() == None
+    assert fileinfo.get_size() == None
+    assert fileinfo.get_inode() == None
+    assert not fileinfo.exists()
+    statestore.state_store.close()
+    shutil.rmtree(rootpath)
+    print "scanning a removed file passed."
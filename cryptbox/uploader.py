@@ -12,104 +12,93 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+from cancellation import *
 from config import *
 from cryptlog import *
-from dirscanner import *
-from debug import *
+from digestcache import *
 from fileinfo import *
+from syncplan import *
 
 class Uploader(object):
     """
     class to process uploads to the CryptStore
     """
 
-    def __init__(self, cryptstore):
+    def __init__(self, cryptstore, workers=None, digests=None):
         """
         creates an instance
         Parameters:
         - cryptstore
           CryptStore instance to use
+        - workers
+          number of worker processes to encrypt files (None: use
+          the configured value)
+        - digests
+          DigestCache to use (None: use an own instance)
         """
         self._cryptstore = cryptstore
+        self._workers = workers
+        if digests == None:
+            digests = DigestCache()
+        self._digests = digests
 
-    def _debug(self, action, entry, fileinfo):
-        """
-        logs debug information
-        Parameters:
-        - action
-          action to log
-        - entry
-          corresponding cryptstore entry
-        - fileinfo
-          corresponding file info
-        """
-        debuglog = DebugLogger("cryptbox", "Uploader")
-        debuglog.debug_value("fileinfo.relative_path", fileinfo.get_relative_path())
-        debuglog.debug_value("fileinfo.exist", fileinfo.exists())
-        debuglog.debug_value("fileinfo.file_timestamp", fileinfo.get_file_timestamp())
-        debuglog.debug_value("fileinfo.state_timestamp", fileinfo.get_state_timestamp())
-        if entry:
-            debuglog.debug_value("entry.state", entry.get_state())
-            debuglog.debug_value("entry.timestamp", entry.get_timestamp())
-        else:
-            debuglog.debug_value("entry", None)
-        debuglog.debug(action)
-
- 
-    def run(self):
+    def run(self, directories=None):
         """
         executes the Uploader
+        Parameters:
+        - directories
+          set of relative paths of the directories whose files are
+          checked. If None, all files are checked.
+        Returns:
+        - executed SyncPlan
         """
-        self.check_for_delete()
-        self.check_for_upload()
+        planner = SyncPlanner(self._cryptstore, self._digests)
+        plan = planner.create_plan(download=False, directories=directories)
+        self.execute(plan)
+        return plan
 
-    def check_for_delete(self):
+    def run_changes(self, relpaths):
         """
-        check if files should be deleted
+        executes the Uploader only for the given files
+        Parameters:
+        - relpaths
+          relative paths of the changed files
+        Returns:
+        - executed SyncPlan
         """
-        debuglog = DebugLogger("cryptbox", "Uploader.check_for_delete")
-        database = FileInfoDatabase()
-        for fileinfo in database.get_all():
-            fileinfo.scan()
-            if not fileinfo.exists():
-                if fileinfo.get_state() != FILEINFO_STATE_DELETED:
-                    delete_flag = True
-                    filepath = fileinfo.get_relative_path()
-                    file_timestamp = fileinfo.get_state_timestamp()
-                    entry = self._cryptstore.get_entry(filepath)
-                    if entry:
-                        entry_timestamp = entry.get_timestamp()
-                        if entry.get_state() != FILEINFO_STATE_DELETED:
-                            if entry_timestamp > file_timestamp:
-                                self._debug("file not deleted", entry, fileinfo)
-                                delete_flag = False
-                        if delete_flag and entry.get_state() != FILEINFO_STATE_DELETED:
-                            self._debug("file deleted", entry, fileinfo)
-                            self._cryptstore.delete_file(entry)
-                            cryptlog("%s deleted." % filepath)
+        planner = SyncPlanner(self._cryptstore, self._digests)
+        plan = planner.create_plan(download=False, relpaths=relpaths)
+        self.execute(plan)
+        return plan
 
-    def check_for_upload(self):
+    def execute(self, plan):
         """
-        check if files should be uploaded
+        executes the uploads, deletions and timestamp updates of a plan.
+        If the synchronization is cancelled, the remaining actions are
+        skipped; the executed actions are recorded.
+        Parameters:
+        - plan
+          SyncPlan to execute
         """
-        config = CryptBoxConfig()
-        srcpath = config.get_source_directory()
-        scanner = DirScanner(srcpath)
-        for fileinfo in scanner.get_list().get_entries():
-            upload_flag = False
-            fileinfo.scan()
-            relpath = fileinfo.get_relative_path()
-            storeentry = self._cryptstore.get_entry(relpath)
-            if storeentry:
-                file_timestamp = fileinfo.get_file_timestamp()
-                store_timestamp = storeentry.get_timestamp()
-                if file_timestamp > store_timestamp:
-                    upload_flag = True
-            else:
-                upload_flag = True
-            if upload_flag:
-                self._debug("file uploaded", storeentry, fileinfo)
-                self._cryptstore.upload_file(fileinfo)
-                cryptlog("%s uploadad." % relpath)
-            else:
-                self._debug("no action", storeentry, fileinfo)
+        with self._cryptstore.batch():
+            for action in plan.get_actions(PLAN_DELETE_REMOTE):
+                if is_cancelled():
+                    break
+                self._cryptstore.delete_file(action.get_entry())
+                self._digests.remove_digest(action.get_relative_path())
+                cryptlog("%s deleted." % action.get_relative_path())
+            for action in plan.get_actions(PLAN_TOUCH_REMOTE):
+                if is_cancelled():
+                    break
+                self._cryptstore.update_timestamp(action.get_fileinfo())
+                cryptlog("%s timestamp updated." % action.get_relative_path())
+            fileinfos = [action.get_fileinfo() for action in plan.get_actions(PLAN_UPLOAD)]
+            uploads = self._cryptstore.upload_files(fileinfos, self._workers)
+            for fileinfo, flag in uploads:
+                if flag:
+                    relpath = fileinfo.get_relative_path()
+                    entry = self._cryptstore.get_entry(relpath)
+                    self._digests.set_digest(fileinfo, entry.get_digest())
+                    cryptlog("%s uploadad." % relpath)
+        flush_states()
+        self._digests.save()
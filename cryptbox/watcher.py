@@ -0,0 +1,329 @@
+# cryptbox - class to watch the source directory for changes
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import select
+import struct
+import time
+
+from cancellation import *
+from cryptlog import *
+from ignorerules import *
+
+# flags of inotify_init1()
+IN_NONBLOCK = 04000
+IN_CLOEXEC = 02000000
+
+# inotify events
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# events to watch in each directory
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+             IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+             IN_MOVE_SELF | IN_ONLYDIR
+
+# header of an inotify event: wd, mask, cookie, length of the name
+EVENT_HEADER = struct.Struct("iIII")
+
+# number of bytes to read at once
+EVENT_BUFFER_SIZE = 64 * 1024
+
+def load_libc():
+    """
+    loads the C library for the inotify functions
+    Returns:
+    - ctypes library or None, if inotify is not available
+    """
+    result = None
+    try:
+        libname = ctypes.util.find_library("c") or "libc.so.6"
+        libc = ctypes.CDLL(libname, use_errno=True)
+        if hasattr(libc, "inotify_init1") and hasattr(libc, "inotify_add_watch"):
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                               ctypes.c_uint32]
+            result = libc
+    except OSError:
+        pass
+    return result
+
+class InotifyWatcher(object):
+    """
+    class to watch the source directory for changes by using inotify.
+    The relative paths of changed files and of the directories
+    containing them are collected. If the changes can't be determined
+    exactly - e.g. the event queue overflowed or a directory was
+    removed - a full rescan is requested.
+    """
+
+    def __init__(self, rootpath):
+        """
+        creates an instance
+        Parameters:
+        - rootpath
+          path of the directory to watch
+        """
+        self._rootpath = rootpath
+        self._libc = load_libc()
+        self._fd = None
+        self._rules = None
+        self._watches = {}
+        self._changes = set()
+        self._dirty = None
+        self._rescan_flag = False
+        self._last_event = 0
+
+    def start(self):
+        """
+        starts watching the directory and its subdirectories
+        Returns:
+        - True:  the directory is watched
+        - False: inotify is not available or the directory can't be
+                 watched completely
+        """
+        self.close()
+        if self._libc == None:
+            return False
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return False
+        self._fd = fd
+        self._rules = IgnoreRules(self._rootpath)
+        self._watches = {}
+        self._changes = set()
+        # the directories changed before the start are unknown
+        self._dirty = None
+        self._rescan_flag = False
+        if not self._add_tree(""):
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        """
+        stops watching
+        """
+        if self._fd != None:
+            os.close(self._fd)
+            self._fd = None
+        self._watches = {}
+
+    def is_watching(self):
+        """
+        Returns:
+        - True:  the directory is watched
+        - False: the directory is not watched
+        """
+        return self._fd != None
+
+    def _add_watch(self, reldir):
+        """
+        adds a watch for a directory
+        Parameters:
+        - reldir
+          relative path of the directory
+        Returns:
+        - True:  the watch was added or the directory doesn't exist
+                 anymore
+        - False: the limit of watches is reached
+        """
+        path = os.path.join(self._rootpath, reldir)
+        wd = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                cryptlog("Limit of inotify watches reached.")
+                return False
+            return True
+        self._watches[wd] = reldir
+        return True
+
+    def _add_tree(self, reldir):
+        """
+        adds watches for a directory and its subdirectories. The
+        files in the directories are marked as changed, since they
+        may have been created before the watches were added.
+        Parameters:
+        - reldir
+          relative path of the directory
+        Returns:
+        - True:  the watches were added
+        - False: the limit of watches is reached
+        """
+        stack = [reldir]
+        while len(stack) > 0:
+            current = stack.pop()
+            if not self._add_watch(current):
+                return False
+            self._mark_dirty(current)
+            try:
+                names = os.listdir(os.path.join(self._rootpath, current))
+            except OSError:
+                continue
+            for name in names:
+                relpath = os.path.join(current, name)
+                if os.path.isdir(os.path.join(self._rootpath, relpath)):
+                    if not self._rules.is_ignored(relpath, True):
+                        stack.append(relpath)
+                elif reldir != "":
+                    self._changes.add(relpath)
+        return True
+
+    def wait(self, timeout):
+        """
+        waits for events and processes them. The waiting ends as
+        well, if the synchronization is cancelled.
+        Parameters:
+        - timeout
+          maximal number of seconds to wait
+        """
+        if self._fd == None:
+            wait_cancelled(timeout)
+            return
+        try:
+            readable = select.select([self._fd], [], [], timeout)[0]
+        except select.error:
+            return
+        if len(readable) == 0:
+            return
+        try:
+            data = os.read(self._fd, EVENT_BUFFER_SIZE)
+        except OSError:
+            return
+        self._last_event = time.time()
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip("\0")
+            pos += length
+            self._process_event(wd, mask, name)
+
+    def _process_event(self, wd, mask, name):
+        """
+        processes an inotify event
+        Parameters:
+        - wd
+          watch descriptor of the directory
+        - mask
+          event mask
+        - name
+          name of the file in the directory
+        """
+        if mask & IN_Q_OVERFLOW:
+            cryptlog("inotify event queue overflowed.")
+            self._rescan_flag = True
+            return
+        reldir = self._watches.get(wd)
+        if reldir == None:
+            return
+        if mask & IN_IGNORED:
+            del self._watches[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # the files of the directory have to be checked and the
+            # paths of the watches may be outdated
+            if reldir == "":
+                cryptlog("Source directory was moved or deleted.")
+            self._rescan_flag = True
+            return
+        relpath = os.path.join(reldir, name)
+        if name == IGNORE_FILENAME:
+            # the rules changed; ignored files may have to be uploaded
+            self._rescan_flag = True
+            return
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if self._rules.is_ignored(relpath, True):
+                    return
+                if not self._add_tree(relpath):
+                    self._rescan_flag = True
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._rescan_flag = True
+        else:
+            self._changes.add(relpath)
+            self._mark_dirty(reldir)
+
+    def _mark_dirty(self, reldir):
+        """
+        records a directory whose files changed
+        Parameters:
+        - reldir
+          relative path of the directory
+        """
+        if self._dirty != None:
+            self._dirty.add(reldir)
+
+    def is_rescan_required(self):
+        """
+        Returns:
+        - True:  a full rescan is required
+        - False: the collected changes are complete
+        """
+        return self._rescan_flag
+
+    def get_changes(self, settle_time):
+        """
+        returns the collected changes, if no events occurred for a
+        while. The returned changes are removed.
+        Parameters:
+        - settle_time
+          number of seconds without events
+        Returns:
+        - set of the relative paths of the changed files or None
+        """
+        result = None
+        if len(self._changes) > 0 and time.time() - self._last_event >= settle_time:
+            result = self._changes
+            self._changes = set()
+        return result
+
+    def get_dirty_directories(self):
+        """
+        returns the directories whose files changed since the last call
+        or since the start. The changes of files consumed by
+        get_changes() are included. The returned directories are
+        removed.
+        Returns:
+        - set of the relative paths of the directories or None, if
+          the changes are not known completely
+        """
+        result = self._dirty
+        if self._fd == None or self._rescan_flag:
+            result = None
+        self._dirty = set()
+        return result
+
+    def clear_changes(self):
+        """
+        removes the collected changes, since a full scan will examine
+        all files
+        """
+        self._changes = set()
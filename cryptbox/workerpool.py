@@ -0,0 +1,224 @@
+# cryptbox - pool of worker processes
+#
+# Copyright 2012 Jochen Skulj, jochen@jochenskulj.de
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import collections
+import multiprocessing
+import sys
+import traceback
+
+from cancellation import *
+
+# number of jobs per worker that are submitted in advance
+JOBS_PER_WORKER = 2
+
+# kinds of jobs: a job that processes a whole item, e.g. a file, or a
+# job that processes a part of an item that is split into several jobs
+JOB_ITEM = "item"
+JOB_PART = "part"
+JOB_LAST_PART = "last"
+
+def get_worker_count(workers):
+    """
+    determines the number of worker processes to use
+    Parameters:
+    - workers
+      configured number of workers. 0 or None means one worker per
+      CPU.
+    Returns:
+    - number of worker processes
+    """
+    result = workers
+    if result == None or result <= 0:
+        try:
+            result = multiprocessing.cpu_count()
+        except NotImplementedError:
+            result = 1
+    return result
+
+def execute_job(function, args):
+    """
+    executes a job and catches its errors. This function is executed
+    by the worker processes.
+    Parameters:
+    - function
+      module level function to execute
+    - args
+      tuple of arguments for the function
+    Returns:
+    - tuple of the result and an error message or None
+    """
+    result = None
+    error = None
+    try:
+        result = function(*args)
+    except Exception:
+        error = "".join(traceback.format_exception(*sys.exc_info()))
+    return (result, error)
+
+def combine_results(results, finish, abort):
+    """
+    combines the results of the jobs of items that are split into
+    several jobs. The jobs of such an item are consecutive; its last
+    job has the kind JOB_LAST_PART.
+    Parameters:
+    - results
+      results of WorkerPool.run_jobs(). Each tag is a tuple of the
+      item and the kind of the job.
+    - finish
+      function that completes an item in the current process after
+      all its jobs succeeded. It gets the item and the list of the
+      results of the jobs and returns the result for the item.
+    - abort
+      function that cleans up an item whose jobs failed or were not
+      all executed. It gets the item.
+    Returns:
+    - generator of tuples (item, result, error) for each item. error
+      is None if the item was processed successfully.
+    """
+    item = None
+    values = []
+    errors = []
+    try:
+        for tag, result, error in results:
+            item, kind = tag
+            if kind == JOB_ITEM:
+                item = None
+                yield (tag[0], result, error)
+                continue
+            if error:
+                errors.append(error)
+            else:
+                values.append(result)
+            if kind == JOB_LAST_PART:
+                result = None
+                error = None
+                if len(errors) > 0:
+                    error = errors[0]
+                else:
+                    try:
+                        result = finish(item, values)
+                    except Exception:
+                        error = "".join(traceback.format_exception(*sys.exc_info()))
+                if error:
+                    abort(item)
+                done = item
+                item = None
+                values = []
+                errors = []
+                yield (done, result, error)
+    finally:
+        # the last jobs of an item were not executed
+        if item != None:
+            abort(item)
+
+class WorkerPool(object):
+    """
+    pool of worker processes to execute independent jobs like
+    encrypting or decrypting files
+    """
+
+    def __init__(self, workers=None):
+        """
+        creates an instance
+        Parameters:
+        - workers
+          number of worker processes. 0 or None means one worker per
+          CPU. If only one worker is used, the jobs are executed in
+          the current process.
+        """
+        self._size = get_worker_count(workers)
+        self._pool = None
+        if self._size > 1:
+            self._pool = multiprocessing.Pool(self._size)
+
+    def get_size(self):
+        """
+        Returns:
+        - number of worker processes
+        """
+        return self._size
+
+    def run(self, function, jobs):
+        """
+        executes a function for each job (see run_jobs())
+        Parameters:
+        - function
+          module level function to execute
+        - jobs
+          iterable of tuples (tag, args). tag identifies the job and
+          is returned with the result; args is the tuple of arguments
+          for the function.
+        Returns:
+        - generator of tuples (tag, result, error) in the order of
+          the jobs. error is None if the job succeeded.
+        """
+        return self.run_jobs((tag, function, args) for tag, args in jobs)
+
+    def run_jobs(self, jobs):
+        """
+        executes jobs that may call different functions. The jobs are
+        consumed lazily and only a limited number of jobs is pending at
+        any time, so jobs may be created while the results are
+        processed. If the operations are cancelled, no further jobs are
+        started; the results of the started jobs are still returned.
+        Parameters:
+        - jobs
+          iterable of tuples (tag, function, args). tag identifies the
+          job and is returned with the result; function is the module
+          level function to execute and args the tuple of its
+          arguments.
+        Returns:
+        - generator of tuples (tag, result, error) in the order of
+          the jobs. error is None if the job succeeded.
+        """
+        if self._pool == None:
+            for tag, function, args in jobs:
+                if is_cancelled():
+                    break
+                result, error = execute_job(function, args)
+                yield (tag, result, error)
+            return
+        pending = collections.deque()
+        window = self._size * JOBS_PER_WORKER
+        for tag, function, args in jobs:
+            if is_cancelled():
+                break
+            async_result = self._pool.apply_async(execute_job, (function, args))
+            pending.append((tag, async_result))
+            if len(pending) >= window:
+                tag, async_result = pending.popleft()
+                result, error = async_result.get()
+                yield (tag, result, error)
+        while len(pending) > 0:
+            tag, async_result = pending.popleft()
+            result, error = async_result.get()
+            yield (tag, result, error)
+
+    def close(self):
+        """
+        waits for the worker processes and closes the pool
+        """
+        if self._pool != None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        """
+        stops the worker processes immediately
+        """
+        if self._pool != None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None